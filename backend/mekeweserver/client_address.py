@@ -0,0 +1,19 @@
+from slowapi.util import get_remote_address
+from starlette.requests import Request
+
+from mekeweserver.config import Config, get_config
+
+config: Config = get_config()
+
+
+def get_client_address(request: Request) -> str:
+    """Address of the client for rate limiting and fair queue scheduling. See `config.SERVER_TRUST_FORWARDED_HEADERS`."""
+    if config.SERVER_TRUST_FORWARDED_HEADERS:
+        forwarded_for = request.headers.get("X-Forwarded-For")
+        if forwarded_for:
+            # every proxy appends the address it got the request from. The first one is the client.
+            return forwarded_for.split(",")[0].strip()
+        real_ip = request.headers.get("X-Real-IP")
+        if real_ip:
+            return real_ip.strip()
+    return get_remote_address(request)
@@ -66,6 +66,10 @@ class Config(BaseSettings):
         default=None,
         description="The protocol detection can fail in certain reverse proxy situations. This option allows you to manually override the automatic detection",
     )
+    SERVER_TRUST_FORWARDED_HEADERS: bool = Field(
+        default=False,
+        description="Take the client address for rate limiting and fair queue scheduling from the 'X-Forwarded-For'/'X-Real-IP' headers. Enable this only if the server runs behind a reverse proxy that sets these headers, otherwise clients can spoof their address.",
+    )
     SERVER_ALLOWED_ORIGINS: List[str] = Field(
         default_factory=list,
         description="Additional http allowed origins values.",
@@ -91,6 +95,186 @@ class Config(BaseSettings):
         description="If a MetaKegg pipeline has finished and is expired, all its metadata will be wiped after this amounts of minutes after expiring. If a user tries to revisit it, there will be a 404 error.",
     )
 
+    PIPELINE_HOUSEKEEPING_MAX_ITEMS_PER_TICK: int = Field(
+        default=100,
+        description="Maximum amount of pipeline runs that will be expired, deleted or cleaned up as abandoned per housekeeping tick (per task). Due pipeline runs above this limit will be handled in the next tick.",
+    )
+    PIPELINE_HOUSEKEEPING_FILE_DELETION_PARALLELISM: int = Field(
+        default=4,
+        description="Amount of threads that delete the files of expired pipeline runs in parallel.",
+    )
+
+    PIPELINE_WORKER_COUNT: int = Field(
+        default=1,
+        ge=0,
+        description="Amount of pipeline worker processes started by the server (or by `python -m mekeweserver.worker`). Each worker processes one pipeline run at a time. Crashed workers will be restarted. Set to 0 on API server nodes if the workers run on separate nodes.",
+    )
+    PIPELINE_WORKER_HEARTBEAT_INTERVAL_SEC: int = Field(
+        default=10,
+        description="Interval in which each pipeline worker reports that it is alive to redis.",
+    )
+    PIPELINE_WORKER_HEARTBEAT_TIMEOUT_SEC: int = Field(
+        default=30,
+        description="A pipeline worker without a heartbeat for this time is reported as unhealthy in `/health`.",
+    )
+    PIPELINE_WORKER_FORGET_AFTER_SEC: int = Field(
+        default=3600,
+        description="A pipeline worker without a heartbeat for this time is considered as removed (e.g. it was killed and replaced under another worker id). The housekeeper removes its heartbeat, so it is not reported in `/health` anymore.",
+    )
+    PIPELINE_WORKER_DEQUEUE_MODE: Literal["polling", "blocking"] = Field(
+        default="blocking",
+        description="`polling`: The pipeline worker checks the queue for new pipeline runs once a second. `blocking`: The pipeline worker waits on the signal list of the queue (Redis BRPOP) and picks up new pipeline runs immediately. The list holds at most one token, set on every enqueue and passed on by every dequeue that leaves tickets in the queue.",
+    )
+    PIPELINE_WORKER_DEQUEUE_TIMEOUT_SEC: float = Field(
+        default=5,
+        description="In `blocking` dequeue mode, the max time the pipeline worker waits for a new pipeline run before it checks for other tasks (e.g. shutdown).",
+    )
+    PIPELINE_WORKER_CONCURRENT_ANALYSES: int = Field(
+        default=1,
+        description="Max. number of analyses one pipeline worker runs at the same time. Each analysis runs in its own child process (metaKEGG changes the working directory of its process and writes its output files relative to it, so analyses can not share one), with its own output log and resource limits. While one analysis waits (e.g. for KEGG downloads) the others go on. Values larger than 1 require `PIPELINE_RUN_IN_SUBPROCESS`.",
+    )
+    PIPELINE_WORKER_PRELOAD_ANALYSIS_MODULES: bool = Field(
+        default=True,
+        description="Import and initialise metaKEGG and its heavy dependencies (pandas, matplotlib incl. font cache, Biopython, reportlab, openpyxl) once when the pipeline worker starts. With `PIPELINE_RUN_IN_SUBPROCESS` this happens in the fork server that starts the analysis child processes, so they start warm. The startup times (warm vs. cold) are tracked in the pipeline statistics.",
+    )
+    PIPELINE_WORKER_DRAIN_GRACE_PERIOD_SEC: float = Field(
+        default=60,
+        description="On shutdown (SIGTERM/SIGINT) the workers stop taking new pipeline runs. A running pipeline run gets this much time to finish. After that it is aborted and put back to the head of the queue, without counting as a failed attempt. Keep it below the kill timeout of your container runtime (e.g. `terminationGracePeriodSeconds`). Only effective with `PIPELINE_RUN_IN_SUBPROCESS`.",
+    )
+    PIPELINE_QUEUE_SCHEDULING: Literal["fair", "fifo"] = Field(
+        default="fair",
+        description="How the next pipeline run is picked from the queue. `fair`: Pipeline runs of different clients (identified by their IP address) are interleaved, so a client that submits many pipeline runs at once does not block everybody else. `fifo`: First come, first served.",
+    )
+    PIPELINE_QUEUE_CLIENT_WEIGHTS: Dict[str, float] = Field(
+        default_factory=dict,
+        description="Share of the workers a client gets with `fair` scheduling, relative to other clients. Clients are identified by IP address. Clients that are not listed have a weight of 1. e.g. `{'10.0.0.5': 3}` lets the client 10.0.0.5 start 3 pipeline runs for every pipeline run of other clients.",
+    )
+    PIPELINE_QUEUE_CLIENT_PRIORITIES: Dict[str, int] = Field(
+        default_factory=dict,
+        description="Priority class per client (IP address). Queued pipeline runs of a higher priority class are always started before the ones of a lower class. Clients that are not listed have a priority of 0.",
+    )
+    PIPELINE_QUEUE_MAX_LENGTH: Optional[int] = Field(
+        default=None,
+        description="Admission control: Max number of queued pipeline runs. If the queue is full, new pipeline runs and file uploads are rejected with HTTP 503 and a 'Retry-After' header. Set to null for no limit.",
+    )
+    PIPELINE_QUEUE_MAX_ESTIMATED_WAIT_SEC: Optional[int] = Field(
+        default=None,
+        description="Admission control: Max estimated waiting time in the queue, based on the recent throughput of the workers. If it is exceeded, new pipeline runs and file uploads are rejected with HTTP 503 and a 'Retry-After' header. Set to null for no limit.",
+    )
+    PIPELINE_RUN_DEFAULT_DURATION_ESTIMATE_SEC: int = Field(
+        default=300,
+        description="Assumed running time of a pipeline run for queue waiting time estimates, as long as there are no statistics of finished pipeline runs.",
+    )
+    PIPELINE_HOUSEKEEPING_RECOVER_INTERRUPTED_RUNS_INTERVAL_SEC: float = Field(
+        default=10,
+        description="Interval in which the housekeeper looks for pipeline runs of crashed workers and requeues them.",
+    )
+    PIPELINE_HOUSEKEEPING_EXPIRE_RUNS_INTERVAL_SEC: float = Field(
+        default=10,
+        description="Interval in which the housekeeper expires finished pipeline runs and deletes their files.",
+    )
+    PIPELINE_HOUSEKEEPING_DELETE_RUNS_INTERVAL_SEC: float = Field(
+        default=60,
+        description="Interval in which the housekeeper deletes the metadata of expired pipeline runs.",
+    )
+    PIPELINE_HOUSEKEEPING_DELETE_ABANDONED_RUNS_INTERVAL_SEC: float = Field(
+        default=60,
+        description="Interval in which the housekeeper deletes pipeline runs that were never started.",
+    )
+    PIPELINE_HOUSEKEEPING_CLEAN_ZOMBIE_FILES_INTERVAL_SEC: float = Field(
+        default=300,
+        description="Interval in which the housekeeper deletes directories in `PIPELINE_RUNS_CACHE_DIR` that do not belong to any pipeline run and unreferenced files in `PIPELINE_UPLOAD_BLOB_DIR`.",
+    )
+    PIPELINE_HOUSEKEEPING_PURGE_STATISTICS_INTERVAL_SEC: float = Field(
+        default=600,
+        description="Interval in which the housekeeper removes old pipeline run statistics.",
+    )
+    PIPELINE_HOUSEKEEPING_REMOVE_GONE_WORKERS_INTERVAL_SEC: float = Field(
+        default=60,
+        description="Interval in which the housekeeper removes the heartbeats of pipeline workers that are gone (see `PIPELINE_WORKER_FORGET_AFTER_SEC`).",
+    )
+    PIPELINE_HOUSEKEEPING_REFRESH_QUEUE_ESTIMATES_INTERVAL_SEC: float = Field(
+        default=10,
+        description="Interval in which the housekeeper recalculates the estimated start times of queued pipeline runs. They are recalculated on every queue change too.",
+    )
+    PIPELINE_RUN_LEASE_TTL_SEC: int = Field(
+        default=60,
+        description="A worker holds a lease on the pipeline run it processes and refreshes it periodically. If the lease is not refreshed within this time (e.g. because the worker crashed), the pipeline run will be put back into the queue.",
+    )
+    PIPELINE_RUN_LEASE_HEARTBEAT_INTERVAL_SEC: int = Field(
+        default=15,
+        description="Interval in which a worker refreshes the lease of the pipeline run it processes. Must be smaller than `PIPELINE_RUN_LEASE_TTL_SEC`.",
+    )
+    PIPELINE_RUN_MAX_ATTEMPTS: int = Field(
+        default=3,
+        description="How often a pipeline run will be started before it is marked as `failed`, if the workers processing it keep crashing.",
+    )
+    PIPELINE_RUN_IN_SUBPROCESS: bool = Field(
+        default=True,
+        description="Run each MetaKEGG analysis in its own child process of the worker. A crashing or hanging analysis can not take down the worker this way and the limits below can be enforced. Only disable for debugging.",
+    )
+    PIPELINE_RUN_TIMEOUT_SEC: Optional[int] = Field(
+        default=14400,
+        description="Wall-clock time limit for a single MetaKEGG analysis. If exceeded, the analysis will be killed and the pipeline run marked as `failed`. Requires `PIPELINE_RUN_IN_SUBPROCESS`. Set to null for no limit.",
+    )
+    PIPELINE_RUN_MAX_MEMORY_BYTES: Optional[int] = Field(
+        default=None,
+        description="Max virtual memory (RLIMIT_AS) of a single MetaKEGG analysis process in bytes. Requires `PIPELINE_RUN_IN_SUBPROCESS`. Set to null for no limit.",
+        examples=[8589934592],
+    )
+    PIPELINE_RUN_MAX_CPU_SEC: Optional[int] = Field(
+        default=None,
+        description="Max CPU time (RLIMIT_CPU) of a single MetaKEGG analysis process in seconds. Requires `PIPELINE_RUN_IN_SUBPROCESS`. Set to null for no limit.",
+    )
+    PIPELINE_RUN_OUTPUT_LOG_FLUSH_INTERVAL_SEC: float = Field(
+        default=0.25,
+        description="The output of a running analysis (stdout, stderr and log records) is buffered in memory and written to the database in batches. This is the max. time a line stays in the buffer.",
+    )
+    PIPELINE_RUN_OUTPUT_LOG_FLUSH_SIZE_BYTES: int = Field(
+        default=65536,
+        description="Write the buffered output of a running analysis to the database as soon as it reaches this size, without waiting for `PIPELINE_RUN_OUTPUT_LOG_FLUSH_INTERVAL_SEC`.",
+    )
+    PIPELINE_RUN_OUTPUT_LOG_LEVEL: Literal[
+        "CRITICAL", "ERROR", "WARNING", "INFO", "DEBUG"
+    ] = Field(
+        default="INFO",
+        description="Log records of metaKEGG and its dependencies with at least this level are written to the output log of a pipeline run. The levels of their loggers are not changed: loggers without an own level inherit the level of the root logger (by default WARNING), records below it are not emitted at all.",
+    )
+    PIPELINE_RUN_OUTPUT_LOG_HEAD_LINES: Optional[int] = Field(
+        default=500,
+        description="The output log of a pipeline run, as shown in the status of the pipeline run, keeps its first `PIPELINE_RUN_OUTPUT_LOG_HEAD_LINES` and its last `PIPELINE_RUN_OUTPUT_LOG_TAIL_LINES` lines. Lines in between are replaced by a 'lines truncated' marker. The full output log is included in the result zip file. Set to null to keep the whole output log in the status.",
+    )
+    PIPELINE_RUN_OUTPUT_LOG_TAIL_LINES: int = Field(
+        default=1500,
+        description="See `PIPELINE_RUN_OUTPUT_LOG_HEAD_LINES`.",
+    )
+    PIPELINE_RUN_OUTPUT_LOG_ARCHIVE_FILE_NAME: str = Field(
+        default="metakegg-output.log",
+        description="File name of the full output log in the result zip file of a pipeline run.",
+    )
+    PIPELINE_RUN_RESULT_ZIP_MODE: Literal["prebuilt", "streamed"] = Field(
+        default="prebuilt",
+        description="`prebuilt`: The worker zips the output files of a pipeline run after the analysis. `streamed`: The worker keeps the output files and only writes a manifest (names, sizes, CRC32 checksums). The result zip is generated on the fly, uncompressed and in constant memory, on every download. The worker is free for the next pipeline run sooner, but downloads are bigger. Results of streamed pipeline runs are not added to the result cache (`PIPELINE_RESULT_CACHE_ENABLED`).",
+    )
+    PIPELINE_RUN_RESULT_ZIP_COMPRESSION: Literal[
+        "stored", "deflated", "bzip2", "lzma"
+    ] = Field(
+        default="deflated",
+        description="Compression method for the files in a prebuilt result zip. `deflated` can be opened by every zip tool, `bzip2` and `lzma` compress better but slower and are not supported by all zip tools.",
+    )
+    PIPELINE_RUN_RESULT_ZIP_COMPRESSION_LEVEL: int = Field(
+        default=6,
+        description="Compression level for `deflated` (0-9) and `bzip2` (1-9). Ignored for `lzma`.",
+    )
+    PIPELINE_RUN_RESULT_ZIP_STORED_FILE_EXTENSIONS: List[str] = Field(
+        default=[".pdf", ".png", ".jpg", ".jpeg", ".gif", ".zip", ".gz", ".xlsx"],
+        description="Files with these extensions are already compressed and are stored in the result zip as they are. Files that do not get smaller by compression (judged by their first MiB) are stored as they are as well.",
+    )
+    PIPELINE_RUN_RESULT_ZIP_COMPRESSION_THREADS: int = Field(
+        default=4,
+        description="Amount of threads that compress a `deflated` file of a result zip in parallel, in chunks of 1 MiB. `bzip2` and `lzma` files are compressed by one thread.",
+    )
+
     CLIENT_CONTACT_EMAIL: Optional[str] = Field(
         default=None,
         description="A email address a contact shown on the main page of the webclient",
@@ -133,6 +317,38 @@ class Config(BaseSettings):
         default="/tmp/mekewe_cache",
         description="Storage directory for MetaKEGG Pipeline ressults.",
     )
+    KEGG_REST_CACHE_ENABLED: bool = Field(
+        default=False,
+        description="Cache the data analyses fetch from KEGG (pathway KGML, pathway entries, map images) on disk, shared by all pipeline runs. Fill it ahead with `python -m mekeweserver.kegg_rest_cache_warmup`. The cache is installed by patching the KEGG fetch functions of Biopython and metaKEGG for the whole analysis process, so every KEGG request of that process goes through the cache.",
+    )
+    KEGG_REST_CACHE_DIR: str = Field(
+        default="/tmp/mekewe_kegg_cache",
+        description="Storage directory of the KEGG REST cache. Must not be inside `PIPELINE_RUNS_CACHE_DIR`. Share it between worker nodes to share the cache.",
+    )
+    KEGG_REST_CACHE_TTL_SEC: int = Field(
+        default=7 * 24 * 60 * 60,
+        description="Cached KEGG data older than this is fetched again. If KEGG is not reachable, expired data is used.",
+    )
+    KEGG_REST_UPSTREAM_BASE_URL: Optional[str] = Field(
+        default=None,
+        description="Fetch KEGG data through this base URL instead of the KEGG servers, e.g. a mirror. The KEGG host and path are appended, e.g. `<base url>/rest.kegg.jp/get/hsa00010/kgml`. Mainly for testing.",
+    )
+    PIPELINE_UPLOAD_BLOB_DIR: str = Field(
+        default="/tmp/mekewe_upload_blobs",
+        description="Storage directory for uploaded input files. Every distinct file content is stored once and hard linked into the pipeline runs that use it. Must not be inside `PIPELINE_RUNS_CACHE_DIR` and should be on the same file system, otherwise the files are copied.",
+    )
+    PIPELINE_RESULT_CACHE_ENABLED: bool = Field(
+        default=False,
+        description="Reuse the result of an earlier pipeline run with identical input files (by content), analysis method and parameters. Such a pipeline run completes instantly without running the analysis again. The cache is shared by all users: a user that uploads the same files with the same parameters as another user gets a copy of the other user's result files. The output log of the other user's pipeline run is not included. Only enable it if this is acceptable for your instance.",
+    )
+    PIPELINE_RESULT_CACHE_DIR: str = Field(
+        default="/tmp/mekewe_result_cache",
+        description="Storage directory for cached pipeline run results. Must not be inside `PIPELINE_RUNS_CACHE_DIR`. Should be on the same file system as `PIPELINE_RUNS_CACHE_DIR`, so results can be hard linked instead of copied.",
+    )
+    PIPELINE_RESULT_CACHE_MAX_SIZE_BYTES: int = Field(
+        default=1024 * 1024 * 1024,
+        description="Max size of the pipeline result cache. If it is exceeded, the least recently used results are evicted.",
+    )
 
     def get_server_url(self) -> str:
         proto: Literal["https", "http"] = "http"
@@ -167,6 +383,17 @@ class Config(BaseSettings):
             self.CLIENT_URL = self.get_server_url()
         return self
 
+    @model_validator(mode="after")
+    def check_concurrent_analyses_run_in_subprocess(self: Self):
+        if (
+            self.PIPELINE_WORKER_CONCURRENT_ANALYSES > 1
+            and not self.PIPELINE_RUN_IN_SUBPROCESS
+        ):
+            raise ValueError(
+                "`PIPELINE_WORKER_CONCURRENT_ANALYSES` larger than 1 requires `PIPELINE_RUN_IN_SUBPROCESS`. metaKEGG changes the working directory of its process, concurrent analyses in one process would write into each others output directories."
+            )
+        return self
+
     ## Server
 
     SERVER_UVICORN_LOG_LEVEL: Optional[str] = Field(
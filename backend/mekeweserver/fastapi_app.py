@@ -1,19 +1,19 @@
 from contextlib import asynccontextmanager
+import re
 import getversion
 from fastapi import Depends
 from fastapi import FastAPI
 import getversion.plugin_setuptools_scm
-from multiprocessing import Process
 
 # from starlette.middleware.sessions import SessionMiddleware
 from fastapi.middleware.cors import CORSMiddleware
 from slowapi import Limiter, _rate_limit_exceeded_handler
-from slowapi.util import get_remote_address
 from slowapi.errors import RateLimitExceeded
 
 
 from fastapi import FastAPI, HTTPException, UploadFile, File, status
 from starlette.middleware.base import BaseHTTPMiddleware
+from starlette.concurrency import run_in_threadpool
 from starlette.requests import Request
 from starlette.responses import Response
 
@@ -23,6 +23,7 @@ import mekeweserver
 from mekeweserver.config import Config, get_config
 from mekeweserver.log import get_logger
 from mekeweserver.utils import bytes_humanreadable
+from mekeweserver.client_address import get_client_address
 
 log = get_logger()
 config: Config = get_config()
@@ -57,11 +58,42 @@ class FileSizeLimiterMiddleware(BaseHTTPMiddleware):
         return await call_next(request)
 
 
+class PipelineQueueAdmissionMiddleware(BaseHTTPMiddleware):
+    """Reject file uploads while the pipeline queue is saturated (see `config.PIPELINE_QUEUE_MAX_LENGTH`).
+    This happens before the body is read, so users do not upload megabytes only to be refused when starting the pipeline run.
+    """
+
+    UPLOAD_PATH_PATTERN = re.compile(r"^/api/pipeline/[^/]+/file/upload/")
+
+    async def dispatch(self, request: Request, call_next):
+        if request.method == "POST" and self.UPLOAD_PATH_PATTERN.match(
+            request.url.path
+        ):
+            from mekeweserver.db import get_redis_client
+            from mekeweserver.pipeline_status_clerk import MetaKeggPipelineStateManager
+
+            # redis-py blocks. Keep the event loop free for the other requests.
+            retry_after_sec = await run_in_threadpool(
+                MetaKeggPipelineStateManager(
+                    get_redis_client()
+                ).get_pipeline_run_admission_retry_after_sec
+            )
+            if retry_after_sec is not None:
+                return Response(
+                    "The pipeline queue is saturated. Please try again later (see 'Retry-After' header).",
+                    status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                    headers={"Retry-After": str(retry_after_sec)},
+                )
+        return await call_next(request)
+
+
 def _add_api_middleware(app: FastAPI):
 
     app.add_middleware(
         FileSizeLimiterMiddleware, config.MAX_FILE_SIZE_UPLOAD_LIMIT_BYTES
     )
+    # added after FileSizeLimiterMiddleware, so it runs before the body is read there.
+    app.add_middleware(PipelineQueueAdmissionMiddleware)
     app.add_middleware(
         CORSMiddleware,
         allow_origins=config.get_allowed_origins(),
@@ -75,7 +107,7 @@ def _add_api_middleware(app: FastAPI):
     # )
 
 
-def _add_app_routers(app: FastAPI, background_worker: Process):
+def _add_app_routers(app: FastAPI):
     from mekeweserver.fastapi_routes import (
         get_api_router,
         get_client_router,
@@ -83,19 +115,19 @@ def _add_app_routers(app: FastAPI, background_worker: Process):
         get_info_config_router,
     )
 
-    app.include_router(get_health_router(app, background_worker))
+    app.include_router(get_health_router(app))
     app.include_router(get_api_router(app))
     app.include_router(get_info_config_router(app))
     app.include_router(get_client_router(app))
 
 
 def _add_rate_limiter(app: FastAPI):
-    limiter = Limiter(key_func=get_remote_address, enabled=config.ENABLE_RATE_LIMITING)
+    limiter = Limiter(key_func=get_client_address, enabled=config.ENABLE_RATE_LIMITING)
     app.state.limiter = limiter
     app.add_exception_handler(RateLimitExceeded, _rate_limit_exceeded_handler)
 
 
-def get_fastapi_app(background_worker: Process) -> FastAPI:
+def get_fastapi_app() -> FastAPI:
     try:
         v = getversion.get_module_version(mekeweserver)[0]
     except:
@@ -109,5 +141,5 @@ def get_fastapi_app(background_worker: Process) -> FastAPI:
 
     _add_api_middleware(app)
     _add_rate_limiter(app)
-    _add_app_routers(app, background_worker)
+    _add_app_routers(app)
     return app
@@ -13,6 +13,7 @@ from pathlib import Path
 import os
 import pydantic
 import uuid
+import datetime
 from fastapi import (
     FastAPI,
     APIRouter,
@@ -27,13 +28,17 @@ from fastapi import (
     Body,
 )
 from slowapi import Limiter
-from fastapi.responses import FileResponse
+from redis.exceptions import RedisError
+from fastapi.responses import FileResponse, StreamingResponse
 from pydantic import BaseModel, Field
-from multiprocessing import Process
 
 
 from mekeweserver.db import get_redis_client
+from mekeweserver.client_address import get_client_address
 from mekeweserver.pipeline_status_clerk import MetaKeggPipelineStateManager
+from mekeweserver.pipeline_result_cache import MetaKeggPipelineResultCache
+from mekeweserver.kegg_rest_cache import MetaKeggKeggRestCache
+from mekeweserver.output_zip_stream import iter_output_zip
 
 from mekeweserver.utils import get_directory_size_bytes, bytes_humanreadable
 from metaKEGG import PipelineAsync
@@ -53,6 +58,9 @@ from mekeweserver.model import (
     MetaKeggPipelineInputParamsValues,
     MetaKeggPipelineInputParamsValuesAllOptional,
     MetaKeggPipelineStatistics,
+    MetaKeggPipelineResultCacheStats,
+    MetaKeggKeggRestCacheStats,
+    MetaKeggPipelineOutputManifest,
     get_param_docs,
     get_param_model,
     GlobalParamModel,
@@ -96,6 +104,10 @@ pipelinerun_failed_exception = HTTPException(
     status_code=status.HTTP_424_FAILED_DEPENDENCY,
     detail="Pipeline-run failed. Check endpoint '/pipeline/{pipeline_ticket_id}/status' for details",
 )
+pipeline_queue_saturated_exception = HTTPException(
+    status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+    detail="The pipeline queue is saturated. Please try again later (see 'Retry-After' header).",
+)
 pipeline_status_exceptions: List[HTTPException] = [
     pipelinerun_not_found_exception,
     pipelinerun_expired_exception,
@@ -116,6 +128,20 @@ def get_api_router(app: FastAPI) -> APIRouter:
     limiter: Limiter = app.state.limiter
     redis = get_redis_client()
 
+    def raise_if_pipeline_queue_saturated(
+        pipeline_manager: MetaKeggPipelineStateManager,
+    ):
+        retry_after_sec = pipeline_manager.get_pipeline_run_admission_retry_after_sec()
+        if retry_after_sec is not None:
+            log.info(
+                f"Pipeline queue is saturated. Reject request for {retry_after_sec} sec."
+            )
+            raise HTTPException(
+                status_code=pipeline_queue_saturated_exception.status_code,
+                detail=pipeline_queue_saturated_exception.detail,
+                headers={"Retry-After": str(retry_after_sec)},
+            )
+
     ##ENDPOINT: /analysis
     @mekewe_router.get(
         "/analysis",
@@ -197,7 +223,7 @@ def get_api_router(app: FastAPI) -> APIRouter:
         if pipeline_status.state in ["running", "queued"]:
             raise HTTPException(
                 status_code=status.HTTP_400_BAD_REQUEST,
-                detail="Pipeline is not in an updatable state. Wait for it to be finished.",
+                detail="Pipeline is not in an updatable state. Cancel it via '/pipeline/{pipeline_ticket_id}/cancel' or wait for it to be finished.",
             )
         pipeline_status_manager.wipe_pipeline_run(pipeline_ticket_id)
         pipeline_status_manager.delete_pipeline_status(pipeline_ticket_id)
@@ -244,9 +270,11 @@ def get_api_router(app: FastAPI) -> APIRouter:
         for key, val in pipeline_params.method_specific_params.items():
             pipeline_status.pipeline_params.method_specific_params[key] = val
 
-        # Save the new state to the db
-        MetaKeggPipelineStateManager(redis_client=redis).set_pipeline_run_definition(
-            pipeline_status,
+        # Save the new params to the db
+        MetaKeggPipelineStateManager(
+            redis_client=redis
+        ).update_pipeline_run_definition_fields(
+            pipeline_ticket_id, pipeline_params=pipeline_status.pipeline_params
         )
         return pipeline_status
 
@@ -255,6 +283,7 @@ def get_api_router(app: FastAPI) -> APIRouter:
         "/pipeline/{pipeline_ticket_id}/file/upload/{param_name}",
         response_model=MetaKeggPipelineDef,
         description="Add a file to an non started/queued pipeline-run definition",
+        responses=http_exception_to_resp_desc(pipeline_queue_saturated_exception),
         tags=["Pipeline"],
     )
     @limiter.limit(f"30/minute")
@@ -264,6 +293,7 @@ def get_api_router(app: FastAPI) -> APIRouter:
         param_name: str,
         file: UploadFile = File(...),
     ) -> MetaKeggPipelineDef:
+        # Admission control for uploads happens in `PipelineQueueAdmissionMiddleware`, before the upload body is read.
         pipeline_manager = MetaKeggPipelineStateManager(redis_client=redis)
         if config.MAX_CACHE_SIZE_BYTES:
             content_length = request.headers.get("Content-Length")
@@ -341,7 +371,8 @@ def get_api_router(app: FastAPI) -> APIRouter:
     @mekewe_router.post(
         "/pipeline/{pipeline_ticket_id}/run",
         response_model=MetaKeggPipelineDef,
-        responses=http_exception_to_resp_desc(pipelinerun_not_found_exception),
+        responses=http_exception_to_resp_desc(pipelinerun_not_found_exception)
+        | http_exception_to_resp_desc(pipeline_queue_saturated_exception),
         description="Qeueu the pipeline-run. If the queue is passed the pipeline will change from 'queued' into 'running' state.",
         tags=["Pipeline"],
     )
@@ -350,11 +381,38 @@ def get_api_router(app: FastAPI) -> APIRouter:
         request: Request,
         pipeline_ticket_id: uuid.UUID,
     ) -> MetaKeggPipelineDef:
-        return MetaKeggPipelineStateManager(
-            redis_client=redis
-        ).set_pipeline_run_as_queud(
+        pipeline_manager = MetaKeggPipelineStateManager(redis_client=redis)
+        raise_if_pipeline_queue_saturated(pipeline_manager)
+        return pipeline_manager.set_pipeline_run_as_queud(
+            pipeline_ticket_id, client_key=get_client_address(request)
+        )
+
+    ##ENDPOINT: /pipeline/{pipeline_ticket_id}/cancel
+    @mekewe_router.post(
+        "/pipeline/{pipeline_ticket_id}/cancel",
+        response_model=MetaKeggPipelineDef,
+        responses=http_exception_to_resp_desc(pipelinerun_not_found_exception),
+        description="""Cancel a `queued` or `running` pipeline-run. All input and output files of the pipeline-run will be deleted.  
+        A queued pipeline-run is removed from the queue immediately. A running pipeline-run will be aborted within a few seconds.  
+        A canceled pipeline-run ends in the state `failed`. Check endpoint '/pipeline/{pipeline_ticket_id}/status' to follow the cancellation.""",
+        tags=["Pipeline"],
+    )
+    @limiter.limit(f"1/second")
+    async def cancel_pipeline_run(
+        request: Request,
+        pipeline_ticket_id: uuid.UUID,
+    ) -> MetaKeggPipelineDef:
+        pipeline_status_manager = MetaKeggPipelineStateManager(redis_client=redis)
+        pipeline_status = pipeline_status_manager.get_pipeline_run_definition(
             pipeline_ticket_id,
+            raise_exception_if_not_exists=pipelinerun_not_found_exception,
         )
+        if pipeline_status.state not in ["running", "queued"]:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="Pipeline-run is not queued or running.",
+            )
+        return pipeline_status_manager.cancel_pipeline_run(pipeline_ticket_id)
 
     ##ENDPOINT: /pipeline/{pipeline_ticket_id}/status
     @mekewe_router.get(
@@ -368,6 +426,11 @@ def get_api_router(app: FastAPI) -> APIRouter:
     async def get_pipeline_run_status(
         request: Request,
         pipeline_ticket_id: uuid.UUID,
+        output_log_offset: int = Query(
+            default=0,
+            ge=0,
+            description="Only include output log lines after this line number. Pass the `output_log_lines_total` of the previous response to only fetch new lines.",
+        ),
     ):
         pipeline_status: MetaKeggPipelineDef = MetaKeggPipelineStateManager(
             redis_client=redis
@@ -376,6 +439,7 @@ def get_api_router(app: FastAPI) -> APIRouter:
             raise_exception_if_not_exists=HTTPException(
                 status_code=status.HTTP_404_NOT_FOUND
             ),
+            output_log_offset=output_log_offset,
         )
 
         """HOTPATCH FOR TESTING LINE-QUEUING IN UI
@@ -425,6 +489,22 @@ def get_api_router(app: FastAPI) -> APIRouter:
             raise pipelinerun_not_finished_exception
         elif status.state == "expired":
             raise pipelinerun_expired_exception
+        if (
+            not status.get_output_zip_file_path().exists()
+            and status.get_output_manifest_file_path().exists()
+        ):
+            # the worker did not build the result zip (see `config.PIPELINE_RUN_RESULT_ZIP_MODE`). Generate it on the fly.
+            manifest = MetaKeggPipelineOutputManifest.model_validate_json(
+                status.get_output_manifest_file_path().read_text()
+            )
+            return StreamingResponse(
+                iter_output_zip(status.get_output_files_dir(), manifest),
+                media_type="application/zip",
+                headers={
+                    "Content-Length": str(manifest.zip_size_bytes),
+                    "Content-Disposition": f'attachment; filename="{status.get_output_zip_file_path().name}"',
+                },
+            )
         return FileResponse(
             status.get_output_zip_file_path(),
             filename=status.get_output_zip_file_path().name,
@@ -451,7 +531,7 @@ def get_client_router(app: FastAPI) -> APIRouter:
     return mekeweclient_router
 
 
-def get_health_router(app: FastAPI, background_worker_process: Process) -> APIRouter:
+def get_health_router(app: FastAPI) -> APIRouter:
     mekeweclient_health_router: APIRouter = APIRouter()
     redis = get_redis_client()
     limiter: Limiter = app.state.limiter
@@ -468,12 +548,29 @@ def get_health_router(app: FastAPI, background_worker_process: Process) -> APIRo
     ) -> MetaKeggWebServerHealthState:
         overall_state = MetaKeggWebServerHealthState(healthy=True, dependencies=[])
 
-        background_worker_state = MetaKeggWebServerModuleHealthState(
-            name="worker", healthy=background_worker_process.is_alive()
-        )
-        if background_worker_state.healthy == False:
+        # The workers can run on other nodes. Their liveness is derived from the heartbeats they write to redis.
+        state_manager = MetaKeggPipelineStateManager(redis)
+        worker_heartbeats: Dict[str, datetime.datetime] = {}
+        try:
+            worker_heartbeats = state_manager.get_worker_heartbeats()
+        except RedisError as e:
+            log.error(e, exc_info=True)
+        if not any(
+            state_manager.is_worker_alive(last_heartbeat)
+            for last_heartbeat in worker_heartbeats.values()
+        ):
             overall_state.healthy = False
-        overall_state.dependencies.append(background_worker_state)
+            overall_state.dependencies.append(
+                MetaKeggWebServerModuleHealthState(name="worker", healthy=False)
+            )
+        for worker_id, last_heartbeat in sorted(worker_heartbeats.items()):
+            background_worker_state = MetaKeggWebServerModuleHealthState(
+                name=f"worker:{worker_id}",
+                healthy=state_manager.is_worker_alive(last_heartbeat),
+            )
+            if not background_worker_state.healthy:
+                overall_state.healthy = False
+            overall_state.dependencies.append(background_worker_state)
 
         cache_server_state = MetaKeggWebServerModuleHealthState(
             name="cache", healthy=False
@@ -481,7 +578,7 @@ def get_health_router(app: FastAPI, background_worker_process: Process) -> APIRo
         try:
             redis.ping()
             cache_server_state.healthy = True
-        except:
+        except RedisError:
             overall_state.healthy = False
         overall_state.dependencies.append(cache_server_state)
         return overall_state
@@ -554,4 +651,28 @@ def get_info_config_router(app: FastAPI) -> APIRouter:
             redis_client=redis
         ).calculate_pipeline_run_statistic_point(days_limit, days_offset)
 
+    @mekeweclient_info_router.get(
+        "/stats/result-cache",
+        response_model=MetaKeggPipelineResultCacheStats,
+        description="Get the size and the hit/miss counters of the pipeline result cache. Pipeline runs with identical input files, analysis method and parameters reuse the result of an earlier run.",
+        tags=["Config/Infos"],
+    )
+    @limiter.limit(f"1/second")
+    async def get_result_cache_statistics(
+        request: Request,
+    ) -> MetaKeggPipelineResultCacheStats:
+        return MetaKeggPipelineResultCache(redis_client=redis).get_stats()
+
+    @mekeweclient_info_router.get(
+        "/stats/kegg-cache",
+        response_model=MetaKeggKeggRestCacheStats,
+        description="Get the size and the hit rate of the cache for data that analyses fetch from KEGG.",
+        tags=["Config/Infos"],
+    )
+    @limiter.limit(f"1/second")
+    async def get_kegg_rest_cache_statistics(
+        request: Request,
+    ) -> MetaKeggKeggRestCacheStats:
+        return MetaKeggKeggRestCache(redis_client=redis).get_stats()
+
     return mekeweclient_info_router
@@ -0,0 +1,268 @@
+from typing import Dict, Optional, Tuple
+import hashlib
+import io
+import os
+import threading
+import time
+import uuid
+import urllib.error
+import urllib.request
+from urllib.parse import urlsplit
+from pathlib import Path
+import redis
+import requests
+
+from mekeweserver.model import MetaKeggKeggRestCacheStats
+from mekeweserver.log import get_logger
+from mekeweserver.config import Config, get_config
+
+config: Config = get_config()
+log = get_logger()
+
+
+class MetaKeggKeggRestCache:
+    """Shared on-disk cache for data fetched from KEGG (pathway KGML, pathway entries and map images) during analyses.
+
+    Entries are keyed by the KEGG URL and stored as `<cache_dir>/<sha256(url)[:2]>/<sha256(url)>`. The modification time of an entry is its fetch time.
+    Entries older than `ttl_sec` are fetched again. If KEGG is not reachable (or throttles us), an expired entry is served instead of failing the analysis.
+    Hits and misses are counted in Redis if a `redis_client` is given.
+    """
+
+    # hash with the counters "hits", "misses", "stale_hits" and "errors"
+    REDIS_NAME_COUNTERS = "kegg_rest_cache_counters"
+    # KEGG asks for max. 3 requests per second (same delay as in Bio.KEGG.REST). Only applies to requests that miss the cache.
+    UPSTREAM_REQUEST_DELAY_SEC = 1 / 3
+    UPSTREAM_REQUEST_TIMEOUT_SEC = 60
+
+    _upstream_request_lock = threading.Lock()
+    _last_upstream_request_at = 0.0
+
+    def __init__(
+        self,
+        redis_client: Optional[redis.Redis] = None,
+        cache_dir: Optional[str] = None,
+        ttl_sec: Optional[int] = None,
+        upstream_base_url: Optional[str] = None,
+    ):
+        self.redis_client = redis_client
+        # absolute, metaKEGG changes the working directory during an analysis
+        self.cache_dir = Path(
+            cache_dir if cache_dir is not None else config.KEGG_REST_CACHE_DIR
+        ).absolute()
+        self.ttl_sec = (
+            ttl_sec if ttl_sec is not None else config.KEGG_REST_CACHE_TTL_SEC
+        )
+        self.upstream_base_url = (
+            upstream_base_url
+            if upstream_base_url is not None
+            else config.KEGG_REST_UPSTREAM_BASE_URL
+        )
+
+    @staticmethod
+    def is_cacheable_url(url: str) -> bool:
+        hostname = urlsplit(url).hostname or ""
+        return hostname == "kegg.jp" or hostname.endswith(".kegg.jp")
+
+    @staticmethod
+    def _get_cache_key(url: str) -> str:
+        # metaKEGG requests the same resources via http and https
+        parts = urlsplit(url)
+        return hashlib.sha256(
+            f"{parts.netloc}{parts.path}?{parts.query}".encode("utf-8")
+        ).hexdigest()
+
+    def _get_entry_path(self, url: str) -> Path:
+        cache_key = self._get_cache_key(url)
+        return Path(self.cache_dir, cache_key[:2], cache_key)
+
+    def _get_upstream_url(self, url: str) -> str:
+        if self.upstream_base_url is None:
+            return url
+        parts = urlsplit(url)
+        return f"{self.upstream_base_url.rstrip('/')}/{parts.netloc}{parts.path}{'?' + parts.query if parts.query else ''}"
+
+    def _count(self, counter_name: str):
+        if self.redis_client is None:
+            return
+        try:
+            self.redis_client.hincrby(self.REDIS_NAME_COUNTERS, counter_name, 1)
+        except redis.RedisError as e:
+            # metrics must not break an analysis
+            log.warning(f"Could not count KEGG REST cache {counter_name}: {e}")
+
+    def _fetch_upstream(self, url: str) -> bytes:
+        with self._upstream_request_lock:
+            # Reserve the next free request slot. The wait happens outside of the lock, so other threads can reserve their slots meanwhile.
+            request_at = max(
+                time.monotonic(),
+                MetaKeggKeggRestCache._last_upstream_request_at
+                + self.UPSTREAM_REQUEST_DELAY_SEC,
+            )
+            MetaKeggKeggRestCache._last_upstream_request_at = request_at
+        wait_sec = request_at - time.monotonic()
+        if wait_sec > 0:
+            time.sleep(wait_sec)
+        with urllib.request.urlopen(
+            self._get_upstream_url(url), timeout=self.UPSTREAM_REQUEST_TIMEOUT_SEC
+        ) as response:
+            return response.read()
+
+    def _write_entry(self, entry_path: Path, content: bytes):
+        entry_path.parent.mkdir(parents=True, exist_ok=True)
+        # other analyses may read the entry at the same time. Never expose a half written file.
+        tmp_path = Path(entry_path.parent, f".{entry_path.name}.{uuid.uuid4().hex}.tmp")
+        tmp_path.write_bytes(content)
+        os.replace(tmp_path, entry_path)
+
+    def get(self, url: str, refresh: bool = False) -> bytes:
+        """Return the content at `url` from the cache, or fetch and cache it. Raises `urllib.error.URLError` if it can neither be fetched nor served from the cache."""
+        entry_path = self._get_entry_path(url)
+        entry_age_sec: Optional[float] = None
+        try:
+            entry_age_sec = time.time() - entry_path.stat().st_mtime
+        except FileNotFoundError:
+            pass
+        if not refresh and entry_age_sec is not None and entry_age_sec < self.ttl_sec:
+            try:
+                content = entry_path.read_bytes()
+                self._count("hits")
+                return content
+            except FileNotFoundError:
+                # removed meanwhile
+                entry_age_sec = None
+        self._count("misses")
+        try:
+            content = self._fetch_upstream(url)
+        except urllib.error.URLError as e:
+            self._count("errors")
+            if entry_age_sec is None:
+                raise
+            log.warning(f"Could not fetch '{url}' ({e}). Serve expired cache entry.")
+            self._count("stale_hits")
+            return entry_path.read_bytes()
+        self._write_entry(entry_path, content)
+        return content
+
+    def get_stats(self) -> MetaKeggKeggRestCacheStats:
+        entries = 0
+        size_bytes = 0
+        if self.cache_dir.exists():
+            for path_obj in self.cache_dir.glob("*/*"):
+                if path_obj.name.startswith("."):
+                    continue
+                entries += 1
+                size_bytes += path_obj.stat().st_size
+        counters: Dict[str, int] = {}
+        if self.redis_client is not None:
+            counters = {
+                k.decode("utf-8"): int(v)
+                for k, v in self.redis_client.hgetall(self.REDIS_NAME_COUNTERS).items()
+            }
+        hits = counters.get("hits", 0)
+        misses = counters.get("misses", 0)
+        return MetaKeggKeggRestCacheStats(
+            entries=entries,
+            size_bytes=size_bytes,
+            ttl_sec=self.ttl_sec,
+            hits=hits,
+            misses=misses,
+            stale_hits=counters.get("stale_hits", 0),
+            errors=counters.get("errors", 0),
+            hit_rate=hits / (hits + misses) if hits + misses else None,
+        )
+
+
+class _CachedHTTPResponse(io.BytesIO):
+    """Stands in for the `http.client.HTTPResponse` that `urllib.request.urlopen` returns."""
+
+    def __init__(self, content: bytes, url: str):
+        super().__init__(content)
+        self.url = url
+        self.status = 200
+
+    def geturl(self) -> str:
+        return self.url
+
+    def getcode(self) -> int:
+        return self.status
+
+
+class _CachedRequests:
+    """Stands in for the `requests` module in metaKEGG's helper functions. `get` of KEGG URLs goes through the cache, everything else to `requests`."""
+
+    def __init__(self, cache: MetaKeggKeggRestCache):
+        self._cache = cache
+
+    def get(self, url: str, *args, **kwargs) -> requests.Response:
+        if not MetaKeggKeggRestCache.is_cacheable_url(url):
+            return requests.get(url, *args, **kwargs)
+        response = requests.Response()
+        response.url = url
+        try:
+            response._content = self._cache.get(url)
+            response.status_code = 200
+        except urllib.error.HTTPError as e:
+            response._content = e.read()
+            response.status_code = e.code
+        return response
+
+    def __getattr__(self, name: str):
+        return getattr(requests, name)
+
+
+_installed_cache: Optional[MetaKeggKeggRestCache] = None
+_originals: Dict[Tuple[object, str], object] = {}
+
+
+def _patch(module: object, attr_name: str, replacement: object):
+    _originals.setdefault((module, attr_name), getattr(module, attr_name))
+    setattr(module, attr_name, replacement)
+
+
+def install_kegg_rest_cache(cache: MetaKeggKeggRestCache):
+    """Route the KEGG requests of metaKEGG and Biopython in this process through `cache`:
+    `Bio.KEGG.REST` (KGML and pathway entries), `Bio.Graphics.KGML_vis` (map images) and `requests` in metaKEGG's helper functions (map images).
+    Calling it again replaces the cache.
+    """
+    global _installed_cache
+    import Bio.KEGG.REST
+    import Bio.Graphics.KGML_vis
+    import metaKEGG.helpers.helpfunctions
+
+    _installed_cache = cache
+    original_urlopen = _originals.get(
+        (Bio.Graphics.KGML_vis, "urlopen"), Bio.Graphics.KGML_vis.urlopen
+    )
+
+    def cached_urlopen(url, *args, **kwargs):
+        if isinstance(url, str) and MetaKeggKeggRestCache.is_cacheable_url(url):
+            return _CachedHTTPResponse(_installed_cache.get(url), url)
+        return original_urlopen(url, *args, **kwargs)
+
+    def cached_kegg_rest_query(op, arg1, arg2=None, arg3=None):
+        # Same URLs as `Bio.KEGG.REST._q`. The request delay of the original only applies to cache misses (see `MetaKeggKeggRestCache._fetch_upstream`).
+        if arg2 and arg3:
+            args = f"{op}/{arg1}/{arg2}/{arg3}"
+        elif arg2:
+            args = f"{op}/{arg1}/{arg2}"
+        else:
+            args = f"{op}/{arg1}"
+        url = f"https://rest.kegg.jp/{args}"
+        response = _CachedHTTPResponse(_installed_cache.get(url), url)
+        if "image" == arg2:
+            return response
+        handle = io.TextIOWrapper(response, encoding="UTF-8")
+        handle.url = url
+        return handle
+
+    _patch(Bio.KEGG.REST, "_q", cached_kegg_rest_query)
+    _patch(Bio.Graphics.KGML_vis, "urlopen", cached_urlopen)
+    _patch(metaKEGG.helpers.helpfunctions, "requests", _CachedRequests(cache))
+
+
+def uninstall_kegg_rest_cache():
+    global _installed_cache
+    for (module, attr_name), original in _originals.items():
+        setattr(module, attr_name, original)
+    _originals.clear()
+    _installed_cache = None
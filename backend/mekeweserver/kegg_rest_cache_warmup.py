@@ -0,0 +1,96 @@
+from typing import Dict, List
+from pathlib import Path
+import argparse
+import io
+import sys, os
+import urllib.error
+
+# Add meta kegg server to global Python modules.
+# This way we address mekeweserver as a module for imports without the need of installing it first.
+# this is convenient for local development
+if __name__ == "__main__":
+    MODULE_DIR = Path(__file__).parent
+    MODULE_PARENT_DIR = MODULE_DIR.parent.absolute()
+    sys.path.insert(0, os.path.normpath(MODULE_PARENT_DIR))
+
+
+from mekeweserver.log import get_logger
+
+
+def get_pathway_urls(pathway_id: str, kgml: bytes) -> List[str]:
+    """URLs metaKEGG fetches for a pathway, besides its KGML."""
+    from Bio.KEGG.KGML import KGML_parser
+
+    urls = [
+        f"https://rest.kegg.jp/get/{pathway_id}",
+        f"https://rest.kegg.jp/get/{pathway_id}/image",
+    ]
+    # the map image that Bio.Graphics.KGML_vis draws on
+    image_url = KGML_parser.read(io.StringIO(kgml.decode("utf-8"))).image
+    if image_url:
+        urls.append(image_url)
+    return urls
+
+
+def warmup_kegg_rest_cache(
+    organisms: List[str], refresh: bool = False, env: Dict = None
+) -> int:
+    """Fetch the KEGG data of all pathways of `organisms` into the KEGG REST cache, so the first analyses do not have to wait for KEGG.
+    Start with `python -m mekeweserver.kegg_rest_cache_warmup hsa mmu`. Returns the number of pathways that could not be fetched.
+    """
+    if env:
+        os.environ = os.environ.copy() | env
+    from mekeweserver.kegg_rest_cache import MetaKeggKeggRestCache
+
+    log = get_logger()
+    # warm-up requests are not counted as hits/misses
+    cache = MetaKeggKeggRestCache()
+    failed_pathways_amount = 0
+    for organism in organisms:
+        pathway_list = cache.get(
+            f"https://rest.kegg.jp/list/pathway/{organism}", refresh=True
+        ).decode("utf-8")
+        pathway_ids = [
+            line.split("\t")[0].removeprefix("path:")
+            for line in pathway_list.splitlines()
+            if line.strip()
+        ]
+        log.info(
+            f"Warm up KEGG REST cache with {len(pathway_ids)} pathways of organism '{organism}'..."
+        )
+        for index, pathway_id in enumerate(pathway_ids):
+            try:
+                kgml = cache.get(
+                    f"https://rest.kegg.jp/get/{pathway_id}/kgml", refresh=refresh
+                )
+                for url in get_pathway_urls(pathway_id, kgml):
+                    cache.get(url, refresh=refresh)
+            except urllib.error.URLError as e:
+                # e.g. pathways without KGML (404)
+                log.warning(f"Could not warm up pathway '{pathway_id}': {e}")
+                failed_pathways_amount += 1
+            if (index + 1) % 25 == 0:
+                log.info(f"...{index + 1}/{len(pathway_ids)} pathways of '{organism}'")
+    log.info(
+        f"KEGG REST cache warm-up done. {failed_pathways_amount} pathways failed. {cache.get_stats().entries} entries in cache."
+    )
+    return failed_pathways_amount
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Fill the KEGG REST cache with the pathway data of the given organisms."
+    )
+    parser.add_argument(
+        "organisms",
+        nargs="*",
+        default=["hsa"],
+        help="KEGG organism codes. Default: hsa",
+    )
+    parser.add_argument(
+        "--refresh",
+        action="store_true",
+        help="Fetch all pathways again, also the ones that are cached and not expired yet.",
+    )
+    args = parser.parse_args()
+    warmup_kegg_rest_cache(args.organisms, refresh=args.refresh)
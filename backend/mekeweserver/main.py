@@ -106,18 +106,23 @@ def run_server(env: Dict = None):
     r.ping()
     log.info("...connection to Cache/DB Health successful.")
 
-    from mekeweserver.pipeline_worker.pipeline_worker import PipelineWorker
-
-    log.info("Start background MetaKegg Pipeline Processor worker...")
-    worker_process = PipelineWorker(env=env)
+    from mekeweserver.pipeline_worker.pipeline_worker_supervisor import (
+        PipelineWorkerSupervisor,
+    )
 
-    atexit.register(worker_process.stop_event.set)
-    worker_process.start()
+    worker_supervisor = PipelineWorkerSupervisor(env=env)
+    if worker_supervisor.worker_count == 0:
+        log.info(
+            "PIPELINE_WORKER_COUNT is 0. Pipeline runs must be processed by workers on other nodes (`python -m mekeweserver.worker`)."
+        )
+    # uvicorn handles SIGTERM/SIGINT. When it returns, the running pipeline runs get a grace period to finish.
+    atexit.register(worker_supervisor.drain)
+    worker_supervisor.start()
     Path(config.PIPELINE_RUNS_CACHE_DIR).mkdir(parents=True, exist_ok=True)
 
     from mekeweserver.fastapi_app import get_fastapi_app
 
-    app = get_fastapi_app(worker_process)
+    app = get_fastapi_app()
     uvicorn_log_config: Dict = LOGGING_CONFIG
     uvicorn_log_config["loggers"][APP_LOGGER_DEFAULT_NAME] = {
         "handlers": ["default"],
@@ -137,7 +142,7 @@ def run_server(env: Dict = None):
     try:
         event_loop.run_until_complete(uvicorn_server.serve())
     except:
-        worker_process.stop_event.set
+        worker_supervisor.stop()
         raise
 
 
@@ -420,6 +420,16 @@ class MetaKeggPipelineDef(BaseModel):
         description="Shows how many pipeline runs are ahead of a queued pipeline-run",
         examples=[4],
     )
+    estimated_start_at_utc: Optional[datetime.datetime] = Field(
+        default=None,
+        description="Estimated start time of a queued pipeline-run, based on the running times of past pipeline runs, the pipeline runs ahead in the queue and the number of active workers. For a running pipeline-run this is the actual start time.",
+        examples=[None],
+    )
+    estimated_finish_at_utc: Optional[datetime.datetime] = Field(
+        default=None,
+        description="Estimated finish time of a queued or running pipeline-run. Can be used to back off polling the status.",
+        examples=[None],
+    )
     error: Optional[str] = Field(
         default=None,
         description="If the state of a pipeline run is `failed`, the error message will be logged into this attribute",
@@ -431,7 +441,18 @@ class MetaKeggPipelineDef(BaseModel):
         examples=[None],
     )
     output_log: Optional[str] = Field(
-        default=None, description="Output prints of a MetaKegg Pipeline analysis run."
+        default=None,
+        description="Output prints of a MetaKegg Pipeline analysis run. If the status was requested with an `output_log_offset`, only the lines after this offset are included.",
+    )
+    output_log_lines_total: Optional[int] = Field(
+        default=None,
+        description="Total amount of lines in the output log. Can be passed as `output_log_offset` on the next status request to only fetch new lines.",
+        examples=[42],
+    )
+    output_log_lines_truncated: Optional[int] = Field(
+        default=None,
+        description="Amount of lines that are left out of `output_log` (marked by a 'lines truncated' line) to keep the status small. The full output log is included in the result zip file.",
+        examples=[0],
     )
     result_path: Optional[str] = Field(
         default=None,
@@ -444,12 +465,22 @@ class MetaKeggPipelineDef(BaseModel):
         description="Uploaded file per parameter", default_factory=dict
     )
     pipeline_output_zip_file_name: Optional[str] = Field(default=None)
+    result_from_cache: bool = Field(
+        default=False,
+        description="True if the result was taken from an earlier pipeline run with identical input files, analysis method and parameters, instead of running the analysis again.",
+        examples=[False],
+    )
     created_at_utc: datetime.datetime = Field(
         default_factory=lambda: datetime.datetime.now(tz=datetime.timezone.utc)
     )
     queued_at_utc: Optional[datetime.datetime] = Field(default=None)
     started_at_utc: Optional[datetime.datetime] = Field(default=None)
     finished_at_utc: Optional[datetime.datetime] = Field(default=None)
+    run_attempts: int = Field(
+        default=0,
+        description="How often a worker started to process this pipeline run. Will be larger than 1 if a worker crashed while processing it.",
+        examples=[1],
+    )
 
     def get_files_base_dir(self) -> Path:
         return Path(PurePath(config.PIPELINE_RUNS_CACHE_DIR, self.ticket.id.hex))
@@ -491,6 +522,14 @@ class MetaKeggPipelineDef(BaseModel):
     def get_output_files_dir(self) -> Path:
         return Path(PurePath(self.get_files_base_dir(), "output"))
 
+    def get_output_log_file_path(self) -> Path:
+        # the full output log. The output log in redis might be truncated.
+        return Path(PurePath(self.get_files_base_dir(), "output.log"))
+
+    def get_output_manifest_file_path(self) -> Path:
+        # only exists if the result zip is streamed (see `config.PIPELINE_RUN_RESULT_ZIP_MODE`)
+        return Path(PurePath(self.get_files_base_dir(), "output_manifest.json"))
+
     def get_output_zip_file_path(self) -> Path | None:
         # f"output-metakegg-{self.pipeline_analyses_method.name}_{datetime.datetime.now().strftime("%Y-%m-%dT%H:%M:%SZ")}.zip"
         if self.pipeline_output_zip_file_name is None:
@@ -506,6 +545,14 @@ class MetaKeggPipelineDef(BaseModel):
         return f"output-metakegg-{self.pipeline_analyses_method.name}_{datetime.datetime.now().strftime('%Y-%m-%d-%H-%M-%S')}.zip"
 
 
+class MetaKeggHousekeepingTaskRun(BaseModel):
+    task_name: str
+    housekeeper_id: str
+    started_at_utc: datetime.datetime
+    duration_sec: Optional[float] = None
+    error: Optional[str] = None
+
+
 class MetaKeggPipelineStatisticPoint(BaseModel):
 
     pipeline_waiting_time_sec: int
@@ -516,6 +563,49 @@ class MetaKeggPipelineStatisticPoint(BaseModel):
     input_files_amount: int
     input_files_size_bytes: int
     result_file_size_bytes: Optional[int]
+    # time from forking the analysis child process until the analysis started
+    analysis_startup_sec: Optional[float] = None
+    analysis_started_warm: Optional[bool] = None
+    result_from_cache: bool = False
+    result_archive_build_sec: Optional[float] = None
+    # size of the output files divided by the size of the result zip
+    result_archive_compression_ratio: Optional[float] = None
+
+
+class MetaKeggPipelineOutputManifestFile(BaseModel):
+    name: str
+    size_bytes: int
+    crc32: int
+    modified_at: datetime.datetime
+
+
+class MetaKeggPipelineOutputManifest(BaseModel):
+    files: List[MetaKeggPipelineOutputManifestFile] = []
+    zip_size_bytes: int
+
+
+class MetaKeggPipelineResultCacheStats(BaseModel):
+    entries: int = 0
+    size_bytes: int = 0
+    max_size_bytes: int
+    hits: int = 0
+    misses: int = 0
+    stores: int = 0
+    evictions: int = 0
+
+
+class MetaKeggKeggRestCacheStats(BaseModel):
+    entries: int = 0
+    size_bytes: int = 0
+    ttl_sec: int
+    hits: int = 0
+    misses: int = 0
+    stale_hits: int = Field(
+        default=0,
+        description="KEGG was not reachable and an expired cache entry was served.",
+    )
+    errors: int = 0
+    hit_rate: Optional[float] = None
 
 
 class MetaKeggPipelineStatistics(BaseModel):
@@ -531,3 +621,5 @@ class MetaKeggPipelineStatistics(BaseModel):
     average_files_input_amount: float = 0.0
     average_files_input_size_bytes: float = 0.0
     average_result_file_size_bytes: float = 0.0
+    average_analysis_startup_warm_sec: Optional[float] = None
+    average_analysis_startup_cold_sec: Optional[float] = None
@@ -0,0 +1,420 @@
+from typing import Callable, Deque, Iterator, List, Tuple
+import collections
+import datetime
+import struct
+import zipfile
+import zlib
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+
+from mekeweserver.model import (
+    MetaKeggPipelineOutputManifest,
+    MetaKeggPipelineOutputManifestFile,
+)
+
+# Minimal zip writer. `iter_output_zip` streams uncompressed ("stored") members. Because the sizes and CRC32 checksums of all members are known
+# from the manifest before the first byte is sent, every header can be written upfront and the size of the whole zip
+# file is known in advance. `write_output_zip` uses the same headers to write deflated members, compressed in parallel.
+# Zip64 is not supported, see `ZIP_MAX_SIZE_BYTES`.
+
+ZIP_MAX_SIZE_BYTES = 0xFFFFFFFF
+FILE_READ_CHUNK_SIZE_BYTES = 1024 * 1024
+
+_LOCAL_FILE_HEADER = struct.Struct("<IHHHHHIIIHH")
+_CENTRAL_DIRECTORY_FILE_HEADER = struct.Struct("<IHHHHHHIIIHHHHHII")
+_END_OF_CENTRAL_DIRECTORY = struct.Struct("<IHHHHIIH")
+_ZIP_VERSION = 20
+# high byte 3: made on Unix. Tells zip tools to read the external attributes as Unix mode, like `zipfile` does.
+_ZIP_VERSION_MADE_BY = (3 << 8) | _ZIP_VERSION
+# bit 11: file names are UTF-8
+_ZIP_FLAGS = 0x0800
+_ZIP_METHOD_STORED = 0
+_ZIP_METHOD_DEFLATED = 8
+# regular file, rw-r--r--
+_ZIP_EXTERNAL_ATTRIBUTES = 0o100644 << 16
+
+
+class OutputZipTooLargeError(Exception):
+    pass
+
+
+def build_output_manifest(files_dir: Path) -> MetaKeggPipelineOutputManifest:
+    """Read the files in `files_dir` (not recursive, like `MetakeggPipelineProcessor.pack_output`) and collect what is needed to stream them as zip.
+    Raises `OutputZipTooLargeError` if the zip would need Zip64.
+    """
+    manifest_files: List[MetaKeggPipelineOutputManifestFile] = []
+    for path_obj in sorted(files_dir.iterdir()):
+        if not path_obj.is_file():
+            continue
+        crc32 = 0
+        with open(path_obj, "rb") as file:
+            while chunk := file.read(FILE_READ_CHUNK_SIZE_BYTES):
+                crc32 = zlib.crc32(chunk, crc32)
+        stat = path_obj.stat()
+        manifest_files.append(
+            MetaKeggPipelineOutputManifestFile(
+                name=path_obj.name,
+                size_bytes=stat.st_size,
+                crc32=crc32,
+                modified_at=datetime.datetime.fromtimestamp(stat.st_mtime),
+            )
+        )
+    zip_size_bytes = get_output_zip_size_bytes(manifest_files)
+    if zip_size_bytes > ZIP_MAX_SIZE_BYTES:
+        raise OutputZipTooLargeError(
+            f"Output files in {files_dir} are too large to be streamed as zip ({zip_size_bytes} bytes)."
+        )
+    return MetaKeggPipelineOutputManifest(
+        files=manifest_files, zip_size_bytes=zip_size_bytes
+    )
+
+
+def get_output_zip_size_bytes(
+    manifest_files: List[MetaKeggPipelineOutputManifestFile],
+) -> int:
+    size_bytes = _END_OF_CENTRAL_DIRECTORY.size
+    for manifest_file in manifest_files:
+        name_size_bytes = len(manifest_file.name.encode("utf-8"))
+        size_bytes += _LOCAL_FILE_HEADER.size + name_size_bytes
+        size_bytes += manifest_file.size_bytes
+        size_bytes += _CENTRAL_DIRECTORY_FILE_HEADER.size + name_size_bytes
+    return size_bytes
+
+
+def _get_dos_date_time(modified_at: datetime.datetime) -> tuple[int, int]:
+    # zip can not represent dates before 1980
+    modified_at = max(modified_at, datetime.datetime(1980, 1, 1))
+    dos_time = (
+        (modified_at.hour << 11) | (modified_at.minute << 5) | (modified_at.second // 2)
+    )
+    dos_date = (
+        ((modified_at.year - 1980) << 9) | (modified_at.month << 5) | modified_at.day
+    )
+    return dos_date, dos_time
+
+
+def _pack_local_file_header(
+    name: bytes,
+    method: int,
+    modified_at: datetime.datetime,
+    crc32: int,
+    compress_size_bytes: int,
+    size_bytes: int,
+) -> bytes:
+    dos_date, dos_time = _get_dos_date_time(modified_at)
+    return (
+        _LOCAL_FILE_HEADER.pack(
+            0x04034B50,
+            _ZIP_VERSION,
+            _ZIP_FLAGS,
+            method,
+            dos_time,
+            dos_date,
+            crc32,
+            compress_size_bytes,
+            size_bytes,
+            len(name),
+            0,
+        )
+        + name
+    )
+
+
+def _pack_central_directory_file_header(
+    name: bytes,
+    method: int,
+    modified_at: datetime.datetime,
+    crc32: int,
+    compress_size_bytes: int,
+    size_bytes: int,
+    offset: int,
+) -> bytes:
+    dos_date, dos_time = _get_dos_date_time(modified_at)
+    return (
+        _CENTRAL_DIRECTORY_FILE_HEADER.pack(
+            0x02014B50,
+            _ZIP_VERSION_MADE_BY,
+            _ZIP_VERSION,
+            _ZIP_FLAGS,
+            method,
+            dos_time,
+            dos_date,
+            crc32,
+            compress_size_bytes,
+            size_bytes,
+            len(name),
+            0,
+            0,
+            0,
+            0,
+            _ZIP_EXTERNAL_ATTRIBUTES,
+            offset,
+        )
+        + name
+    )
+
+
+def _pack_end_of_central_directory(
+    members_count: int, central_directory_size_bytes: int, offset: int
+) -> bytes:
+    return _END_OF_CENTRAL_DIRECTORY.pack(
+        0x06054B50,
+        0,
+        0,
+        members_count,
+        members_count,
+        central_directory_size_bytes,
+        offset,
+        0,
+    )
+
+
+def iter_output_zip(
+    files_dir: Path, manifest: MetaKeggPipelineOutputManifest
+) -> Iterator[bytes]:
+    """Generate the zip file of the files in `manifest` chunk by chunk. The generated zip is exactly `manifest.zip_size_bytes` long."""
+    central_directory = bytearray()
+    offset = 0
+    for manifest_file in manifest.files:
+        name = manifest_file.name.encode("utf-8")
+        local_file_header = _pack_local_file_header(
+            name,
+            _ZIP_METHOD_STORED,
+            manifest_file.modified_at,
+            manifest_file.crc32,
+            manifest_file.size_bytes,
+            manifest_file.size_bytes,
+        )
+        central_directory += _pack_central_directory_file_header(
+            name,
+            _ZIP_METHOD_STORED,
+            manifest_file.modified_at,
+            manifest_file.crc32,
+            manifest_file.size_bytes,
+            manifest_file.size_bytes,
+            offset,
+        )
+        yield local_file_header
+        remaining_bytes = manifest_file.size_bytes
+        with open(Path(files_dir, manifest_file.name), "rb") as file:
+            while remaining_bytes > 0:
+                chunk = file.read(min(FILE_READ_CHUNK_SIZE_BYTES, remaining_bytes))
+                if not chunk:
+                    # the headers are already sent. We can not fix the zip anymore.
+                    raise IOError(
+                        f"Output file '{manifest_file.name}' is smaller than recorded in its manifest."
+                    )
+                remaining_bytes -= len(chunk)
+                yield chunk
+        offset += len(local_file_header) + manifest_file.size_bytes
+    yield bytes(central_directory) + _pack_end_of_central_directory(
+        len(manifest.files), len(central_directory), offset
+    )
+
+
+# see `config.PIPELINE_RUN_RESULT_ZIP_COMPRESSION`
+ZIP_COMPRESSION_METHODS = {
+    "stored": zipfile.ZIP_STORED,
+    "deflated": zipfile.ZIP_DEFLATED,
+    "bzip2": zipfile.ZIP_BZIP2,
+    "lzma": zipfile.ZIP_LZMA,
+}
+# The last bytes of a chunk are the dictionary for the next one (the deflate window size). Chunks compress nearly as well as one stream this way.
+_DEFLATE_DICTIONARY_SIZE_BYTES = 32 * 1024
+# A file is stored instead of compressed, if its first chunk does not get smaller than this share of its size.
+_MAX_COMPRESSED_SHARE = 0.95
+# Upper bound of the growth of compressible data by deflate, including the sync flush marker of every chunk.
+# Zips that might get larger than `ZIP_MAX_SIZE_BYTES` are written by `zipfile` (with Zip64) in one thread.
+_DEFLATE_MAX_GROWTH_SHARE = 0.01
+
+
+def _deflate_chunk(chunk: bytes, dictionary: bytes, compress_level: int, last: bool):
+    # raw deflate, without zlib header
+    compressor = zlib.compressobj(
+        compress_level, zlib.DEFLATED, -zlib.MAX_WBITS, zdict=dictionary
+    )
+    # A sync flush ends the chunk on a byte boundary, without marking the end of the deflate stream. So the chunks can be concatenated.
+    return compressor.compress(chunk) + compressor.flush(
+        zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH
+    )
+
+
+class _ParallelDeflateCompressor:
+    """Same interface as a zlib compressor (`compress`/`flush`), producing one raw deflate stream.
+    The data is split into chunks that are deflated in parallel by the threads of `executor` (zlib releases the GIL).
+    Compressed chunks are handed back in order as soon as they are ready. At most `max_pending_chunks` chunks are in memory.
+    """
+
+    def __init__(
+        self, executor: ThreadPoolExecutor, compress_level: int, max_pending_chunks: int
+    ):
+        self.executor = executor
+        self.compress_level = compress_level
+        self.max_pending_chunks = max_pending_chunks
+        self._pending_chunks: Deque[Future] = collections.deque()
+        # start of the next chunk
+        self._buffer = b""
+        self._dictionary = b""
+
+    def _submit_chunk(self, chunk: bytes, last: bool):
+        self._pending_chunks.append(
+            self.executor.submit(
+                _deflate_chunk, chunk, self._dictionary, self.compress_level, last
+            )
+        )
+        self._dictionary = chunk[-_DEFLATE_DICTIONARY_SIZE_BYTES:]
+
+    def compress(self, data: bytes) -> bytes:
+        self._buffer += data
+        while len(self._buffer) >= FILE_READ_CHUNK_SIZE_BYTES:
+            self._submit_chunk(self._buffer[:FILE_READ_CHUNK_SIZE_BYTES], last=False)
+            self._buffer = self._buffer[FILE_READ_CHUNK_SIZE_BYTES:]
+        compressed_chunks = []
+        while self._pending_chunks and (
+            self._pending_chunks[0].done()
+            or len(self._pending_chunks) > self.max_pending_chunks
+        ):
+            compressed_chunks.append(self._pending_chunks.popleft().result())
+        return b"".join(compressed_chunks)
+
+    def flush(self) -> bytes:
+        self._submit_chunk(self._buffer, last=True)
+        self._buffer = b""
+        compressed_chunks = [chunk.result() for chunk in self._pending_chunks]
+        self._pending_chunks.clear()
+        return b"".join(compressed_chunks)
+
+
+def _is_compressible(source_path: Path) -> bool:
+    with open(source_path, "rb") as source_file:
+        first_chunk = source_file.read(FILE_READ_CHUNK_SIZE_BYTES)
+    if not first_chunk:
+        return False
+    return len(zlib.compress(first_chunk, 1)) < len(first_chunk) * _MAX_COMPRESSED_SHARE
+
+
+def _write_zip(
+    target_zip_file_path: Path,
+    members: List[Tuple[Path, str, int]],
+    executor: ThreadPoolExecutor,
+    compress_level: int,
+    max_pending_chunks: int,
+):
+    """Write a zip of `stored` and `deflated` members (source path, name in the zip, compression method).
+    The local file header of a member is written before its data and updated with the checksum and sizes afterwards.
+    """
+    central_directory = bytearray()
+    with open(target_zip_file_path, "wb") as output_file:
+        for source_path, arcname, compress_type in members:
+            name = arcname.encode("utf-8")
+            method = (
+                _ZIP_METHOD_DEFLATED
+                if compress_type == zipfile.ZIP_DEFLATED
+                else _ZIP_METHOD_STORED
+            )
+            modified_at = datetime.datetime.fromtimestamp(source_path.stat().st_mtime)
+            offset = output_file.tell()
+            output_file.write(
+                _pack_local_file_header(name, method, modified_at, 0, 0, 0)
+            )
+            compressor = (
+                _ParallelDeflateCompressor(
+                    executor, compress_level, max_pending_chunks=max_pending_chunks
+                )
+                if method == _ZIP_METHOD_DEFLATED
+                else None
+            )
+            crc32 = 0
+            size_bytes = 0
+            compress_size_bytes = 0
+            with open(source_path, "rb") as source_file:
+                while chunk := source_file.read(FILE_READ_CHUNK_SIZE_BYTES):
+                    crc32 = zlib.crc32(chunk, crc32)
+                    size_bytes += len(chunk)
+                    data = compressor.compress(chunk) if compressor else chunk
+                    output_file.write(data)
+                    compress_size_bytes += len(data)
+            if compressor:
+                data = compressor.flush()
+                output_file.write(data)
+                compress_size_bytes += len(data)
+            end_offset = output_file.tell()
+            output_file.seek(offset)
+            output_file.write(
+                _pack_local_file_header(
+                    name, method, modified_at, crc32, compress_size_bytes, size_bytes
+                )
+            )
+            output_file.seek(end_offset)
+            central_directory += _pack_central_directory_file_header(
+                name,
+                method,
+                modified_at,
+                crc32,
+                compress_size_bytes,
+                size_bytes,
+                offset,
+            )
+        output_file.write(
+            bytes(central_directory)
+            + _pack_end_of_central_directory(
+                len(members), len(central_directory), output_file.tell()
+            )
+        )
+
+
+def write_output_zip(
+    target_zip_file_path: Path,
+    members: List[Tuple[Path, str]],
+    get_compress_type: Callable[[Path], int],
+    compress_level: int,
+    max_workers: int,
+) -> Tuple[int, int]:
+    """Zip the files of `members` (source path, name in the zip) in the given order. `get_compress_type` decides the compression method (`zipfile.ZIP_*`) per file.
+    Files that do not get smaller by compression (e.g. already compressed data) are stored.
+    `deflated` members are compressed chunk by chunk by `max_workers` threads in parallel and written straight into the zip.
+    Zips with `bzip2` or `lzma` members and zips that might need Zip64 are written by `zipfile`, which compresses in one thread.
+    Returns the total size of the files and the size of the zip file in bytes.
+    """
+    files_size_bytes = 0
+    typed_members: List[Tuple[Path, str, int]] = []
+    for source_path, arcname in members:
+        compress_type = get_compress_type(source_path)
+        if compress_type != zipfile.ZIP_STORED and not _is_compressible(source_path):
+            compress_type = zipfile.ZIP_STORED
+        files_size_bytes += source_path.stat().st_size
+        typed_members.append((source_path, arcname, compress_type))
+    max_zip_size_bytes = (
+        files_size_bytes * (1 + _DEFLATE_MAX_GROWTH_SHARE)
+        + sum(
+            _LOCAL_FILE_HEADER.size
+            + _CENTRAL_DIRECTORY_FILE_HEADER.size
+            + 2 * len(arcname.encode("utf-8"))
+            for _, arcname in members
+        )
+        + _END_OF_CENTRAL_DIRECTORY.size
+    )
+    if max_zip_size_bytes <= ZIP_MAX_SIZE_BYTES and all(
+        compress_type in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED)
+        for _, _, compress_type in typed_members
+    ):
+        with ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="OutputZipCompressor"
+        ) as executor:
+            _write_zip(
+                target_zip_file_path,
+                typed_members,
+                executor,
+                compress_level,
+                max_pending_chunks=2 * max_workers,
+            )
+    else:
+        with zipfile.ZipFile(target_zip_file_path, "w") as output_zip:
+            for source_path, arcname, compress_type in typed_members:
+                output_zip.write(
+                    source_path,
+                    arcname=arcname,
+                    compress_type=compress_type,
+                    compresslevel=compress_level,
+                )
+    return files_size_bytes, target_zip_file_path.stat().st_size
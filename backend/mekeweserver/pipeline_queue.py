@@ -0,0 +1,289 @@
+from typing import Callable, List, Optional
+import uuid
+import redis
+
+from mekeweserver.log import get_logger
+from mekeweserver.config import Config, get_config
+
+config: Config = get_config()
+log = get_logger()
+
+
+class MetaKeggPipelineQueue:
+    """Queue of pipeline-run tickets with fair scheduling across clients.
+
+    Tickets are scheduled with start-time fair queuing. Every ticket gets a virtual start tag of
+    `max(virtual time, last tag of its client) + 1 / client weight` and the ticket with the smallest tag is picked next.
+    The virtual time is the tag of the last picked ticket. A client that submits a large batch gets its tickets spread out on the virtual time axis,
+    tickets of other clients are interleaved in between instead of waiting for the whole batch.
+    On top there are optional priority classes: Tickets of a higher priority class are always picked first.
+    With `config.PIPELINE_QUEUE_SCHEDULING == "fifo"` all tickets share one client key, which results in a plain FIFO queue (per priority class).
+    """
+
+    # one sorted set per priority class ("pipeline_queue:<priority>"). The score is the virtual start tag of the ticket.
+    REDIS_NAME_QUEUE_PREFIX = "pipeline_queue"
+    # set of all priority classes that were ever used
+    REDIS_NAME_PRIORITIES = "pipeline_queue_priorities"
+    # hash ticket -> priority class of the queued tickets. Needed to remove a ticket.
+    REDIS_NAME_TICKET_PRIORITIES = "pipeline_queue_ticket_priorities"
+    # hash ticket -> priority class of the tickets taken from the queue, until they are finished. Needed to requeue an interrupted ticket into its priority class.
+    REDIS_NAME_DEQUEUED_TICKET_PRIORITIES = "pipeline_queue_dequeued_ticket_priorities"
+    # hash priority class -> virtual time
+    REDIS_NAME_VIRTUAL_TIMES = "pipeline_queue_virtual_times"
+    # last virtual start tag per client ("pipeline_queue_client_tag:<priority>:<client_key>"). Expires, as old tags are lower than the virtual time anyway.
+    REDIS_NAME_CLIENT_TAG_PREFIX = "pipeline_queue_client_tag"
+    CLIENT_TAG_TTL_SEC = 86400
+    # Wake-up signal for idle workers, who block on this list (BRPOP). It holds at most one token ("the queue might not be empty"):
+    # every enqueue sets the token and every successful dequeue sets it again if tickets are left ("baton passing").
+    # So one woken worker wakes the next one as long as there are tickets and no ticket waits for the dequeue timeout, no matter how many
+    # were enqueued at once. A leftover token (the queue was emptied by a dequeue that did not wait) wakes one worker once for nothing.
+    # The tickets can not be popped with BZPOPMIN directly, as a dequeue has to move the ticket into the processing list of the worker
+    # and advance the virtual time in the same transaction.
+    REDIS_NAME_SIGNAL = "pipeline_queue_signal"
+    # Former plain FIFO list (positions were looked up with LPOS). Migrated by `migrate_legacy_queue`.
+    LEGACY_REDIS_NAME_QUEUE = "pipeline_queue"
+
+    def __init__(self, redis_client: redis.Redis):
+        self.redis_client = redis_client
+
+    def _get_queue_name(self, priority: int) -> str:
+        return f"{self.REDIS_NAME_QUEUE_PREFIX}:{priority}"
+
+    def _get_client_tag_name(self, priority: int, client_key: str) -> str:
+        return f"{self.REDIS_NAME_CLIENT_TAG_PREFIX}:{priority}:{client_key}"
+
+    def _get_priorities(self) -> List[int]:
+        """All priority classes in use, highest first."""
+        return sorted(
+            (
+                int(raw)
+                for raw in self.redis_client.smembers(self.REDIS_NAME_PRIORITIES)
+            ),
+            reverse=True,
+        )
+
+    def enqueue(
+        self,
+        ticket_id: uuid.UUID,
+        client_key: str,
+        stage_with: Optional[Callable[[redis.client.Pipeline], None]] = None,
+    ):
+        """Put a ticket into the queue. `stage_with` can stage more commands into the same transaction (e.g. the state change of the pipeline run)."""
+        priority = config.PIPELINE_QUEUE_CLIENT_PRIORITIES.get(client_key, 0)
+        weight = config.PIPELINE_QUEUE_CLIENT_WEIGHTS.get(client_key, 1)
+        if config.PIPELINE_QUEUE_SCHEDULING == "fifo":
+            client_key = ""
+        client_tag_name = self._get_client_tag_name(priority, client_key)
+        with self.redis_client.pipeline(transaction=True) as redis_pipe:
+            while True:
+                try:
+                    # optimistic locking: if another enqueue of the same client or a dequeue changes the tags meanwhile, the transaction fails and we try again.
+                    redis_pipe.watch(self.REDIS_NAME_VIRTUAL_TIMES, client_tag_name)
+                    raw_virtual_time = redis_pipe.hget(
+                        self.REDIS_NAME_VIRTUAL_TIMES, priority
+                    )
+                    raw_client_tag = redis_pipe.get(client_tag_name)
+                    tag = (
+                        max(float(raw_virtual_time or 0), float(raw_client_tag or 0))
+                        + 1 / weight
+                    )
+                    redis_pipe.multi()
+                    if stage_with is not None:
+                        stage_with(redis_pipe)
+                    redis_pipe.zadd(
+                        self._get_queue_name(priority), {ticket_id.hex: tag}
+                    )
+                    redis_pipe.hset(
+                        self.REDIS_NAME_TICKET_PRIORITIES, ticket_id.hex, priority
+                    )
+                    redis_pipe.sadd(self.REDIS_NAME_PRIORITIES, priority)
+                    redis_pipe.set(client_tag_name, tag, ex=self.CLIENT_TAG_TTL_SEC)
+                    self._stage_signal(redis_pipe)
+                    redis_pipe.execute()
+                    return
+                except redis.WatchError:
+                    continue
+
+    def _stage_signal(self, redis_pipe: redis.client.Pipeline):
+        redis_pipe.lpush(self.REDIS_NAME_SIGNAL, 1)
+        redis_pipe.ltrim(self.REDIS_NAME_SIGNAL, 0, 0)
+
+    def _signal_if_not_empty(self):
+        if self.get_length() > 0:
+            redis_pipe = self.redis_client.pipeline(transaction=True)
+            self._stage_signal(redis_pipe)
+            redis_pipe.execute()
+
+    def enqueue_at_head(self, ticket_id: uuid.UUID):
+        """Put a ticket in front of all other tickets of its priority class (e.g. an interrupted pipeline run)."""
+        redis_pipe = self.redis_client.pipeline(transaction=False)
+        redis_pipe.hget(self.REDIS_NAME_DEQUEUED_TICKET_PRIORITIES, ticket_id.hex)
+        redis_pipe.hget(self.REDIS_NAME_TICKET_PRIORITIES, ticket_id.hex)
+        raw_dequeued_priority, raw_priority = redis_pipe.execute()
+        raw_priority = (
+            raw_dequeued_priority if raw_dequeued_priority is not None else raw_priority
+        )
+        priority = int(raw_priority) if raw_priority is not None else 0
+        queue_name = self._get_queue_name(priority)
+        with self.redis_client.pipeline(transaction=True) as redis_pipe:
+            while True:
+                try:
+                    # optimistic locking: if an enqueue or dequeue changes the head or the virtual time meanwhile, the transaction fails and we try again.
+                    redis_pipe.watch(queue_name, self.REDIS_NAME_VIRTUAL_TIMES)
+                    head = redis_pipe.zrange(queue_name, 0, 0, withscores=True)
+                    raw_virtual_time = redis_pipe.hget(
+                        self.REDIS_NAME_VIRTUAL_TIMES, priority
+                    )
+                    tag = (
+                        min(
+                            [float(raw_virtual_time or 0)]
+                            + [score for _, score in head]
+                        )
+                        - 1
+                    )
+                    redis_pipe.multi()
+                    redis_pipe.zadd(queue_name, {ticket_id.hex: tag})
+                    redis_pipe.hset(
+                        self.REDIS_NAME_TICKET_PRIORITIES, ticket_id.hex, priority
+                    )
+                    redis_pipe.hdel(
+                        self.REDIS_NAME_DEQUEUED_TICKET_PRIORITIES, ticket_id.hex
+                    )
+                    redis_pipe.sadd(self.REDIS_NAME_PRIORITIES, priority)
+                    self._stage_signal(redis_pipe)
+                    redis_pipe.execute()
+                    return
+                except redis.WatchError:
+                    continue
+
+    def dequeue(self, processing_list_name: Optional[str] = None) -> uuid.UUID | None:
+        """Take the next ticket from the queue. If `processing_list_name` is provided, the ticket is moved into this list in the same transaction."""
+        for priority in self._get_priorities():
+            queue_name = self._get_queue_name(priority)
+            while True:
+                with self.redis_client.pipeline(transaction=True) as redis_pipe:
+                    try:
+                        # optimistic locking: if another worker takes the same ticket meanwhile, the transaction fails and we try again.
+                        redis_pipe.watch(queue_name)
+                        head = redis_pipe.zrange(queue_name, 0, 0, withscores=True)
+                        if not head:
+                            break
+                        raw_ticket_id, tag = head[0]
+                        raw_virtual_time = redis_pipe.hget(
+                            self.REDIS_NAME_VIRTUAL_TIMES, priority
+                        )
+                        redis_pipe.multi()
+                        redis_pipe.zrem(queue_name, raw_ticket_id)
+                        redis_pipe.hdel(
+                            self.REDIS_NAME_TICKET_PRIORITIES, raw_ticket_id
+                        )
+                        redis_pipe.hset(
+                            self.REDIS_NAME_DEQUEUED_TICKET_PRIORITIES,
+                            raw_ticket_id,
+                            priority,
+                        )
+                        if processing_list_name is not None:
+                            redis_pipe.lpush(processing_list_name, raw_ticket_id)
+                        redis_pipe.hset(
+                            self.REDIS_NAME_VIRTUAL_TIMES,
+                            priority,
+                            max(tag, float(raw_virtual_time or 0)),
+                        )
+                        redis_pipe.execute()
+                        # pass the signal on to the next idle worker
+                        self._signal_if_not_empty()
+                        return uuid.UUID(raw_ticket_id.decode("utf-8"))
+                    except redis.WatchError:
+                        continue
+        return None
+
+    def wait_for_ticket(self, timeout_sec: float):
+        """Block until a ticket was enqueued or the timeout passed. There is no guarantee that the ticket is still available afterwards."""
+        self.redis_client.brpop(self.REDIS_NAME_SIGNAL, timeout=timeout_sec)
+
+    def remove(self, ticket_id: uuid.UUID) -> bool:
+        """Remove a ticket from the queue. Returns False if the ticket was not in the queue (anymore)."""
+        raw_priority = self.redis_client.hget(
+            self.REDIS_NAME_TICKET_PRIORITIES, ticket_id.hex
+        )
+        if raw_priority is None:
+            return False
+        redis_pipe = self.redis_client.pipeline(transaction=True)
+        redis_pipe.zrem(self._get_queue_name(int(raw_priority)), ticket_id.hex)
+        redis_pipe.hdel(self.REDIS_NAME_TICKET_PRIORITIES, ticket_id.hex)
+        removed_count, _ = redis_pipe.execute()
+        return bool(removed_count)
+
+    def forget_dequeued_ticket(self, ticket_id: uuid.UUID):
+        """The ticket was finished and will not be requeued with `enqueue_at_head` anymore."""
+        self.redis_client.hdel(
+            self.REDIS_NAME_DEQUEUED_TICKET_PRIORITIES, ticket_id.hex
+        )
+
+    def stage_removal(
+        self, redis_pipe: redis.client.Pipeline, ticket_ids: List[uuid.UUID]
+    ):
+        for priority in self._get_priorities():
+            redis_pipe.zrem(
+                self._get_queue_name(priority), *[t.hex for t in ticket_ids]
+            )
+        redis_pipe.hdel(self.REDIS_NAME_TICKET_PRIORITIES, *[t.hex for t in ticket_ids])
+        redis_pipe.hdel(
+            self.REDIS_NAME_DEQUEUED_TICKET_PRIORITIES, *[t.hex for t in ticket_ids]
+        )
+
+    def get_place_in_queue(self, ticket_id: uuid.UUID) -> int | None:
+        """1-based position of the ticket across all priority classes. None if the ticket is not queued.
+        The rank of the ticket in its sorted set plus the sizes of the higher priority classes: O(log n) per priority class and one round trip,
+        instead of scanning the queue. Dequeues remove tickets from the sorted sets in a transaction, so the position is always up to date.
+        """
+        priorities = self._get_priorities()
+        redis_pipe = self.redis_client.pipeline(transaction=False)
+        for priority in priorities:
+            redis_pipe.zrank(self._get_queue_name(priority), ticket_id.hex)
+            redis_pipe.zcard(self._get_queue_name(priority))
+        results = redis_pipe.execute()
+        tickets_ahead = 0
+        for index in range(len(priorities)):
+            rank, size = results[index * 2], results[index * 2 + 1]
+            if rank is not None:
+                return tickets_ahead + rank + 1
+            tickets_ahead += size
+        return None
+
+    def get_ticket_ids(
+        self, until_ticket_id: Optional[uuid.UUID] = None
+    ) -> List[uuid.UUID]:
+        """All queued tickets in the order they will be picked. If `until_ticket_id` is provided, only the tickets ahead of it are returned."""
+        ticket_ids: List[uuid.UUID] = []
+        for priority in self._get_priorities():
+            queue_name = self._get_queue_name(priority)
+            rank = None
+            if until_ticket_id is not None:
+                rank = self.redis_client.zrank(queue_name, until_ticket_id.hex)
+            raw_ticket_ids = (
+                self.redis_client.zrange(queue_name, 0, -1)
+                if rank is None
+                else self.redis_client.zrange(queue_name, 0, rank)[:-1]
+            )
+            ticket_ids.extend(uuid.UUID(raw.decode("utf-8")) for raw in raw_ticket_ids)
+            if rank is not None:
+                break
+        return ticket_ids
+
+    def get_length(self) -> int:
+        redis_pipe = self.redis_client.pipeline(transaction=False)
+        for priority in self._get_priorities():
+            redis_pipe.zcard(self._get_queue_name(priority))
+        return sum(redis_pipe.execute())
+
+    def migrate_legacy_queue(self):
+        """Move tickets from the former plain FIFO list into the fair queue, keeping their order."""
+        if self.redis_client.type(self.LEGACY_REDIS_NAME_QUEUE) == b"list":
+            log.info("Migrate pipeline queue to fair queue...")
+            while True:
+                # the legacy list was consumed from the right side
+                raw_ticket_id = self.redis_client.rpop(self.LEGACY_REDIS_NAME_QUEUE)
+                if raw_ticket_id is None:
+                    break
+                self.enqueue(uuid.UUID(raw_ticket_id.decode("utf-8")), client_key="")
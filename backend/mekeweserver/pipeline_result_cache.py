@@ -0,0 +1,168 @@
+from typing import Any, Dict, List, Optional
+import hashlib
+import json
+import os
+import shutil
+import time
+import uuid
+from pathlib import Path
+import redis
+
+from mekeweserver.model import MetaKeggPipelineResultCacheStats
+from mekeweserver.log import get_logger
+from mekeweserver.config import Config, get_config
+
+config: Config = get_config()
+log = get_logger()
+
+
+class MetaKeggPipelineResultCache:
+    """Content-addressed cache of pipeline-run output zips.
+
+    The key is a hash of everything that determines the result of an analysis: the metaKEGG version, the analysis method,
+    the resolved global and method params and the content (not the name) of every input file.
+    The zip files live in `config.PIPELINE_RESULT_CACHE_DIR` as `<key>.zip`, independent of the pipeline runs that created them.
+    So they are still available after a pipeline run expired. The zips never contain the output log of the pipeline run that created them,
+    a cache hit must not hand it out to other users. If the cache exceeds `config.PIPELINE_RESULT_CACHE_MAX_SIZE_BYTES`,
+    the least recently used entries are evicted.
+    """
+
+    # sorted set cache key -> unix timestamp of the last use
+    REDIS_NAME_LRU_INDEX = "pipeline_result_cache_lru"
+    # hash cache key -> size of the zip in bytes
+    REDIS_NAME_SIZES = "pipeline_result_cache_sizes"
+    # hash with the counters "hits", "misses", "stores", "evictions" and "size_bytes"
+    REDIS_NAME_COUNTERS = "pipeline_result_cache_counters"
+    FILE_READ_CHUNK_SIZE_BYTES = 1024 * 1024
+
+    def __init__(self, redis_client: redis.Redis):
+        self.redis_client = redis_client
+        self.cache_dir = Path(config.PIPELINE_RESULT_CACHE_DIR)
+
+    def _get_zip_path(self, cache_key: str) -> Path:
+        return Path(self.cache_dir, f"{cache_key}.zip")
+
+    @classmethod
+    def _get_file_digest(cls, path: Path) -> str:
+        file_hash = hashlib.sha256()
+        with open(path, "rb") as file:
+            while chunk := file.read(cls.FILE_READ_CHUNK_SIZE_BYTES):
+                file_hash.update(chunk)
+        return file_hash.hexdigest()
+
+    @classmethod
+    def _normalize_param_value(cls, value: Any, file_digests: Dict[str, str]) -> Any:
+        # input files are identified by their content. The upload location and file name do not matter.
+        if isinstance(value, (str, Path)) and str(value) in file_digests:
+            return f"sha256:{file_digests[str(value)]}"
+        if isinstance(value, (list, tuple)):
+            return [cls._normalize_param_value(v, file_digests) for v in value]
+        if isinstance(value, dict):
+            return {
+                k: cls._normalize_param_value(v, file_digests) for k, v in value.items()
+            }
+        return value
+
+    @classmethod
+    def compute_key(
+        cls,
+        method_name: str,
+        global_params: Dict[str, Any],
+        method_params: Dict[str, Any],
+        input_file_paths: List[Path],
+        metakegg_version: str,
+    ) -> str:
+        """Hash the normalized inputs of a pipeline run. `input_file_paths` are the uploaded files the params refer to."""
+        file_digests = {
+            str(path): cls._get_file_digest(path) for path in input_file_paths
+        }
+        normalized_inputs = {
+            "metakegg_version": metakegg_version,
+            "method": method_name,
+            "global_params": cls._normalize_param_value(global_params, file_digests),
+            "method_params": cls._normalize_param_value(method_params, file_digests),
+        }
+        return hashlib.sha256(
+            json.dumps(normalized_inputs, sort_keys=True, default=str).encode("utf-8")
+        ).hexdigest()
+
+    def get(self, cache_key: str) -> Optional[Path]:
+        """Returns the path of the cached output zip or None on a cache miss."""
+        zip_path = self._get_zip_path(cache_key)
+        if (
+            self.redis_client.zscore(self.REDIS_NAME_LRU_INDEX, cache_key) is not None
+            and zip_path.exists()
+        ):
+            redis_pipe = self.redis_client.pipeline(transaction=False)
+            redis_pipe.zadd(
+                self.REDIS_NAME_LRU_INDEX, {cache_key: time.time()}, xx=True
+            )
+            redis_pipe.hincrby(self.REDIS_NAME_COUNTERS, "hits", 1)
+            redis_pipe.execute()
+            return zip_path
+        self.redis_client.hincrby(self.REDIS_NAME_COUNTERS, "misses", 1)
+        return None
+
+    def put(self, cache_key: str, output_zip_path: Path):
+        """Add the output zip of a pipeline run to the cache and evict old entries if the cache is too big.
+        The zip is copied, not linked. The pipeline run adds its output log to its own zip afterwards.
+        """
+        size_bytes = output_zip_path.stat().st_size
+        if size_bytes > config.PIPELINE_RESULT_CACHE_MAX_SIZE_BYTES:
+            return
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        # write under a temporary name first. Other workers must never see a half written zip.
+        tmp_zip_path = Path(self.cache_dir, f".{cache_key}.{uuid.uuid4().hex}.tmp")
+        shutil.copyfile(output_zip_path, tmp_zip_path)
+        self._add_entry(cache_key, tmp_zip_path, size_bytes)
+
+    def _add_entry(self, cache_key: str, tmp_zip_path: Path, size_bytes: int):
+        os.replace(tmp_zip_path, self._get_zip_path(cache_key))
+        redis_pipe = self.redis_client.pipeline(transaction=True)
+        redis_pipe.zadd(self.REDIS_NAME_LRU_INDEX, {cache_key: time.time()})
+        redis_pipe.hsetnx(self.REDIS_NAME_SIZES, cache_key, size_bytes)
+        _, is_new_entry = redis_pipe.execute()
+        if is_new_entry:
+            redis_pipe = self.redis_client.pipeline(transaction=True)
+            redis_pipe.hincrby(self.REDIS_NAME_COUNTERS, "stores", 1)
+            redis_pipe.hincrby(self.REDIS_NAME_COUNTERS, "size_bytes", size_bytes)
+            redis_pipe.execute()
+        self._evict()
+
+    def _evict(self):
+        while (
+            int(self.redis_client.hget(self.REDIS_NAME_COUNTERS, "size_bytes") or 0)
+            > config.PIPELINE_RESULT_CACHE_MAX_SIZE_BYTES
+        ):
+            # ZPOPMIN is atomic. If multiple workers evict at the same time, every entry is removed only once.
+            popped = self.redis_client.zpopmin(self.REDIS_NAME_LRU_INDEX)
+            if not popped:
+                break
+            raw_cache_key, _ = popped[0]
+            self._remove_entry(raw_cache_key.decode("utf-8"))
+            self.redis_client.hincrby(self.REDIS_NAME_COUNTERS, "evictions", 1)
+
+    def _remove_entry(self, cache_key: str):
+        raw_size_bytes = self.redis_client.hget(self.REDIS_NAME_SIZES, cache_key)
+        self._get_zip_path(cache_key).unlink(missing_ok=True)
+        redis_pipe = self.redis_client.pipeline(transaction=True)
+        redis_pipe.hdel(self.REDIS_NAME_SIZES, cache_key)
+        redis_pipe.hincrby(
+            self.REDIS_NAME_COUNTERS, "size_bytes", -int(raw_size_bytes or 0)
+        )
+        redis_pipe.execute()
+
+    def get_stats(self) -> MetaKeggPipelineResultCacheStats:
+        raw_counters: Dict[bytes, bytes] = self.redis_client.hgetall(
+            self.REDIS_NAME_COUNTERS
+        )
+        counters = {k.decode("utf-8"): int(v) for k, v in raw_counters.items()}
+        return MetaKeggPipelineResultCacheStats(
+            entries=self.redis_client.zcard(self.REDIS_NAME_LRU_INDEX),
+            size_bytes=counters.get("size_bytes", 0),
+            max_size_bytes=config.PIPELINE_RESULT_CACHE_MAX_SIZE_BYTES,
+            hits=counters.get("hits", 0),
+            misses=counters.get("misses", 0),
+            stores=counters.get("stores", 0),
+            evictions=counters.get("evictions", 0),
+        )
@@ -0,0 +1,97 @@
+from typing import Dict, List, Optional
+import heapq
+
+from mekeweserver.model import MetaKeggPipelineStatisticPoint
+
+
+class MetaKeggPipelineRunDurationEstimator:
+    """Estimates the running time of a pipeline run from the statistic points of past pipeline runs.
+
+    Per analysis method the running time is fitted linearly to the input files size (least squares).
+    If there are too few data points for a method, or the running time does not grow with the input size, the method's average is used.
+    Without any data points of the method, the average of all methods is used and without any data points at all `default_duration_sec`.
+    """
+
+    MIN_DATAPOINTS_FOR_SIZE_FIT = 3
+
+    def __init__(
+        self,
+        datapoints: List[MetaKeggPipelineStatisticPoint],
+        default_duration_sec: float,
+    ):
+        self.default_duration_sec = default_duration_sec
+        # results from the result cache took no time to compute
+        datapoints = [d for d in datapoints if not d.result_from_cache]
+        # failed pipeline runs often stop early and would skew the estimate
+        successful_datapoints = [d for d in datapoints if not d.pipeline_failed]
+        if successful_datapoints:
+            datapoints = successful_datapoints
+        self.overall_average_sec: Optional[float] = (
+            sum(d.pipeline_running_duration_sec for d in datapoints) / len(datapoints)
+            if datapoints
+            else None
+        )
+        datapoints_per_method: Dict[str, List[MetaKeggPipelineStatisticPoint]] = {}
+        for d in datapoints:
+            datapoints_per_method.setdefault(d.pipeline_methodname, []).append(d)
+        # method name -> (average sec, intercept sec, sec per input byte)
+        self.method_models: Dict[str, tuple[float, float, float]] = {
+            method_name: self._fit(method_datapoints)
+            for method_name, method_datapoints in datapoints_per_method.items()
+        }
+
+    def _fit(
+        self, datapoints: List[MetaKeggPipelineStatisticPoint]
+    ) -> tuple[float, float, float]:
+        sizes = [d.input_files_size_bytes for d in datapoints]
+        durations = [d.pipeline_running_duration_sec for d in datapoints]
+        mean_size = sum(sizes) / len(sizes)
+        mean_duration = sum(durations) / len(durations)
+        if len(datapoints) < self.MIN_DATAPOINTS_FOR_SIZE_FIT:
+            return mean_duration, mean_duration, 0.0
+        size_variance = sum((s - mean_size) ** 2 for s in sizes)
+        if size_variance == 0:
+            return mean_duration, mean_duration, 0.0
+        slope = (
+            sum((s - mean_size) * (d - mean_duration) for s, d in zip(sizes, durations))
+            / size_variance
+        )
+        if slope <= 0:
+            return mean_duration, mean_duration, 0.0
+        return mean_duration, mean_duration - slope * mean_size, slope
+
+    def estimate_duration_sec(
+        self,
+        method_name: Optional[str] = None,
+        input_files_size_bytes: Optional[int] = None,
+    ) -> float:
+        if method_name in self.method_models:
+            mean_duration, intercept, slope = self.method_models[method_name]
+            if input_files_size_bytes is None:
+                return mean_duration
+            # a pipeline run takes at least a second, even if the fit says otherwise for tiny inputs
+            return max(intercept + slope * input_files_size_bytes, 1.0)
+        if self.overall_average_sec is not None:
+            return self.overall_average_sec
+        return self.default_duration_sec
+
+
+def estimate_start_offsets_sec(
+    worker_count: int,
+    running_remaining_sec: List[float],
+    queued_durations_sec: List[float],
+) -> List[float]:
+    """Simulate the workers processing the queue in order.
+    Returns the offset from now in seconds at which each of `queued_durations_sec` is estimated to start.
+    `running_remaining_sec` are the estimated remaining running times of the pipeline runs that are processed right now.
+    """
+    # time from now at which each worker is free
+    worker_free_at = sorted(running_remaining_sec)
+    worker_free_at += [0.0] * max(worker_count - len(worker_free_at), 0)
+    heapq.heapify(worker_free_at)
+    start_offsets = []
+    for duration_sec in queued_durations_sec:
+        start_offset = heapq.heappop(worker_free_at)
+        start_offsets.append(start_offset)
+        heapq.heappush(worker_free_at, start_offset + duration_sec)
+    return start_offsets
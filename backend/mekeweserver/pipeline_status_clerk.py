@@ -1,13 +1,15 @@
-from typing import Dict, List, Optional
+from typing import Any, Dict, List, Optional, Tuple, get_args
 from collections import Counter
+import json
+import math
 import redis
 from pathlib import Path, PurePath
 import uuid
 import datetime
 import shutil
 from fastapi import UploadFile
+from pydantic import TypeAdapter
 from mekeweserver.config import RedisConnectionParams
-import redis
 from mekeweserver.model import (
     MetaKeggPipelineDef,
     MetaKeggPipelineDefStates,
@@ -22,8 +24,15 @@ from mekeweserver.model import (
 from mekeweserver.config import Config, get_config
 from mekeweserver.log import get_logger
 from mekeweserver.model import find_parameter_docs_by_name
+from mekeweserver.pipeline_queue import MetaKeggPipelineQueue
+from mekeweserver.upload_blob_store import MetaKeggUploadBlobStore
+from mekeweserver.pipeline_run_estimates import (
+    MetaKeggPipelineRunDurationEstimator,
+    estimate_start_offsets_sec,
+)
 from mekeweserver.utils import (
     get_directory_size_bytes,
+    get_disk_usage_bytes,
     bytes_humanreadable,
     count_files_in_dir_tree,
 )
@@ -31,30 +40,226 @@ from mekeweserver.utils import (
 config: Config = get_config()
 log = get_logger()
 
+# Used to (de)serialize single fields of a `MetaKeggPipelineDef` for the field-level storage layout.
+_pipeline_definition_field_adapters: Dict[str, TypeAdapter] = {
+    name: TypeAdapter(field.annotation)
+    for name, field in MetaKeggPipelineDef.model_fields.items()
+}
+
 
 class MetaKeggPipelineStateManager:
+    # Legacy storage: one hash with the full json serialized definitions. Will be migrated on worker boot (see `rebuild_pipeline_run_indexes`).
     REDIS_NAME_PIPELINE_STATES = "pipeline_states"
-    REDIS_NAME_PIPELINE_QUEUE = "pipeline_queue"
+    # Every pipeline definition is stored in its own hash ("pipeline_def:<ticket>") with one json serialized value per model field.
+    # This way small updates (e.g. a state change) do not need to rewrite the whole definition.
+    REDIS_NAME_PIPELINE_DEFINITION_PREFIX = "pipeline_def"
+    REDIS_NAME_PIPELINE_TICKETS = "pipeline_tickets"
+    # Reliable queue: Workers move tickets from the queue into their own processing list ("pipeline_processing:<worker_id>")
+    # and only remove them when the run is finished. Tickets of a crashed worker are not lost this way.
+    REDIS_NAME_PIPELINE_PROCESSING_PREFIX = "pipeline_processing"
+    # Leases: A key with a TTL per running pipeline run ("pipeline_lease:<ticket_id>") that is refreshed by the processing worker.
+    # The holder hash remembers which worker took the ticket, even after the lease key lapsed.
+    REDIS_NAME_PIPELINE_LEASE_PREFIX = "pipeline_lease"
+    REDIS_NAME_PIPELINE_LEASE_HOLDERS = "pipeline_lease_holders"
+    # hash worker_id -> unix timestamp of the last heartbeat of the worker. Workers can run on other nodes than the API server.
+    REDIS_NAME_PIPELINE_WORKER_HEARTBEATS = "pipeline_worker_heartbeats"
+    # set of ticket ids the user wants to cancel. The processing worker checks it periodically.
+    REDIS_NAME_PIPELINE_CANCEL_REQUESTS = "pipeline_cancel_requests"
     REDIS_NAME_PIPELINE_STATISTICS = "pipeline_statistics"
+    # Number of recent pipeline runs used to estimate the running time of pipeline runs (see `MetaKeggPipelineRunDurationEstimator`).
+    PIPELINE_RUN_DURATION_ESTIMATE_SAMPLE_SIZE = 200
+    # hash ticket -> estimated running time in seconds. Estimated once when the pipeline run is queued, as the input files can not change afterwards.
+    REDIS_NAME_PIPELINE_DURATION_ESTIMATES = "pipeline_duration_estimates"
+    # Estimated start of every queued pipeline run (sorted set ticket -> unix timestamp) and of a pipeline run that would be queued right now (unix timestamp).
+    # Recomputed when the queue or the running pipeline runs change and by the housekeeper (see `refresh_queue_start_estimates`). Status polls only read them.
+    REDIS_NAME_PIPELINE_QUEUE_START_ESTIMATES = "pipeline_queue_start_estimates"
+    REDIS_NAME_PIPELINE_QUEUE_NEXT_START_ESTIMATE = "pipeline_queue_next_start_estimate"
+    # hash ticket -> json {"startup_sec": float, "warm": bool}. Startup time of the analysis child process. Moved into the statistic point when the run is finished.
+    REDIS_NAME_PIPELINE_ANALYSIS_STARTUP_TIMES = "pipeline_analysis_startup_times"
+    REDIS_NAME_PIPELINE_RESULT_ARCHIVE_STATS = "pipeline_result_archive_stats"
+    # Secondary indexes. One set per pipeline state and one sorted set per housekeeping deadline (score is a unix timestamp).
+    # They are maintained on every write of a pipeline definition, so housekeeping does not need to scan/parse all definitions.
+    REDIS_NAME_PIPELINE_STATE_INDEX_PREFIX = "pipeline_state_index"
+    REDIS_NAME_PIPELINE_EXPIRE_DEADLINES = "pipeline_expire_deadlines"
+    REDIS_NAME_PIPELINE_DELETE_DEADLINES = "pipeline_delete_deadlines"
+    REDIS_NAME_PIPELINE_ABANDON_DEADLINES = "pipeline_abandon_deadlines"
+    # The output of a pipeline run is stored in an append-only list per ticket and not in the definition itself.
+    # It keeps the first `PIPELINE_RUN_OUTPUT_LOG_HEAD_LINES` lines. Later lines go to the tail list, which keeps the last `PIPELINE_RUN_OUTPUT_LOG_TAIL_LINES` lines.
+    # The amount of lines dropped in between is counted per ticket.
+    REDIS_NAME_PIPELINE_OUTPUT_LOG_PREFIX = "pipeline_output_log"
+    REDIS_NAME_PIPELINE_OUTPUT_LOG_TAIL_PREFIX = "pipeline_output_log_tail"
+    REDIS_NAME_PIPELINE_OUTPUT_LOG_TRUNCATED_LINES = (
+        "pipeline_output_log_truncated_lines"
+    )
+    # These fields are calculated on read or live in their own structure. They are never stored in the definition hash.
+    PIPELINE_DEFINITION_NON_STORED_FIELDS = {
+        "place_in_queue",
+        "output_log",
+        "output_log_lines_total",
+        "output_log_lines_truncated",
+        "estimated_start_at_utc",
+        "estimated_finish_at_utc",
+    }
+    # If one of these fields changes, the secondary indexes need to be updated.
+    PIPELINE_DEFINITION_INDEXED_FIELDS = {"state", "created_at_utc", "finished_at_utc"}
 
     def __init__(self, redis_client: redis.Redis):
         self.redis_client = redis_client
+        self.queue = MetaKeggPipelineQueue(redis_client)
+        self.blob_store = MetaKeggUploadBlobStore(redis_client)
 
     def get_all_pipeline_run_definitions(
         self, filter_state: MetaKeggPipelineDefStates = None
     ) -> List[MetaKeggPipelineDef]:
+        if filter_state is not None:
+            raw_ticket_hexes = self.redis_client.smembers(
+                self._get_state_index_name(filter_state)
+            )
+        else:
+            raw_ticket_hexes = self.redis_client.smembers(
+                self.REDIS_NAME_PIPELINE_TICKETS
+            )
         result = []
-        raw_definitions: str = self.redis_client.hgetall(
-            self.REDIS_NAME_PIPELINE_STATES
-        ).values()
-        for raw_definition in raw_definitions:
-            definition = MetaKeggPipelineDef.model_validate_json(raw_definition)
+        for definition in self._get_indexed_pipeline_run_definitions(
+            [uuid.UUID(raw.decode("utf-8")) for raw in raw_ticket_hexes]
+        ):
             if filter_state is not None and definition.state == filter_state:
                 result.append(definition)
             elif filter_state is None:
                 result.append(definition)
         return result
 
+    def get_all_pipeline_run_ticket_ids(self) -> List[uuid.UUID]:
+        return [
+            uuid.UUID(raw.decode("utf-8"))
+            for raw in self.redis_client.smembers(self.REDIS_NAME_PIPELINE_TICKETS)
+        ]
+
+    def _get_state_index_name(self, state: MetaKeggPipelineDefStates) -> str:
+        return f"{self.REDIS_NAME_PIPELINE_STATE_INDEX_PREFIX}:{state}"
+
+    def _stage_pipeline_run_index_update(
+        self,
+        redis_pipe: redis.client.Pipeline,
+        ticket_id: uuid.UUID,
+        state: MetaKeggPipelineDefStates,
+        created_at_utc: datetime.datetime,
+        finished_at_utc: Optional[datetime.datetime],
+    ):
+        """Add all commands to `redis_pipe` that are needed to bring the secondary indexes in line with the given (indexed) field values of a pipeline definition"""
+        ticket_hex = ticket_id.hex
+        for index_state in get_args(MetaKeggPipelineDefStates):
+            if index_state != state:
+                redis_pipe.srem(self._get_state_index_name(index_state), ticket_hex)
+        redis_pipe.sadd(self._get_state_index_name(state), ticket_hex)
+
+        expire_datetime = self._calc_expire_datetime(finished_at_utc)
+        if expire_datetime is not None and state != "expired":
+            redis_pipe.zadd(
+                self.REDIS_NAME_PIPELINE_EXPIRE_DEADLINES,
+                {ticket_hex: expire_datetime.timestamp()},
+            )
+        else:
+            redis_pipe.zrem(self.REDIS_NAME_PIPELINE_EXPIRE_DEADLINES, ticket_hex)
+
+        delete_datetime = self._calc_delete_datetime(finished_at_utc)
+        if delete_datetime is not None:
+            redis_pipe.zadd(
+                self.REDIS_NAME_PIPELINE_DELETE_DEADLINES,
+                {ticket_hex: delete_datetime.timestamp()},
+            )
+        else:
+            redis_pipe.zrem(self.REDIS_NAME_PIPELINE_DELETE_DEADLINES, ticket_hex)
+
+        abandon_datetime = self._calc_abandon_datetime(state, created_at_utc)
+        if abandon_datetime is not None:
+            redis_pipe.zadd(
+                self.REDIS_NAME_PIPELINE_ABANDON_DEADLINES,
+                {ticket_hex: abandon_datetime.timestamp()},
+            )
+        else:
+            redis_pipe.zrem(self.REDIS_NAME_PIPELINE_ABANDON_DEADLINES, ticket_hex)
+
+    def _stage_pipeline_run_index_update_from_definition(
+        self, redis_pipe: redis.client.Pipeline, pipeline_status: MetaKeggPipelineDef
+    ):
+        self._stage_pipeline_run_index_update(
+            redis_pipe,
+            ticket_id=pipeline_status.ticket.id,
+            state=pipeline_status.state,
+            created_at_utc=pipeline_status.created_at_utc,
+            finished_at_utc=pipeline_status.finished_at_utc,
+        )
+
+    def _stage_pipeline_run_index_removal(
+        self, redis_pipe: redis.client.Pipeline, ticket_id: uuid.UUID
+    ):
+        for state in get_args(MetaKeggPipelineDefStates):
+            redis_pipe.srem(self._get_state_index_name(state), ticket_id.hex)
+        redis_pipe.zrem(self.REDIS_NAME_PIPELINE_EXPIRE_DEADLINES, ticket_id.hex)
+        redis_pipe.zrem(self.REDIS_NAME_PIPELINE_DELETE_DEADLINES, ticket_id.hex)
+        redis_pipe.zrem(self.REDIS_NAME_PIPELINE_ABANDON_DEADLINES, ticket_id.hex)
+
+    def rebuild_pipeline_run_indexes(self):
+        """Recreate all secondary indexes from the stored pipeline definitions.
+        Definitions in the legacy storage layout (one json blob per definition in `REDIS_NAME_PIPELINE_STATES`) will be migrated to the field-level layout first.
+        Should be called on worker boot.
+        """
+        self._migrate_legacy_pipeline_run_definitions()
+        self.queue.migrate_legacy_queue()
+        log.info("Rebuild pipeline-run state and deadline indexes...")
+        redis_pipe = self.redis_client.pipeline(transaction=True)
+        for state in get_args(MetaKeggPipelineDefStates):
+            redis_pipe.delete(self._get_state_index_name(state))
+        redis_pipe.delete(
+            self.REDIS_NAME_PIPELINE_EXPIRE_DEADLINES,
+            self.REDIS_NAME_PIPELINE_DELETE_DEADLINES,
+            self.REDIS_NAME_PIPELINE_ABANDON_DEADLINES,
+        )
+        for pipeline_status in self.get_all_pipeline_run_definitions():
+            self._stage_pipeline_run_index_update_from_definition(
+                redis_pipe, pipeline_status
+            )
+        redis_pipe.execute()
+
+    def _migrate_legacy_pipeline_run_definitions(self):
+        legacy_raw_definitions: Dict[bytes, bytes] = self.redis_client.hgetall(
+            self.REDIS_NAME_PIPELINE_STATES
+        )
+        if not legacy_raw_definitions:
+            return
+        log.info(
+            f"Migrate {len(legacy_raw_definitions)} pipeline-run definitions to field-level storage..."
+        )
+        for raw_definition in legacy_raw_definitions.values():
+            pipeline_status = MetaKeggPipelineDef.model_validate_json(raw_definition)
+            redis_pipe = self.redis_client.pipeline(transaction=True)
+            if pipeline_status.output_log:
+                # migrate output logs that were stored inside the definition into the append-only output log list
+                redis_pipe.delete(self._get_output_log_name(pipeline_status.ticket.id))
+                redis_pipe.rpush(
+                    self._get_output_log_name(pipeline_status.ticket.id),
+                    *pipeline_status.output_log.splitlines(),
+                )
+            self._stage_pipeline_run_definition_write(redis_pipe, pipeline_status)
+            redis_pipe.hdel(
+                self.REDIS_NAME_PIPELINE_STATES, pipeline_status.ticket.id.hex
+            )
+            redis_pipe.execute()
+
+    def _get_due_ticket_ids(
+        self, deadline_index_name: str, limit: Optional[int] = None
+    ) -> List[uuid.UUID]:
+        now_timestamp = datetime.datetime.now(tz=datetime.timezone.utc).timestamp()
+        raw_ticket_hexes: List[bytes] = self.redis_client.zrangebyscore(
+            deadline_index_name,
+            "-inf",
+            now_timestamp,
+            start=0 if limit is not None else None,
+            num=limit,
+        )
+        return [uuid.UUID(raw.decode("utf-8")) for raw in raw_ticket_hexes]
+
     def init_new_pipeline_run(
         self, params: MetaKeggPipelineInputParamsValuesAllOptional
     ) -> MetaKeggPipelineTicket:
@@ -71,30 +276,272 @@ class MetaKeggPipelineStateManager:
         self.set_pipeline_run_definition(pipeline_status)
         return ticket
 
-    def get_pipeline_run_definition(
-        self, ticket_id: uuid.UUID, raise_exception_if_not_exists: Exception = None
-    ) -> MetaKeggPipelineDef:
-        raw_data: str = self.redis_client.hget(
-            self.REDIS_NAME_PIPELINE_STATES, ticket_id.hex
+    def _get_definition_name(self, ticket_id: uuid.UUID) -> str:
+        return f"{self.REDIS_NAME_PIPELINE_DEFINITION_PREFIX}:{ticket_id.hex}"
+
+    def _serialize_pipeline_run_definition(
+        self, pipeline_status: MetaKeggPipelineDef
+    ) -> Dict[str, str]:
+        return {
+            field_name: json.dumps(value)
+            for field_name, value in pipeline_status.model_dump(
+                mode="json", exclude=self.PIPELINE_DEFINITION_NON_STORED_FIELDS
+            ).items()
+        }
+
+    def _deserialize_pipeline_run_definition(
+        self, raw_fields: Dict[bytes, bytes]
+    ) -> MetaKeggPipelineDef | None:
+        if not raw_fields:
+            return None
+        return MetaKeggPipelineDef.model_validate(
+            {
+                raw_field_name.decode("utf-8"): json.loads(raw_value)
+                for raw_field_name, raw_value in raw_fields.items()
+            }
         )
-        if raw_data is None and raise_exception_if_not_exists:
-            raise raise_exception_if_not_exists
-        data = MetaKeggPipelineDef.model_validate_json(raw_data)
-        if data.state == "queued":
-            pos_as_str: str | None = self.redis_client.lpos(
-                self.REDIS_NAME_PIPELINE_QUEUE, ticket_id.hex
+
+    def get_pipeline_run_definition(
+        self,
+        ticket_id: uuid.UUID,
+        raise_exception_if_not_exists: Exception = None,
+        output_log_offset: int = 0,
+    ) -> MetaKeggPipelineDef | None:
+        redis_pipe = self.redis_client.pipeline(transaction=False)
+        redis_pipe.hgetall(self._get_definition_name(ticket_id))
+        self._stage_output_log_lengths_read(redis_pipe, ticket_id)
+        raw_fields, *raw_output_log_lengths = redis_pipe.execute()
+        data = self._deserialize_pipeline_run_definition(raw_fields)
+        if data is None:
+            if raise_exception_if_not_exists:
+                raise raise_exception_if_not_exists
+            return None
+        output_log_lengths = self._parse_output_log_lengths(*raw_output_log_lengths)
+        if sum(output_log_lengths):
+            output_log_lines, truncated_lines = self._read_output_log(
+                ticket_id, output_log_offset, *output_log_lengths
             )
-            if pos_as_str is not None:
-                data.place_in_queue = int(pos_as_str)
+            data.output_log = "".join(f"{line}\n" for line in output_log_lines)
+            data.output_log_lines_total = sum(output_log_lengths)
+            data.output_log_lines_truncated = truncated_lines
+        if data.state == "queued":
+            data.place_in_queue = self.queue.get_place_in_queue(ticket_id)
+        self._set_pipeline_run_time_estimates(data)
         return data
 
+    def get_pipeline_run_definition_fields(
+        self, ticket_id: uuid.UUID, field_names: List[str]
+    ) -> Dict[str, Any] | None:
+        """Fetch only some fields of a pipeline definition. Returns None if the pipeline definition does not exist."""
+        raw_values: List[bytes | None] = self.redis_client.hmget(
+            self._get_definition_name(ticket_id), field_names
+        )
+        if all(raw_value is None for raw_value in raw_values):
+            return None
+        return {
+            field_name: (
+                _pipeline_definition_field_adapters[field_name].validate_json(raw_value)
+                if raw_value is not None
+                else None
+            )
+            for field_name, raw_value in zip(field_names, raw_values)
+        }
+
+    def update_pipeline_run_definition_fields(
+        self, ticket_id: uuid.UUID, **fields: Any
+    ):
+        """Partial update of a pipeline definition. Only the given fields will be written. e.g.:
+        `update_pipeline_run_definition_fields(ticket_id, state="running", started_at_utc=now)`
+        """
+        if not fields:
+            return
+        changed_indexed_field_names = self.PIPELINE_DEFINITION_INDEXED_FIELDS & set(
+            fields.keys()
+        )
+        fetch_field_names = ["ticket"] + list(
+            self.PIPELINE_DEFINITION_INDEXED_FIELDS - changed_indexed_field_names
+            if changed_indexed_field_names
+            else []
+        )
+        current_values = self.get_pipeline_run_definition_fields(
+            ticket_id, fetch_field_names
+        )
+        if current_values is None or current_values["ticket"] is None:
+            raise ValueError(f"Pipeline-run with id '{ticket_id}' does not exist.")
+        redis_pipe = self.redis_client.pipeline(transaction=True)
+        self._stage_pipeline_run_definition_fields_update(
+            redis_pipe, ticket_id, current_values, fields
+        )
+        redis_pipe.execute()
+
+    def _stage_pipeline_run_definition_fields_update(
+        self,
+        redis_pipe: redis.client.Pipeline,
+        ticket_id: uuid.UUID,
+        current_values: Dict[str, Any],
+        fields: Dict[str, Any],
+    ):
+        """Add the commands of a partial update to `redis_pipe`. `current_values` must contain the indexed fields that are not in `fields`."""
+        redis_pipe.hset(
+            self._get_definition_name(ticket_id),
+            mapping={
+                field_name: _pipeline_definition_field_adapters[field_name].dump_json(
+                    value
+                )
+                for field_name, value in fields.items()
+            },
+        )
+        changed_indexed_field_names = self.PIPELINE_DEFINITION_INDEXED_FIELDS & set(
+            fields.keys()
+        )
+        if changed_indexed_field_names:
+            index_values = current_values | {
+                field_name: fields[field_name]
+                for field_name in changed_indexed_field_names
+            }
+            self._stage_pipeline_run_index_update(
+                redis_pipe,
+                ticket_id=ticket_id,
+                state=index_values["state"],
+                created_at_utc=index_values["created_at_utc"],
+                finished_at_utc=index_values["finished_at_utc"],
+            )
+
+    def _stage_pipeline_run_definition_write(
+        self, redis_pipe: redis.client.Pipeline, pipeline_status: MetaKeggPipelineDef
+    ):
+        redis_pipe.hset(
+            self._get_definition_name(pipeline_status.ticket.id),
+            mapping=self._serialize_pipeline_run_definition(pipeline_status),
+        )
+        redis_pipe.sadd(self.REDIS_NAME_PIPELINE_TICKETS, pipeline_status.ticket.id.hex)
+        self._stage_pipeline_run_index_update_from_definition(
+            redis_pipe, pipeline_status
+        )
+
     def set_pipeline_run_definition(self, pipeline_status: MetaKeggPipelineDef):
-        self.redis_client.hset(
-            self.REDIS_NAME_PIPELINE_STATES,
-            pipeline_status.ticket.id.hex,
-            pipeline_status.model_dump_json(),
+        redis_pipe = self.redis_client.pipeline(transaction=True)
+        self._stage_pipeline_run_definition_write(redis_pipe, pipeline_status)
+        redis_pipe.execute()
+
+    def set_pipeline_run_definitions(self, pipeline_states: List[MetaKeggPipelineDef]):
+        """Write multiple pipeline definitions with one pipelined Redis round trip."""
+        if not pipeline_states:
+            return
+        redis_pipe = self.redis_client.pipeline(transaction=True)
+        for pipeline_status in pipeline_states:
+            self._stage_pipeline_run_definition_write(redis_pipe, pipeline_status)
+        redis_pipe.execute()
+
+    def _get_output_log_name(self, ticket_id: uuid.UUID) -> str:
+        return f"{self.REDIS_NAME_PIPELINE_OUTPUT_LOG_PREFIX}:{ticket_id.hex}"
+
+    def _get_output_log_tail_name(self, ticket_id: uuid.UUID) -> str:
+        return f"{self.REDIS_NAME_PIPELINE_OUTPUT_LOG_TAIL_PREFIX}:{ticket_id.hex}"
+
+    def _stage_output_log_lengths_read(
+        self, redis_pipe: redis.client.Pipeline, ticket_id: uuid.UUID
+    ):
+        redis_pipe.llen(self._get_output_log_name(ticket_id))
+        redis_pipe.hget(
+            self.REDIS_NAME_PIPELINE_OUTPUT_LOG_TRUNCATED_LINES, ticket_id.hex
+        )
+        redis_pipe.llen(self._get_output_log_tail_name(ticket_id))
+
+    def _parse_output_log_lengths(
+        self, head_length: int, raw_truncated_length: Optional[bytes], tail_length: int
+    ) -> Tuple[int, int, int]:
+        return head_length, int(raw_truncated_length or 0), tail_length
+
+    def _read_output_log(
+        self,
+        ticket_id: uuid.UUID,
+        offset: int,
+        head_length: int,
+        truncated_length: int,
+        tail_length: int,
+    ) -> Tuple[List[str], int]:
+        """Read the output log lines after line number `offset`. Truncated lines are replaced by a marker line.
+        Returns the lines and the amount of truncated lines after `offset`.
+        """
+        tail_offset = head_length + truncated_length
+        redis_pipe = self.redis_client.pipeline(transaction=False)
+        redis_pipe.lrange(self._get_output_log_name(ticket_id), offset, -1)
+        redis_pipe.lrange(
+            self._get_output_log_tail_name(ticket_id),
+            max(0, offset - tail_offset),
+            -1,
+        )
+        raw_head_lines, raw_tail_lines = redis_pipe.execute()
+        lines = [line.decode("utf-8") for line in raw_head_lines]
+        truncated_lines_after_offset = max(0, tail_offset - max(offset, head_length))
+        if truncated_lines_after_offset:
+            lines.append(
+                f"[... {truncated_lines_after_offset} lines truncated. The full output log is included in the result zip file as '{config.PIPELINE_RUN_OUTPUT_LOG_ARCHIVE_FILE_NAME}' ...]"
+            )
+        lines.extend(line.decode("utf-8") for line in raw_tail_lines)
+        return lines, truncated_lines_after_offset
+
+    def append_pipeline_run_output_log(self, ticket_id: uuid.UUID, lines: List[str]):
+        """Append lines to the output log of a pipeline run. Lines between the head and the tail of the output log are dropped (see `REDIS_NAME_PIPELINE_OUTPUT_LOG_PREFIX`).
+        Expects one writer per pipeline run at a time (the worker holding the lease).
+        """
+        if not lines:
+            return
+        head_lines_max = config.PIPELINE_RUN_OUTPUT_LOG_HEAD_LINES
+        if head_lines_max is None:
+            self.redis_client.rpush(self._get_output_log_name(ticket_id), *lines)
+            return
+        redis_pipe = self.redis_client.pipeline(transaction=False)
+        redis_pipe.llen(self._get_output_log_name(ticket_id))
+        redis_pipe.llen(self._get_output_log_tail_name(ticket_id))
+        head_length, tail_length = redis_pipe.execute()
+        head_lines_free = max(0, head_lines_max - head_length)
+        head_lines = lines[:head_lines_free]
+        tail_lines = lines[head_lines_free:]
+        tail_lines_max = config.PIPELINE_RUN_OUTPUT_LOG_TAIL_LINES
+        truncated_length = max(0, tail_length + len(tail_lines) - tail_lines_max)
+        redis_pipe = self.redis_client.pipeline(transaction=True)
+        if head_lines:
+            redis_pipe.rpush(self._get_output_log_name(ticket_id), *head_lines)
+        if tail_lines and tail_lines_max > 0:
+            redis_pipe.rpush(self._get_output_log_tail_name(ticket_id), *tail_lines)
+            redis_pipe.ltrim(
+                self._get_output_log_tail_name(ticket_id), -tail_lines_max, -1
+            )
+        if truncated_length:
+            redis_pipe.hincrby(
+                self.REDIS_NAME_PIPELINE_OUTPUT_LOG_TRUNCATED_LINES,
+                ticket_id.hex,
+                truncated_length,
+            )
+        redis_pipe.execute()
+
+    def get_pipeline_run_output_log(
+        self, ticket_id: uuid.UUID, offset: int = 0
+    ) -> List[str]:
+        redis_pipe = self.redis_client.pipeline(transaction=False)
+        self._stage_output_log_lengths_read(redis_pipe, ticket_id)
+        output_log_lengths = self._parse_output_log_lengths(*redis_pipe.execute())
+        return self._read_output_log(ticket_id, offset, *output_log_lengths)[0]
+
+    def _stage_output_log_removal(
+        self, redis_pipe: redis.client.Pipeline, ticket_ids: List[uuid.UUID]
+    ):
+        redis_pipe.delete(
+            *[self._get_output_log_name(t) for t in ticket_ids],
+            *[self._get_output_log_tail_name(t) for t in ticket_ids],
+        )
+        redis_pipe.hdel(
+            self.REDIS_NAME_PIPELINE_OUTPUT_LOG_TRUNCATED_LINES,
+            *[t.hex for t in ticket_ids],
         )
 
+    def clear_pipeline_run_output_log(self, ticket_id: uuid.UUID):
+        redis_pipe = self.redis_client.pipeline(transaction=True)
+        self._stage_output_log_removal(redis_pipe, [ticket_id])
+        redis_pipe.execute()
+
     def attach_pipeline_run_input_file(
         self, ticket_id: uuid.UUID, param_name: str, upload_file_object: UploadFile
     ) -> MetaKeggPipelineDef:
@@ -133,17 +580,24 @@ class MetaKeggPipelineStateManager:
             if existing_file:
                 pipeline_status = self.remove_pipeline_run_input_file(
                     ticket_id=ticket_id,
+                    param_name=param_name,
                     removefile_name=existing_file[0],
                 )
 
-        # store file
-        with open(internal_file_path, "wb") as target_file:
-            target_file.write(upload_file_object.file.read())
+        # store file. Identical uploads share one blob on disk.
+        self.blob_store.store(
+            ticket_id,
+            param_name,
+            clean_file_name,
+            upload_file_object.file,
+            internal_file_path,
+        )
 
         if config.MAX_CACHE_SIZE_BYTES:
             cache_size = self.get_cache_usage_size_bytes()
             if cache_size > config.MAX_CACHE_SIZE_BYTES:
                 internal_file_path.unlink()
+                self.blob_store.release(ticket_id, param_name, clean_file_name)
                 raise ValueError("Out of storage. Try again later.")
             else:
                 log.info(
@@ -155,7 +609,10 @@ class MetaKeggPipelineStateManager:
             pipeline_status.pipeline_input_file_names[param_name].append(
                 clean_file_name
             )
-        self.set_pipeline_run_definition(pipeline_status)
+        self.update_pipeline_run_definition_fields(
+            ticket_id,
+            pipeline_input_file_names=pipeline_status.pipeline_input_file_names,
+        )
         return pipeline_status
 
     def remove_pipeline_run_input_file(
@@ -177,24 +634,31 @@ class MetaKeggPipelineStateManager:
             )
             return pipeline
         pipeline.pipeline_input_file_names[param_name].remove(removefile_name)
-        self.set_pipeline_run_definition(pipeline)
+        self.update_pipeline_run_definition_fields(
+            ticket_id, pipeline_input_file_names=pipeline.pipeline_input_file_names
+        )
         upload_file_path.unlink(missing_ok=True)
+        self.blob_store.release(ticket_id, param_name, removefile_name)
         return self.get_pipeline_run_definition(ticket_id=ticket_id)
 
     def set_pipeline_method(
         self, ticket_id: uuid.UUID, analysis_method_name: str
     ) -> MetaKeggPipelineDef:
         log.info(f"Add pipeline-run with id '{ticket_id}' to queue.")
-        pipeline_status = self.get_pipeline_run_definition(ticket_id)
-        pipeline_status.pipeline_analyses_method = next(
-            e.value
-            for e in MetaKeggPipelineAnalysisMethodDocs
-            if e.name == analysis_method_name
+        self.update_pipeline_run_definition_fields(
+            ticket_id,
+            pipeline_analyses_method=next(
+                e.value
+                for e in MetaKeggPipelineAnalysisMethodDocs
+                if e.name == analysis_method_name
+            ),
         )
-        self.set_pipeline_run_definition(pipeline_status)
-        return pipeline_status
+        return self.get_pipeline_run_definition(ticket_id)
 
-    def set_pipeline_run_as_queud(self, ticket_id: uuid.UUID) -> MetaKeggPipelineDef:
+    def set_pipeline_run_as_queud(
+        self, ticket_id: uuid.UUID, client_key: str = ""
+    ) -> MetaKeggPipelineDef:
+        """Put the pipeline run into the queue. `client_key` identifies the submitting client for fair scheduling (see `MetaKeggPipelineQueue`)."""
         log.info(f"Add pipeline-run with id '{ticket_id}' to queue.")
         pipeline_status = self.get_pipeline_run_definition(ticket_id)
 
@@ -202,47 +666,122 @@ class MetaKeggPipelineStateManager:
         pipeline_status.error = None
         pipeline_status.error_traceback = None
         pipeline_status.output_log = None
+        pipeline_status.output_log_lines_total = None
+        pipeline_status.output_log_lines_truncated = None
+        self.clear_pipeline_run_output_log(ticket_id)
+        pipeline_status.get_output_log_file_path().unlink(missing_ok=True)
         pipeline_status.finished_at_utc = None
-        if pipeline_status.get_output_zip_file_path() is not None:
-            # delete results from previous runs
-            pipeline_status.get_output_zip_file_path().unlink(missing_ok=True)
+        pipeline_status.run_attempts = 0
+        pipeline_status.result_from_cache = False
+        # delete results from previous runs
+        if pipeline_status.get_output_files_dir().exists():
+            shutil.rmtree(pipeline_status.get_output_files_dir())
+        pipeline_status.get_output_manifest_file_path().unlink(missing_ok=True)
         # ...reset done
 
         pipeline_status.state = "queued"
         pipeline_status.queued_at_utc = datetime.datetime.now(tz=datetime.timezone.utc)
-        queue_length = self.redis_client.llen(self.REDIS_NAME_PIPELINE_QUEUE)
 
-        self.set_pipeline_run_definition(pipeline_status)
-        self.redis_client.lpush(self.REDIS_NAME_PIPELINE_QUEUE, ticket_id.hex)
-        pipeline_status.place_in_queue = queue_length + 1
+        input_files_base_dir = pipeline_status.get_input_files_base_dir()
+        estimated_duration_sec = (
+            self.get_pipeline_run_duration_estimator().estimate_duration_sec(
+                method_name=(
+                    pipeline_status.pipeline_analyses_method.name
+                    if pipeline_status.pipeline_analyses_method is not None
+                    else None
+                ),
+                input_files_size_bytes=(
+                    get_directory_size_bytes(input_files_base_dir)
+                    if input_files_base_dir.exists()
+                    else None
+                ),
+            )
+        )
+
+        def stage_queued_state(redis_pipe: redis.client.Pipeline):
+            self._stage_pipeline_run_definition_write(redis_pipe, pipeline_status)
+            redis_pipe.srem(self.REDIS_NAME_PIPELINE_CANCEL_REQUESTS, ticket_id.hex)
+            redis_pipe.hset(
+                self.REDIS_NAME_PIPELINE_DURATION_ESTIMATES,
+                ticket_id.hex,
+                estimated_duration_sec,
+            )
+
+        self.queue.enqueue(
+            ticket_id, client_key=client_key, stage_with=stage_queued_state
+        )
+        self.refresh_queue_start_estimates()
+        pipeline_status.place_in_queue = self.queue.get_place_in_queue(ticket_id)
+        self._set_pipeline_run_time_estimates(pipeline_status)
         return pipeline_status
 
     def set_pipeline_state_as_running(
         self,
         ticket_id: uuid.UUID,
     ) -> MetaKeggPipelineDef:
-        pipeline_status = self.get_pipeline_run_definition(ticket_id)
-
-        pipeline_status.state = "running"
-        pipeline_status.started_at_utc = datetime.datetime.now(tz=datetime.timezone.utc)
-        self.set_pipeline_run_definition(pipeline_status)
-        return pipeline_status
+        self.update_pipeline_run_definition_fields(
+            ticket_id,
+            state="running",
+            started_at_utc=datetime.datetime.now(tz=datetime.timezone.utc),
+        )
+        return self.get_pipeline_run_definition(ticket_id)
 
     def set_pipeline_state_as_finished(
         self, ticket_id: uuid.UUID
     ) -> MetaKeggPipelineDef:
-        pipeline_status = self.get_pipeline_run_definition(ticket_id)
-        pipeline_status.state = (
-            "failed" if pipeline_status.error is not None else "success"
+        error = self.get_pipeline_run_definition_fields(ticket_id, ["error"])["error"]
+        self.update_pipeline_run_definition_fields(
+            ticket_id,
+            state="failed" if error is not None else "success",
+            finished_at_utc=datetime.datetime.now(tz=datetime.timezone.utc),
         )
-        pipeline_status.finished_at_utc = datetime.datetime.now(
-            tz=datetime.timezone.utc
-        )
-        self.set_pipeline_run_definition(pipeline_status)
+        self.release_pipeline_run_lease(ticket_id)
+        self.queue.forget_dequeued_ticket(ticket_id)
+        # a worker is free again
+        self.refresh_queue_start_estimates()
+        pipeline_status = self.get_pipeline_run_definition(ticket_id)
         self.create_pipeline_run_statistic_point(pipeline_status)
         return pipeline_status
 
+    def set_pipeline_run_analysis_startup_time(
+        self, ticket_id: uuid.UUID, startup_sec: float, warm: bool
+    ):
+        self.redis_client.hset(
+            self.REDIS_NAME_PIPELINE_ANALYSIS_STARTUP_TIMES,
+            ticket_id.hex,
+            json.dumps({"startup_sec": startup_sec, "warm": warm}),
+        )
+
+    def set_pipeline_run_result_archive_stats(
+        self, ticket_id: uuid.UUID, build_sec: float, compression_ratio: float
+    ):
+        self.redis_client.hset(
+            self.REDIS_NAME_PIPELINE_RESULT_ARCHIVE_STATS,
+            ticket_id.hex,
+            json.dumps(
+                {"build_sec": build_sec, "compression_ratio": compression_ratio}
+            ),
+        )
+
     def create_pipeline_run_statistic_point(self, pipeline_status: MetaKeggPipelineDef):
+        redis_pipe = self.redis_client.pipeline(transaction=False)
+        redis_pipe.hget(
+            self.REDIS_NAME_PIPELINE_ANALYSIS_STARTUP_TIMES,
+            pipeline_status.ticket.id.hex,
+        )
+        redis_pipe.hget(
+            self.REDIS_NAME_PIPELINE_RESULT_ARCHIVE_STATS,
+            pipeline_status.ticket.id.hex,
+        )
+        raw_analysis_startup, raw_result_archive_stats = redis_pipe.execute()
+        analysis_startup = (
+            json.loads(raw_analysis_startup) if raw_analysis_startup is not None else {}
+        )
+        result_archive_stats = (
+            json.loads(raw_result_archive_stats)
+            if raw_result_archive_stats is not None
+            else {}
+        )
         data_point = MetaKeggPipelineStatisticPoint(
             pipeline_waiting_time_sec=(
                 pipeline_status.started_at_utc - pipeline_status.queued_at_utc
@@ -259,16 +798,34 @@ class MetaKeggPipelineStateManager:
             input_files_size_bytes=get_directory_size_bytes(
                 pipeline_status.get_input_files_base_dir()
             ),
+            # the result zip, or the output files the result zip is streamed from (see `config.PIPELINE_RUN_RESULT_ZIP_MODE`)
             result_file_size_bytes=(
-                get_directory_size_bytes(pipeline_status.get_output_zip_file_path())
+                get_directory_size_bytes(pipeline_status.get_output_files_dir())
                 if pipeline_status.get_output_zip_file_path() is not None
                 else None
             ),
+            analysis_startup_sec=analysis_startup.get("startup_sec"),
+            analysis_started_warm=analysis_startup.get("warm"),
+            result_from_cache=pipeline_status.result_from_cache,
+            result_archive_build_sec=result_archive_stats.get("build_sec"),
+            result_archive_compression_ratio=result_archive_stats.get(
+                "compression_ratio"
+            ),
         )
-        self.redis_client.rpush(
+        redis_pipe = self.redis_client.pipeline(transaction=True)
+        redis_pipe.rpush(
             self.REDIS_NAME_PIPELINE_STATISTICS,
             data_point.model_dump_json(),
         )
+        redis_pipe.hdel(
+            self.REDIS_NAME_PIPELINE_ANALYSIS_STARTUP_TIMES,
+            pipeline_status.ticket.id.hex,
+        )
+        redis_pipe.hdel(
+            self.REDIS_NAME_PIPELINE_RESULT_ARCHIVE_STATS,
+            pipeline_status.ticket.id.hex,
+        )
+        redis_pipe.execute()
 
     def calculate_pipeline_run_statistic_point(
         self, days_limit: Optional[int] = None, days_offset: Optional[int] = None
@@ -364,8 +921,24 @@ class MetaKeggPipelineStateManager:
                 if [d for d in datapoints if d.result_file_size_bytes is not None]
                 else 0
             ),
+            average_analysis_startup_warm_sec=self._get_average_analysis_startup_sec(
+                datapoints, warm=True
+            ),
+            average_analysis_startup_cold_sec=self._get_average_analysis_startup_sec(
+                datapoints, warm=False
+            ),
         )
 
+    def _get_average_analysis_startup_sec(
+        self, datapoints: List[MetaKeggPipelineStatisticPoint], warm: bool
+    ) -> Optional[float]:
+        startup_times = [
+            d.analysis_startup_sec
+            for d in datapoints
+            if d.analysis_startup_sec is not None and d.analysis_started_warm == warm
+        ]
+        return sum(startup_times) / len(startup_times) if startup_times else None
+
     def remove_expired_pipeline_run_statistic_points(
         self,
     ) -> MetaKeggPipelineStatistics:
@@ -395,107 +968,754 @@ class MetaKeggPipelineStateManager:
         pipeline_status = self.get_pipeline_run_definition(ticket_id)
         if pipeline_status is None:
             return
-        if pipeline_status.get_files_base_dir().exists():
-            shutil.rmtree(pipeline_status.get_files_base_dir())
+        self.delete_pipeline_run_files(pipeline_status)
         pipeline_status.state = "expired"
-        self.set_pipeline_run_definition(pipeline_status)
+        self.update_pipeline_run_definition_fields(ticket_id, state="expired")
         return pipeline_status
 
+    def cancel_pipeline_run(self, ticket_id: uuid.UUID) -> MetaKeggPipelineDef:
+        """Cancel a queued or running pipeline run.
+        A queued pipeline run is removed from the queue right away and its files are freed.
+        For a running pipeline run a cancel request is registered. The processing worker aborts the run and frees the files.
+        """
+        state = self.get_pipeline_run_definition_fields(ticket_id, ["state"])["state"]
+        if state == "queued":
+            if self.queue.remove(ticket_id):
+                log.info(
+                    f"Remove canceled pipeline-run with id '{ticket_id}' from queue."
+                )
+                self._set_pipeline_run_as_canceled(ticket_id)
+                return self.get_pipeline_run_definition(ticket_id)
+            # The ticket was not in the queue anymore: a worker just took it. Treat it as running.
+        if state in ["queued", "running"]:
+            log.info(f"Request cancellation of pipeline-run with id '{ticket_id}'.")
+            self.redis_client.sadd(
+                self.REDIS_NAME_PIPELINE_CANCEL_REQUESTS, ticket_id.hex
+            )
+        return self.get_pipeline_run_definition(ticket_id)
+
+    def _set_pipeline_run_as_canceled(self, ticket_id: uuid.UUID):
+        # There is no dedicated "canceled" state. Clients wait for `failed` or `success`.
+        self.update_pipeline_run_definition_fields(
+            ticket_id,
+            state="failed",
+            error="The pipeline run was canceled.",
+            finished_at_utc=datetime.datetime.now(tz=datetime.timezone.utc),
+        )
+        self.free_pipeline_run_files(ticket_id)
+        self.clear_pipeline_run_cancel_request(ticket_id)
+        self.queue.forget_dequeued_ticket(ticket_id)
+        self.refresh_queue_start_estimates()
+
+    def is_pipeline_run_cancel_requested(self, ticket_id: uuid.UUID) -> bool:
+        return bool(
+            self.redis_client.sismember(
+                self.REDIS_NAME_PIPELINE_CANCEL_REQUESTS, ticket_id.hex
+            )
+        )
+
+    def clear_pipeline_run_cancel_request(self, ticket_id: uuid.UUID):
+        self.redis_client.srem(self.REDIS_NAME_PIPELINE_CANCEL_REQUESTS, ticket_id.hex)
+
+    def free_pipeline_run_files(self, ticket_id: uuid.UUID):
+        """Delete all input and output files of a pipeline run, but keep its definition."""
+        pipeline_status = self.get_pipeline_run_definition(ticket_id)
+        if pipeline_status is None:
+            return
+        self.delete_pipeline_run_files(pipeline_status)
+        self.update_pipeline_run_definition_fields(
+            ticket_id, pipeline_input_file_names={}, pipeline_output_zip_file_name=None
+        )
+
+    def delete_pipeline_run_files(self, pipeline_status: MetaKeggPipelineDef):
+        """Delete the files directory of a pipeline run and release its references to upload blobs."""
+        if pipeline_status.get_files_base_dir().exists():
+            shutil.rmtree(pipeline_status.get_files_base_dir())
+        self.blob_store.release(pipeline_status.ticket.id)
+
     def delete_pipeline_status(self, ticket_id: uuid.UUID):
-        self.redis_client.hdel(self.REDIS_NAME_PIPELINE_STATES, ticket_id.hex)
+        redis_pipe = self.redis_client.pipeline(transaction=True)
+        redis_pipe.delete(self._get_definition_name(ticket_id))
+        redis_pipe.srem(self.REDIS_NAME_PIPELINE_TICKETS, ticket_id.hex)
+        self._stage_output_log_removal(redis_pipe, [ticket_id])
+        self.queue.stage_removal(redis_pipe, [ticket_id])
+        redis_pipe.delete(self._get_lease_name(ticket_id))
+        redis_pipe.hdel(self.REDIS_NAME_PIPELINE_LEASE_HOLDERS, ticket_id.hex)
+        redis_pipe.srem(self.REDIS_NAME_PIPELINE_CANCEL_REQUESTS, ticket_id.hex)
+        redis_pipe.hdel(self.REDIS_NAME_PIPELINE_DURATION_ESTIMATES, ticket_id.hex)
+        redis_pipe.zrem(self.REDIS_NAME_PIPELINE_QUEUE_START_ESTIMATES, ticket_id.hex)
+        redis_pipe.hdel(self.REDIS_NAME_PIPELINE_ANALYSIS_STARTUP_TIMES, ticket_id.hex)
+        redis_pipe.hdel(self.REDIS_NAME_PIPELINE_RESULT_ARCHIVE_STATS, ticket_id.hex)
+        self._stage_pipeline_run_index_removal(redis_pipe, ticket_id)
+        redis_pipe.execute()
+
+    def delete_pipeline_statuses(self, ticket_ids: List[uuid.UUID]):
+        """Delete multiple pipeline definitions with one pipelined Redis round trip."""
+        if not ticket_ids:
+            return
+        redis_pipe = self.redis_client.pipeline(transaction=True)
+        redis_pipe.delete(*[self._get_definition_name(t) for t in ticket_ids])
+        redis_pipe.srem(self.REDIS_NAME_PIPELINE_TICKETS, *[t.hex for t in ticket_ids])
+        self._stage_output_log_removal(redis_pipe, ticket_ids)
+        self.queue.stage_removal(redis_pipe, ticket_ids)
+        redis_pipe.delete(*[self._get_lease_name(t) for t in ticket_ids])
+        redis_pipe.hdel(
+            self.REDIS_NAME_PIPELINE_LEASE_HOLDERS, *[t.hex for t in ticket_ids]
+        )
+        redis_pipe.srem(
+            self.REDIS_NAME_PIPELINE_CANCEL_REQUESTS, *[t.hex for t in ticket_ids]
+        )
+        redis_pipe.hdel(
+            self.REDIS_NAME_PIPELINE_DURATION_ESTIMATES, *[t.hex for t in ticket_ids]
+        )
+        redis_pipe.zrem(
+            self.REDIS_NAME_PIPELINE_QUEUE_START_ESTIMATES, *[t.hex for t in ticket_ids]
+        )
+        redis_pipe.hdel(
+            self.REDIS_NAME_PIPELINE_ANALYSIS_STARTUP_TIMES,
+            *[t.hex for t in ticket_ids],
+        )
+        redis_pipe.hdel(
+            self.REDIS_NAME_PIPELINE_RESULT_ARCHIVE_STATS,
+            *[t.hex for t in ticket_ids],
+        )
+        for ticket_id in ticket_ids:
+            self._stage_pipeline_run_index_removal(redis_pipe, ticket_id)
+        redis_pipe.execute()
+
+    def _get_processing_list_name(self, worker_id: str) -> str:
+        return f"{self.REDIS_NAME_PIPELINE_PROCESSING_PREFIX}:{worker_id}"
 
     def get_next_pipeline_run_from_queue(
-        self, set_status_running: bool = True
+        self,
+        set_status_running: bool = True,
+        worker_id: Optional[str] = None,
+        block_timeout_sec: Optional[float] = None,
     ) -> MetaKeggPipelineDef | None:
-        raw_ticket_id: bytes = self.redis_client.rpop(self.REDIS_NAME_PIPELINE_QUEUE)
-        if raw_ticket_id is None:
+        """Take the next ticket from the queue. Which ticket is next is decided by the fair scheduler of `MetaKeggPipelineQueue`.
+        If a `worker_id` is provided, the ticket is moved atomically into the processing list of the worker and stays there until
+        `acknowledge_pipeline_run_processed` is called. If `block_timeout_sec` is provided too, this blocks until a ticket
+        arrives or the timeout passes.
+        """
+        processing_list_name = (
+            self._get_processing_list_name(worker_id) if worker_id is not None else None
+        )
+        next_ticket_id = self.queue.dequeue(processing_list_name)
+        if next_ticket_id is None and block_timeout_sec is not None:
+            self.queue.wait_for_ticket(block_timeout_sec)
+            next_ticket_id = self.queue.dequeue(processing_list_name)
+        if next_ticket_id is None:
             return None
-        raw_ticket_id = raw_ticket_id.decode("utf-8")
         # print(
         #    "TODO: FIX THIS. Failes in test and shows that backgroudn worker is not terminated properly"
         # ) # update: can not reproduce failed termination of background worker. keep eye on.
 
         log.info(
-            f"Pick up next pipeline-run with id '{raw_ticket_id}' from queue to be processed..."
+            f"Pick up next pipeline-run with id '{next_ticket_id}' from queue to be processed..."
         )
-        next_ticket_id = uuid.UUID(raw_ticket_id)
         pipeline_status = self.get_pipeline_run_definition(next_ticket_id)
         if set_status_running:
+            # the lease must exist before the state is `running`, otherwise the recovery sweep could requeue the ticket right away.
+            self.acquire_pipeline_run_lease(next_ticket_id, worker_id=worker_id)
             pipeline_status.state = "running"
             pipeline_status.started_at_utc = datetime.datetime.now(
                 tz=datetime.timezone.utc
             )
-            self.set_pipeline_run_definition(pipeline_status)
+            pipeline_status.run_attempts += 1
+            self.update_pipeline_run_definition_fields(
+                next_ticket_id,
+                state=pipeline_status.state,
+                started_at_utc=pipeline_status.started_at_utc,
+                run_attempts=pipeline_status.run_attempts,
+            )
+        self.refresh_queue_start_estimates()
         return pipeline_status
 
-    def get_next_pipeline_that_is_expired(
-        self, set_status_expired: bool = True
-    ) -> MetaKeggPipelineDef | None:
-        all_pipeline_states_json_raw: Dict[str, str] = self.redis_client.hgetall(
-            self.REDIS_NAME_PIPELINE_STATES
+    def acknowledge_pipeline_run_processed(self, worker_id: str, ticket_id: uuid.UUID):
+        self.redis_client.lrem(
+            self._get_processing_list_name(worker_id), 1, ticket_id.hex
         )
-        for uuid_hex, pipeline_state_json_raw in all_pipeline_states_json_raw.items():
 
-            pipeline_status = MetaKeggPipelineDef.model_validate_json(
-                pipeline_state_json_raw
-            )
+    def requeue_unfinished_pipeline_runs_of_worker(
+        self, worker_id: str
+    ) -> List[uuid.UUID]:
+        """Put tickets that are left in the processing list of a worker (e.g. because the worker died mid-run) back to the head of the queue.
+        Tickets that were already finished are just removed from the processing list.
+        """
+        processing_list_name = self._get_processing_list_name(worker_id)
+        requeued_ticket_ids = []
+        # The processing list is filled from the left, so it is ordered newest to oldest.
+        # Every ticket is put in front of the queue, so the oldest ends up as the very next one to be picked up.
+        for raw_ticket_id in self.redis_client.lrange(processing_list_name, 0, -1):
+            ticket_id = uuid.UUID(raw_ticket_id.decode("utf-8"))
+            fields = self.get_pipeline_run_definition_fields(ticket_id, ["state"])
             if (
-                self.is_pipeline_run_expired(pipeline_status)
-                and pipeline_status.state != "expired"
+                fields is not None
+                and fields["state"] in ["queued", "running"]
+                and self._requeue_pipeline_run(
+                    ticket_id, reason=f"it was not finished by worker '{worker_id}'"
+                )
             ):
-                if set_status_expired:
-                    pipeline_status.state = "expired"
-                    self.set_pipeline_run_definition(pipeline_status)
-                return pipeline_status
-        return None
+                requeued_ticket_ids.append(ticket_id)
+            # remove it only after it is back in the queue. Requeueing the same ticket twice is harmless.
+            self.redis_client.lrem(processing_list_name, 1, raw_ticket_id)
+        return requeued_ticket_ids
 
-    def get_next_pipeline_that_is_deletable(self) -> MetaKeggPipelineDef | None:
-        all_pipeline_states_json_raw: Dict[str, str] = self.redis_client.hgetall(
-            self.REDIS_NAME_PIPELINE_STATES
+    def _requeue_pipeline_run(self, ticket_id: uuid.UUID, reason: str) -> bool:
+        """Put an interrupted pipeline run back to the head of the queue.
+        If it already was started `config.PIPELINE_RUN_MAX_ATTEMPTS` times, it is marked as `failed` instead.
+        Returns True if the pipeline run was requeued.
+        """
+        run_attempts = self.get_pipeline_run_definition_fields(
+            ticket_id, ["run_attempts"]
+        )["run_attempts"]
+        self.release_pipeline_run_lease(ticket_id)
+        if self.is_pipeline_run_cancel_requested(ticket_id):
+            # the user does not want this pipeline run anymore. no need to run it again.
+            self._set_pipeline_run_as_canceled(ticket_id)
+            return False
+        if run_attempts >= config.PIPELINE_RUN_MAX_ATTEMPTS:
+            log.error(
+                f"Pipeline-run with id '{ticket_id}' was interrupted because {reason}. Giving up after {run_attempts} attempts."
+            )
+            self.update_pipeline_run_definition_fields(
+                ticket_id,
+                error=f"Pipeline run was interrupted {run_attempts} times. The last time because {reason}. Please contact the admin if this keeps happening.",
+            )
+            self.set_pipeline_state_as_finished(ticket_id)
+            return False
+        log.warning(
+            f"Pipeline-run with id '{ticket_id}' was interrupted because {reason}. Put it back into the queue."
+        )
+        self.update_pipeline_run_definition_fields(
+            ticket_id, state="queued", started_at_utc=None
+        )
+        self.queue.enqueue_at_head(ticket_id)
+        self.refresh_queue_start_estimates()
+        return True
+
+    def requeue_pipeline_run_of_stopping_worker(
+        self, worker_id: str, ticket_id: uuid.UUID
+    ) -> bool:
+        """Put a pipeline run back to the head of the queue that was aborted on purpose, because its worker is shutting down.
+        This does not count as a failed attempt. Returns True if the pipeline run was requeued.
+        """
+        run_attempts = self.get_pipeline_run_definition_fields(
+            ticket_id, ["run_attempts"]
+        )["run_attempts"]
+        self.update_pipeline_run_definition_fields(
+            ticket_id, run_attempts=max(run_attempts - 1, 0)
+        )
+        requeued = self._requeue_pipeline_run(
+            ticket_id, reason=f"worker '{worker_id}' is shutting down"
+        )
+        # only now the ticket can be removed from the processing list. If the worker dies before, it will be requeued on the next start anyway.
+        self.acknowledge_pipeline_run_processed(worker_id, ticket_id)
+        return requeued
+
+    def _get_lease_name(self, ticket_id: uuid.UUID) -> str:
+        return f"{self.REDIS_NAME_PIPELINE_LEASE_PREFIX}:{ticket_id.hex}"
+
+    def acquire_pipeline_run_lease(
+        self, ticket_id: uuid.UUID, worker_id: Optional[str] = None
+    ):
+        redis_pipe = self.redis_client.pipeline(transaction=True)
+        redis_pipe.set(
+            self._get_lease_name(ticket_id),
+            worker_id or "",
+            ex=config.PIPELINE_RUN_LEASE_TTL_SEC,
+        )
+        redis_pipe.hset(
+            self.REDIS_NAME_PIPELINE_LEASE_HOLDERS, ticket_id.hex, worker_id or ""
+        )
+        redis_pipe.execute()
+
+    def refresh_pipeline_run_lease(self, ticket_id: uuid.UUID) -> bool:
+        """Extend the lease of a running pipeline run. Returns False if the lease already lapsed."""
+        return bool(
+            self.redis_client.expire(
+                self._get_lease_name(ticket_id), config.PIPELINE_RUN_LEASE_TTL_SEC
+            )
+        )
+
+    def release_pipeline_run_lease(self, ticket_id: uuid.UUID):
+        redis_pipe = self.redis_client.pipeline(transaction=True)
+        redis_pipe.delete(self._get_lease_name(ticket_id))
+        redis_pipe.hdel(self.REDIS_NAME_PIPELINE_LEASE_HOLDERS, ticket_id.hex)
+        redis_pipe.execute()
+
+    def recover_pipeline_runs_with_lapsed_lease(self) -> List[uuid.UUID]:
+        """Requeue (or fail, see `_requeue_pipeline_run`) all `running` pipeline runs whose lease lapsed.
+        Returns the ticket ids of the requeued pipeline runs."""
+        running_ticket_ids = [
+            uuid.UUID(raw.decode("utf-8"))
+            for raw in self.redis_client.smembers(self._get_state_index_name("running"))
+        ]
+        if not running_ticket_ids:
+            return []
+        redis_pipe = self.redis_client.pipeline(transaction=False)
+        for ticket_id in running_ticket_ids:
+            redis_pipe.exists(self._get_lease_name(ticket_id))
+            redis_pipe.hget(self.REDIS_NAME_PIPELINE_LEASE_HOLDERS, ticket_id.hex)
+        results = redis_pipe.execute()
+        requeued_ticket_ids = []
+        for index, ticket_id in enumerate(running_ticket_ids):
+            lease_exists, raw_worker_id = results[index * 2], results[index * 2 + 1]
+            if lease_exists:
+                continue
+            worker_id = raw_worker_id.decode("utf-8") if raw_worker_id else None
+            if worker_id and not self.redis_client.lrem(
+                self._get_processing_list_name(worker_id), 1, ticket_id.hex
+            ):
+                # the ticket is not in the processing list of its worker anymore. A restarted worker already requeued it.
+                continue
+            if self._requeue_pipeline_run(
+                ticket_id,
+                reason=f"the lease of worker '{worker_id}' lapsed",
+            ):
+                requeued_ticket_ids.append(ticket_id)
+        return requeued_ticket_ids
+
+    def set_worker_heartbeat(self, worker_id: str):
+        self.redis_client.hset(
+            self.REDIS_NAME_PIPELINE_WORKER_HEARTBEATS,
+            worker_id,
+            datetime.datetime.now(tz=datetime.timezone.utc).timestamp(),
+        )
+
+    def remove_worker_heartbeat(self, worker_id: str):
+        self.redis_client.hdel(self.REDIS_NAME_PIPELINE_WORKER_HEARTBEATS, worker_id)
+
+    def get_worker_heartbeats(self) -> Dict[str, datetime.datetime]:
+        """Returns the time of the last heartbeat per worker id, including workers without a recent heartbeat (see `is_worker_alive`)."""
+        return {
+            raw_worker_id.decode("utf-8"): datetime.datetime.fromtimestamp(
+                float(raw_timestamp), tz=datetime.timezone.utc
+            )
+            for raw_worker_id, raw_timestamp in self.redis_client.hgetall(
+                self.REDIS_NAME_PIPELINE_WORKER_HEARTBEATS
+            ).items()
+        }
+
+    def is_worker_alive(self, last_heartbeat: datetime.datetime) -> bool:
+        return (
+            datetime.datetime.now(tz=datetime.timezone.utc) - last_heartbeat
+        ).total_seconds() < config.PIPELINE_WORKER_HEARTBEAT_TIMEOUT_SEC
+
+    def get_alive_worker_count(self) -> int:
+        return len(
+            [
+                last_heartbeat
+                for last_heartbeat in self.get_worker_heartbeats().values()
+                if self.is_worker_alive(last_heartbeat)
+            ]
+        )
+
+    def remove_gone_worker_heartbeats(self) -> List[str]:
+        """Remove the heartbeats of workers without a heartbeat for `config.PIPELINE_WORKER_FORGET_AFTER_SEC`.
+        A worker that was killed without a graceful shutdown can not remove its heartbeat itself, and its replacement may get another worker id.
+        Returns the ids of the removed workers.
+        """
+        now = datetime.datetime.now(tz=datetime.timezone.utc)
+        gone_worker_ids = [
+            worker_id
+            for worker_id, last_heartbeat in self.get_worker_heartbeats().items()
+            if (now - last_heartbeat).total_seconds()
+            > config.PIPELINE_WORKER_FORGET_AFTER_SEC
+        ]
+        if gone_worker_ids:
+            self.redis_client.hdel(
+                self.REDIS_NAME_PIPELINE_WORKER_HEARTBEATS, *gone_worker_ids
+            )
+        return gone_worker_ids
+
+    def get_pipeline_run_duration_estimator(
+        self,
+    ) -> MetaKeggPipelineRunDurationEstimator:
+        raw_datapoints = self.redis_client.lrange(
+            self.REDIS_NAME_PIPELINE_STATISTICS,
+            -self.PIPELINE_RUN_DURATION_ESTIMATE_SAMPLE_SIZE,
+            -1,
+        )
+        return MetaKeggPipelineRunDurationEstimator(
+            [
+                MetaKeggPipelineStatisticPoint.model_validate_json(raw)
+                for raw in raw_datapoints
+            ],
+            default_duration_sec=config.PIPELINE_RUN_DEFAULT_DURATION_ESTIMATE_SEC,
+        )
+
+    def _get_estimated_durations_sec(self, ticket_ids: List[uuid.UUID]) -> List[float]:
+        if not ticket_ids:
+            return []
+        raw_durations = self.redis_client.hmget(
+            self.REDIS_NAME_PIPELINE_DURATION_ESTIMATES, [t.hex for t in ticket_ids]
+        )
+        fallback_duration_sec: Optional[float] = None
+        if any(raw is None for raw in raw_durations):
+            # pipeline runs queued before estimates existed
+            fallback_duration_sec = (
+                self.get_pipeline_run_duration_estimator().estimate_duration_sec()
+            )
+        return [
+            float(raw) if raw is not None else fallback_duration_sec
+            for raw in raw_durations
+        ]
+
+    def _estimate_queue_start_offsets_sec(
+        self, queued_ticket_ids: List[uuid.UUID]
+    ) -> List[float]:
+        """Estimated start times (seconds from now) of `queued_ticket_ids` in queue order.
+        The additional last entry is the estimated start of a pipeline run that would be queued right now.
+        """
+        running_ticket_ids = [
+            uuid.UUID(raw.decode("utf-8"))
+            for raw in self.redis_client.smembers(self._get_state_index_name("running"))
+        ]
+        now = datetime.datetime.now(tz=datetime.timezone.utc)
+        running_remaining_sec: List[float] = []
+        for ticket_id, duration_sec in zip(
+            running_ticket_ids, self._get_estimated_durations_sec(running_ticket_ids)
+        ):
+            fields = self.get_pipeline_run_definition_fields(
+                ticket_id, ["started_at_utc"]
+            )
+            if fields is None or fields["started_at_utc"] is None:
+                continue
+            elapsed_sec = (now - fields["started_at_utc"]).total_seconds()
+            running_remaining_sec.append(max(duration_sec - elapsed_sec, 0.0))
+        # if no worker reports a heartbeat right now (e.g. they are restarting), assume one.
+        return estimate_start_offsets_sec(
+            worker_count=max(self.get_alive_worker_count(), 1),
+            running_remaining_sec=running_remaining_sec,
+            queued_durations_sec=self._get_estimated_durations_sec(queued_ticket_ids)
+            + [0.0],
+        )
+
+    def refresh_queue_start_estimates(self) -> float:
+        """Estimate the start of every queued pipeline run and store it (see `REDIS_NAME_PIPELINE_QUEUE_START_ESTIMATES`).
+        Returns the estimated seconds until a pipeline run that is queued now will be started.
+        """
+        queued_ticket_ids = self.queue.get_ticket_ids()
+        start_offsets_sec = self._estimate_queue_start_offsets_sec(queued_ticket_ids)
+        now_timestamp = datetime.datetime.now(tz=datetime.timezone.utc).timestamp()
+        # Concurrent refreshes may store a slightly outdated result. It is corrected by the next queue change or housekeeping tick.
+        redis_pipe = self.redis_client.pipeline(transaction=True)
+        redis_pipe.delete(self.REDIS_NAME_PIPELINE_QUEUE_START_ESTIMATES)
+        if queued_ticket_ids:
+            redis_pipe.zadd(
+                self.REDIS_NAME_PIPELINE_QUEUE_START_ESTIMATES,
+                {
+                    ticket_id.hex: now_timestamp + start_offset_sec
+                    for ticket_id, start_offset_sec in zip(
+                        queued_ticket_ids, start_offsets_sec
+                    )
+                },
+            )
+        redis_pipe.set(
+            self.REDIS_NAME_PIPELINE_QUEUE_NEXT_START_ESTIMATE,
+            now_timestamp + start_offsets_sec[-1],
         )
-        for uuid_hex, pipeline_state_json_raw in all_pipeline_states_json_raw.items():
-            pipeline_status = MetaKeggPipelineDef.model_validate_json(
-                pipeline_state_json_raw
+        redis_pipe.execute()
+        return start_offsets_sec[-1]
+
+    def _set_pipeline_run_time_estimates(self, pipeline_status: MetaKeggPipelineDef):
+        now = datetime.datetime.now(tz=datetime.timezone.utc)
+        if pipeline_status.state == "running" and pipeline_status.started_at_utc:
+            pipeline_status.estimated_start_at_utc = pipeline_status.started_at_utc
+        elif (
+            pipeline_status.state == "queued"
+            and pipeline_status.place_in_queue is not None
+        ):
+            raw_start_timestamp = self.redis_client.zscore(
+                self.REDIS_NAME_PIPELINE_QUEUE_START_ESTIMATES,
+                pipeline_status.ticket.id.hex,
+            )
+            if raw_start_timestamp is None:
+                # queued after the last refresh
+                raw_start_timestamp = self.redis_client.get(
+                    self.REDIS_NAME_PIPELINE_QUEUE_NEXT_START_ESTIMATE
+                )
+            if raw_start_timestamp is None:
+                return
+            # an overdue pipeline run is expected to start any moment
+            pipeline_status.estimated_start_at_utc = max(
+                datetime.datetime.fromtimestamp(
+                    float(raw_start_timestamp), tz=datetime.timezone.utc
+                ),
+                now,
             )
-            if self.is_pipeline_run_deletable(pipeline_status):
-                return pipeline_status
-        return None
+        else:
+            return
+        estimated_finish_at_utc = pipeline_status.estimated_start_at_utc + (
+            datetime.timedelta(
+                seconds=self._get_estimated_durations_sec([pipeline_status.ticket.id])[
+                    0
+                ]
+            )
+        )
+        # an overdue pipeline run is expected to finish any moment
+        pipeline_status.estimated_finish_at_utc = max(estimated_finish_at_utc, now)
+
+    def get_estimated_queue_wait_sec(self) -> float:
+        """Estimated time until a pipeline run that is queued now will be started, based on the recent running times and the number of workers."""
+        raw_start_timestamp = self.redis_client.get(
+            self.REDIS_NAME_PIPELINE_QUEUE_NEXT_START_ESTIMATE
+        )
+        if raw_start_timestamp is None:
+            return self.refresh_queue_start_estimates()
+        return max(
+            float(raw_start_timestamp)
+            - datetime.datetime.now(tz=datetime.timezone.utc).timestamp(),
+            0.0,
+        )
+
+    def get_pipeline_run_admission_retry_after_sec(self) -> Optional[int]:
+        """Admission control: Check if the queue can take another pipeline run
+        (`config.PIPELINE_QUEUE_MAX_LENGTH` and `config.PIPELINE_QUEUE_MAX_ESTIMATED_WAIT_SEC`).
+        Returns None if the pipeline run is admitted. Otherwise the estimated seconds until the queue has drained enough to try again.
+        """
+        if (
+            config.PIPELINE_QUEUE_MAX_LENGTH is None
+            and config.PIPELINE_QUEUE_MAX_ESTIMATED_WAIT_SEC is None
+        ):
+            return None
+        # Only reads the precomputed estimates (see `refresh_queue_start_estimates`), as this runs on every upload request.
+        queue_length = self.queue.get_length()
+        estimated_wait_sec = self.get_estimated_queue_wait_sec()
+        retry_after_sec: Optional[float] = None
+        if (
+            config.PIPELINE_QUEUE_MAX_LENGTH is not None
+            and queue_length >= config.PIPELINE_QUEUE_MAX_LENGTH
+        ):
+            # the queue is below the limit again, when this pipeline run is started
+            start_estimate = self.redis_client.zrange(
+                self.REDIS_NAME_PIPELINE_QUEUE_START_ESTIMATES,
+                queue_length - config.PIPELINE_QUEUE_MAX_LENGTH,
+                queue_length - config.PIPELINE_QUEUE_MAX_LENGTH,
+                withscores=True,
+            )
+            retry_after_sec = (
+                max(
+                    start_estimate[0][1]
+                    - datetime.datetime.now(tz=datetime.timezone.utc).timestamp(),
+                    0.0,
+                )
+                if start_estimate
+                # the estimates are older than the last enqueue
+                else estimated_wait_sec
+            )
+        if (
+            config.PIPELINE_QUEUE_MAX_ESTIMATED_WAIT_SEC is not None
+            and estimated_wait_sec > config.PIPELINE_QUEUE_MAX_ESTIMATED_WAIT_SEC
+        ):
+            retry_after_sec = max(
+                retry_after_sec or 0.0,
+                estimated_wait_sec - config.PIPELINE_QUEUE_MAX_ESTIMATED_WAIT_SEC,
+            )
+        if retry_after_sec is None:
+            return None
+        return max(int(math.ceil(retry_after_sec)), 1)
+
+    def get_next_pipeline_that_is_expired(
+        self, set_status_expired: bool = True
+    ) -> MetaKeggPipelineDef | None:
+        pipeline_states = self.get_pipelines_that_are_expired(limit=1)
+        if not pipeline_states:
+            return None
+        pipeline_status = pipeline_states[0]
+        if set_status_expired:
+            pipeline_status.state = "expired"
+            self.update_pipeline_run_definition_fields(
+                pipeline_status.ticket.id, state="expired"
+            )
+        return pipeline_status
+
+    def get_next_pipeline_that_is_deletable(self) -> MetaKeggPipelineDef | None:
+        pipeline_states = self.get_pipelines_that_are_deletable(limit=1)
+        return pipeline_states[0] if pipeline_states else None
 
     def get_next_pipeline_that_is_abandoned(
         self,
     ) -> MetaKeggPipelineDef | None:
-        all_pipeline_states_json_raw: Dict[str, str] = self.redis_client.hgetall(
-            self.REDIS_NAME_PIPELINE_STATES
-        )
-        for uuid_hex, pipeline_state_json_raw in all_pipeline_states_json_raw.items():
-            pipeline_status = MetaKeggPipelineDef.model_validate_json(
-                pipeline_state_json_raw
+        pipeline_states = self.get_pipelines_that_are_abandoned(limit=1)
+        return pipeline_states[0] if pipeline_states else None
+
+    def get_pipelines_that_are_expired(
+        self, limit: Optional[int] = None
+    ) -> List[MetaKeggPipelineDef]:
+        return [
+            pipeline_status
+            for pipeline_status in self._get_indexed_pipeline_run_definitions(
+                self._get_due_ticket_ids(
+                    self.REDIS_NAME_PIPELINE_EXPIRE_DEADLINES, limit=limit
+                )
             )
-            if self.is_pipeline_run_definition_abandoned(pipeline_status):
-                return pipeline_status
-        return None
+            if self.is_pipeline_run_expired(pipeline_status)
+            and pipeline_status.state != "expired"
+        ]
 
-    def is_pipeline_run_expired(self, pipeline_status: MetaKeggPipelineDef):
-        if pipeline_status.finished_at_utc is None:
+    def set_pipeline_runs_expired(
+        self, ticket_ids: List[uuid.UUID]
+    ) -> List[MetaKeggPipelineDef]:
+        """Set the state of pipeline runs that are (still) expired to `expired` and drop the references to their files.
+        Only these fields are written. The definitions are watched from reading to writing, if one of them changes in between
+        (e.g. the pipeline run was requeued) all are read and checked again.
+        Returns the pipeline runs that were set to `expired`. Their files can be deleted afterwards.
+        """
+        if not ticket_ids:
+            return []
+        expired_fields = {
+            "state": "expired",
+            # a "deleted" marker behind the input filename list
+            "pipeline_input_file_names": {},
+            "pipeline_output_zip_file_name": None,
+        }
+        with self.redis_client.pipeline(transaction=True) as redis_pipe:
+            while True:
+                try:
+                    redis_pipe.watch(
+                        *[self._get_definition_name(t) for t in ticket_ids]
+                    )
+                    # read with another connection in one round trip, changes from here on still fail the transaction
+                    pipeline_states = [
+                        pipeline_status
+                        for pipeline_status in self._get_indexed_pipeline_run_definitions(
+                            ticket_ids
+                        )
+                        if self.is_pipeline_run_expired(pipeline_status)
+                        and pipeline_status.state != "expired"
+                    ]
+                    redis_pipe.multi()
+                    for pipeline_status in pipeline_states:
+                        self._stage_pipeline_run_definition_fields_update(
+                            redis_pipe,
+                            pipeline_status.ticket.id,
+                            {
+                                "created_at_utc": pipeline_status.created_at_utc,
+                                "finished_at_utc": pipeline_status.finished_at_utc,
+                            },
+                            expired_fields,
+                        )
+                        for field_name, value in expired_fields.items():
+                            setattr(pipeline_status, field_name, value)
+                    redis_pipe.execute()
+                    return pipeline_states
+                except redis.WatchError:
+                    continue
+
+    def get_pipelines_that_are_deletable(
+        self, limit: Optional[int] = None
+    ) -> List[MetaKeggPipelineDef]:
+        return [
+            pipeline_status
+            for pipeline_status in self._get_indexed_pipeline_run_definitions(
+                self._get_due_ticket_ids(
+                    self.REDIS_NAME_PIPELINE_DELETE_DEADLINES, limit=limit
+                )
+            )
+            if self.is_pipeline_run_deletable(pipeline_status)
+        ]
+
+    def get_pipelines_that_are_abandoned(
+        self, limit: Optional[int] = None
+    ) -> List[MetaKeggPipelineDef]:
+        return [
+            pipeline_status
+            for pipeline_status in self._get_indexed_pipeline_run_definitions(
+                self._get_due_ticket_ids(
+                    self.REDIS_NAME_PIPELINE_ABANDON_DEADLINES, limit=limit
+                )
+            )
+            if self.is_pipeline_run_definition_abandoned(pipeline_status)
+        ]
+
+    def _get_indexed_pipeline_run_definitions(
+        self, ticket_ids: List[uuid.UUID]
+    ) -> List[MetaKeggPipelineDef]:
+        """Load multiple pipeline definitions referenced by an index in one round trip.
+        Definitions that do not exist anymore will be skipped and their stale index entries removed.
+        """
+        if not ticket_ids:
+            return []
+        redis_pipe = self.redis_client.pipeline(transaction=False)
+        for ticket_id in ticket_ids:
+            redis_pipe.hgetall(self._get_definition_name(ticket_id))
+        result = []
+        stale_ticket_ids = []
+        for ticket_id, raw_fields in zip(ticket_ids, redis_pipe.execute()):
+            definition = self._deserialize_pipeline_run_definition(raw_fields)
+            if definition is None:
+                stale_ticket_ids.append(ticket_id)
+                continue
+            result.append(definition)
+        if stale_ticket_ids:
+            redis_pipe = self.redis_client.pipeline(transaction=True)
+            for ticket_id in stale_ticket_ids:
+                redis_pipe.srem(self.REDIS_NAME_PIPELINE_TICKETS, ticket_id.hex)
+                self._stage_pipeline_run_index_removal(redis_pipe, ticket_id)
+            redis_pipe.execute()
+        return result
+
+    def _calc_expire_datetime(
+        self, finished_at_utc: Optional[datetime.datetime]
+    ) -> datetime.datetime | None:
+        if finished_at_utc is None:
             # only finished pipeline run can expire.
-            return False
-        expire_datetime = pipeline_status.finished_at_utc + datetime.timedelta(
+            return None
+        return finished_at_utc + datetime.timedelta(
             minutes=config.PIPELINE_RESULT_EXPIRED_AFTER_MIN
         )
+
+    def _calc_delete_datetime(
+        self, finished_at_utc: Optional[datetime.datetime]
+    ) -> datetime.datetime | None:
+        expire_datetime = self._calc_expire_datetime(finished_at_utc)
+        if expire_datetime is None:
+            return None
+        return expire_datetime + datetime.timedelta(
+            minutes=config.PIPELINE_RESULT_DELETED_AFTER_MIN
+        )
+
+    def _calc_abandon_datetime(
+        self, state: MetaKeggPipelineDefStates, created_at_utc: datetime.datetime
+    ) -> datetime.datetime | None:
+        if state != "initialized":
+            # only pipeline runs with state initialized can be "abandoned".
+            return None
+        return created_at_utc + datetime.timedelta(
+            minutes=config.PIPELINE_ABANDONED_DEFINITION_DELETED_AFTER
+        )
+
+    def get_pipeline_run_expire_datetime(
+        self, pipeline_status: MetaKeggPipelineDef
+    ) -> datetime.datetime | None:
+        return self._calc_expire_datetime(pipeline_status.finished_at_utc)
+
+    def get_pipeline_run_delete_datetime(
+        self, pipeline_status: MetaKeggPipelineDef
+    ) -> datetime.datetime | None:
+        return self._calc_delete_datetime(pipeline_status.finished_at_utc)
+
+    def get_pipeline_run_abandon_datetime(
+        self, pipeline_status: MetaKeggPipelineDef
+    ) -> datetime.datetime | None:
+        return self._calc_abandon_datetime(
+            pipeline_status.state, pipeline_status.created_at_utc
+        )
+
+    def is_pipeline_run_expired(self, pipeline_status: MetaKeggPipelineDef):
+        expire_datetime = self.get_pipeline_run_expire_datetime(pipeline_status)
+        if expire_datetime is None:
+            return False
         if expire_datetime < datetime.datetime.now(tz=datetime.timezone.utc):
             return True
         return False
 
     def is_pipeline_run_deletable(self, pipeline_status: MetaKeggPipelineDef):
-        if pipeline_status.finished_at_utc is None:
-            # only finished pipeline run can expire.
+        deleteable_datetime = self.get_pipeline_run_delete_datetime(pipeline_status)
+        if deleteable_datetime is None:
             return False
-        expire_datetime = pipeline_status.finished_at_utc + datetime.timedelta(
-            minutes=config.PIPELINE_RESULT_EXPIRED_AFTER_MIN
-        )
-        deleteable_datetime = expire_datetime + datetime.timedelta(
-            minutes=config.PIPELINE_RESULT_DELETED_AFTER_MIN
-        )
         if deleteable_datetime < datetime.datetime.now(tz=datetime.timezone.utc):
             return True
         return False
@@ -503,15 +1723,18 @@ class MetaKeggPipelineStateManager:
     def is_pipeline_run_definition_abandoned(
         self, pipeline_status: MetaKeggPipelineDef
     ):
-        if pipeline_status.state != "initialized":
-            # only pipeline runs with state initialized can be "abandoned".
+        abandoned_datetime = self.get_pipeline_run_abandon_datetime(pipeline_status)
+        if abandoned_datetime is None:
             return False
-        abandoned_datetime = pipeline_status.created_at_utc + datetime.timedelta(
-            minutes=config.PIPELINE_ABANDONED_DEFINITION_DELETED_AFTER
-        )
         if abandoned_datetime < datetime.datetime.now(tz=datetime.timezone.utc):
             return True
         return False
 
     def get_cache_usage_size_bytes(self) -> int:
-        return get_directory_size_bytes(Path(config.PIPELINE_RUNS_CACHE_DIR))
+        # input files are hard links to shared upload blobs. Count every blob once.
+        return get_disk_usage_bytes(
+            [
+                Path(config.PIPELINE_RUNS_CACHE_DIR),
+                Path(config.PIPELINE_UPLOAD_BLOB_DIR),
+            ]
+        )
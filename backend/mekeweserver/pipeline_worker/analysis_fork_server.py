@@ -0,0 +1,23 @@
+import multiprocessing
+import multiprocessing.context
+import multiprocessing.forkserver
+
+
+def get_analysis_process_context() -> multiprocessing.context.ForkServerContext:
+    """The analysis child processes are forked from a fork server and not from the pipeline worker itself.
+    The worker runs threads (heartbeats, lease, pipeline run executor). A child forked from it could inherit locks held by these threads and deadlock.
+    The fork server is single threaded. It imports `analysis_fork_server_init` once, so with `config.PIPELINE_WORKER_PRELOAD_ANALYSIS_MODULES`
+    every analysis child process starts warm.
+    """
+    context = multiprocessing.get_context("forkserver")
+    # only effective until the fork server is started. `__main__` is the default. The child processes import the main module again, its imports are cached this way.
+    context.set_forkserver_preload(
+        ["__main__", "mekeweserver.pipeline_worker.analysis_fork_server_init"]
+    )
+    return context
+
+
+def start_analysis_fork_server():
+    """Start the fork server right away (and not with the first analysis), so the preload does not delay the first pipeline run."""
+    get_analysis_process_context()
+    multiprocessing.forkserver.ensure_running()
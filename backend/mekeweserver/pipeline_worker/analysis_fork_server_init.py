@@ -0,0 +1,13 @@
+"""Imported once by the fork server of the analysis child processes (see `analysis_fork_server.get_analysis_process_context`)."""
+
+import signal
+
+from mekeweserver.pipeline_worker.analysis_preload import preload_analysis_modules
+from mekeweserver.config import Config, get_config
+
+config: Config = get_config()
+
+# Like the analysis child processes, the fork server must survive signals to the whole process group while the worker drains. It exits together with the worker.
+signal.signal(signal.SIGTERM, signal.SIG_IGN)
+if config.PIPELINE_WORKER_PRELOAD_ANALYSIS_MODULES:
+    preload_analysis_modules()
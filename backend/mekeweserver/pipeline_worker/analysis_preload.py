@@ -0,0 +1,48 @@
+import io
+import time
+
+from mekeweserver.log import get_logger
+
+log = get_logger()
+
+# Set in the process that did the preload. Forked children inherit it, together with the already initialised modules.
+_preloaded = False
+
+
+def is_preloaded() -> bool:
+    return _preloaded
+
+
+def preload_analysis_modules() -> float:
+    """Import and initialise the heavy dependencies of a metaKEGG analysis (pandas, matplotlib, Biopython, reportlab, openpyxl).
+    The fork server of the analysis child processes calls this on start and acts as a template process: Every analysis child process is forked from it
+    and starts warm instead of paying the import and initialisation costs again.
+    Returns the time the preload took in seconds.
+    """
+    global _preloaded
+    if _preloaded:
+        return 0.0
+    started_at = time.perf_counter()
+    import matplotlib
+
+    # metaKEGG only writes files. No GUI backend needed.
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+    from matplotlib import font_manager
+
+    # Loads the font cache (or builds it, if it does not exist yet)
+    font_manager.findfont(font_manager.FontProperties())
+    # The first rendered figure initialises the text rendering. Render a tiny one.
+    figure = plt.figure(figsize=(1, 1))
+    figure.text(0.5, 0.5, "metaKEGG")
+    figure.savefig(io.BytesIO(), format="png")
+    plt.close(figure)
+    import pandas
+    import openpyxl
+    import reportlab.pdfgen.canvas
+    import Bio.KEGG.REST
+    import Bio.Graphics.KGML_vis
+    from metaKEGG.modules.pipeline_async import PipelineAsync
+
+    _preloaded = True
+    return time.perf_counter() - started_at
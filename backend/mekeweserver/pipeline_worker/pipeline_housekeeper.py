@@ -0,0 +1,254 @@
+from typing import List, Dict, Callable
+from multiprocessing import Process, Event
+from concurrent.futures import ThreadPoolExecutor
+import shutil
+import os
+import time
+import datetime
+from pathlib import Path
+import uuid
+import socket
+
+import redis
+
+from mekeweserver.pipeline_status_clerk import MetaKeggPipelineStateManager
+from mekeweserver.model import MetaKeggPipelineDef, MetaKeggHousekeepingTaskRun
+from mekeweserver.db import get_redis_client
+
+from mekeweserver.log import get_logger
+from mekeweserver.config import Config, get_config
+
+config: Config = get_config()
+log = get_logger()
+
+
+class PipelineHousekeeper(Process):
+    """Runs the housekeeping tasks (expire/delete old pipeline runs, clean up files, ...) each on its own interval.
+    It runs in its own process, so housekeeping goes on while the workers are busy with long pipeline runs.
+    """
+
+    # Per task lock. It is not released after the task ran but expires after the task interval.
+    # This way a task runs once per interval, even if there are multiple housekeepers (e.g. on multiple worker nodes).
+    TASK_LOCK_REDIS_KEY_PREFIX = "METAKEGG_HOUSEKEEPING_LOCK"
+    # hash task name -> json of the MetaKeggHousekeepingTaskRun of the last run
+    TASK_RUNS_REDIS_KEY = "METAKEGG_HOUSEKEEPING_TASK_RUNS"
+
+    def __init__(self, env: Dict = None, housekeeper_id: str = None):
+        Process.__init__(self)
+        self.stop_event = Event()
+        self.env = env
+        self.housekeeper_id = (
+            housekeeper_id if housekeeper_id is not None else socket.gethostname()
+        )
+
+    def get_tasks(self) -> Dict[str, tuple[Callable, float]]:
+        return {
+            "recover_interrupted_pipelines": (
+                self._recover_interrupted_pipelines,
+                config.PIPELINE_HOUSEKEEPING_RECOVER_INTERRUPTED_RUNS_INTERVAL_SEC,
+            ),
+            "process_expiring_pipelines": (
+                self._process_expiring_pipelines,
+                config.PIPELINE_HOUSEKEEPING_EXPIRE_RUNS_INTERVAL_SEC,
+            ),
+            "process_deletable_pipelines": (
+                self._process_deletable_pipelines,
+                config.PIPELINE_HOUSEKEEPING_DELETE_RUNS_INTERVAL_SEC,
+            ),
+            "process_abandoned_pipeline_defs": (
+                self._process_abandoned_pipeline_defs,
+                config.PIPELINE_HOUSEKEEPING_DELETE_ABANDONED_RUNS_INTERVAL_SEC,
+            ),
+            "clean_zombie_files": (
+                self._clean_zombie_files,
+                config.PIPELINE_HOUSEKEEPING_CLEAN_ZOMBIE_FILES_INTERVAL_SEC,
+            ),
+            "purge_old_statistics": (
+                self._purge_old_statistics,
+                config.PIPELINE_HOUSEKEEPING_PURGE_STATISTICS_INTERVAL_SEC,
+            ),
+            "remove_gone_workers": (
+                self._remove_gone_workers,
+                config.PIPELINE_HOUSEKEEPING_REMOVE_GONE_WORKERS_INTERVAL_SEC,
+            ),
+            "refresh_queue_start_estimates": (
+                self._refresh_queue_start_estimates,
+                config.PIPELINE_HOUSEKEEPING_REFRESH_QUEUE_ESTIMATES_INTERVAL_SEC,
+            ),
+        }
+
+    def run(self):
+        if self.env:
+            os.environ = os.environ.copy() | self.env
+        log.info("Started MetaKegg Pipeline Housekeeper")
+        redis_client = get_redis_client(never_start_fakeredis=True)
+        state_manager = MetaKeggPipelineStateManager(redis_client=redis_client)
+        tasks = self.get_tasks()
+        next_run_at: Dict[str, float] = {name: time.monotonic() for name in tasks}
+        while not self.stop_event.is_set():
+            for task_name, (task, interval_sec) in tasks.items():
+                if time.monotonic() < next_run_at[task_name]:
+                    continue
+                next_run_at[task_name] = time.monotonic() + interval_sec
+                try:
+                    if self._acquire_task_lock(redis_client, task_name, interval_sec):
+                        self._run_task(redis_client, state_manager, task_name, task)
+                except redis.RedisError as e:
+                    log.error(e, exc_info=True)
+            self.stop_event.wait(max(min(next_run_at.values()) - time.monotonic(), 0))
+        log.info("Exiting MetaKegg Pipeline Housekeeper.")
+
+    def _acquire_task_lock(
+        self, redis_client: redis.Redis, task_name: str, interval_sec: float
+    ) -> bool:
+        return bool(
+            redis_client.set(
+                f"{self.TASK_LOCK_REDIS_KEY_PREFIX}:{task_name}",
+                self.housekeeper_id,
+                nx=True,
+                ex=max(int(interval_sec), 1),
+            )
+        )
+
+    def _run_task(
+        self,
+        redis_client: redis.Redis,
+        state_manager: MetaKeggPipelineStateManager,
+        task_name: str,
+        task: Callable[[MetaKeggPipelineStateManager], None],
+    ):
+        task_run = MetaKeggHousekeepingTaskRun(
+            task_name=task_name,
+            housekeeper_id=self.housekeeper_id,
+            started_at_utc=datetime.datetime.now(tz=datetime.timezone.utc),
+        )
+        started_at = time.monotonic()
+        try:
+            task(state_manager)
+        except Exception as e:
+            # a failing task must not stop the other tasks
+            log.error(e, exc_info=True)
+            task_run.error = str(e)
+        task_run.duration_sec = time.monotonic() - started_at
+        redis_client.hset(
+            self.TASK_RUNS_REDIS_KEY, task_name, task_run.model_dump_json()
+        )
+
+    @classmethod
+    def get_task_runs(
+        cls, redis_client: redis.Redis
+    ) -> Dict[str, MetaKeggHousekeepingTaskRun]:
+        """Last run of every housekeeping task."""
+        return {
+            raw_task_name.decode(
+                "utf-8"
+            ): MetaKeggHousekeepingTaskRun.model_validate_json(raw_task_run)
+            for raw_task_name, raw_task_run in redis_client.hgetall(
+                cls.TASK_RUNS_REDIS_KEY
+            ).items()
+        }
+
+    def _recover_interrupted_pipelines(
+        self, state_manager: MetaKeggPipelineStateManager
+    ):
+        state_manager.recover_pipeline_runs_with_lapsed_lease()
+
+    def _process_expiring_pipelines(self, state_manager: MetaKeggPipelineStateManager):
+        pipeline_definitions_that_are_expired = (
+            state_manager.get_pipelines_that_are_expired(
+                limit=config.PIPELINE_HOUSEKEEPING_MAX_ITEMS_PER_TICK
+            )
+        )
+        if not pipeline_definitions_that_are_expired:
+            return
+        log.info(
+            f"Set MetaKegg pipeline defintions with ticket ids {[d.ticket.id.hex for d in pipeline_definitions_that_are_expired]} as expired..."
+        )
+        # we first need to set the pipelinestate to expired before deleting anything to prevent race cond.
+        # Only the expiry fields are written and only for pipeline runs that did not change in the meantime (e.g. requeued).
+        pipeline_definitions_that_are_expired = state_manager.set_pipeline_runs_expired(
+            [d.ticket.id for d in pipeline_definitions_that_are_expired]
+        )
+
+        # delete all cached file for these pipelines
+        with ThreadPoolExecutor(
+            max_workers=config.PIPELINE_HOUSEKEEPING_FILE_DELETION_PARALLELISM
+        ) as executor:
+            list(
+                executor.map(
+                    state_manager.delete_pipeline_run_files,
+                    pipeline_definitions_that_are_expired,
+                )
+            )
+
+    def _process_deletable_pipelines(self, state_manager: MetaKeggPipelineStateManager):
+        pipeline_definitions_that_are_deletable = (
+            state_manager.get_pipelines_that_are_deletable(
+                limit=config.PIPELINE_HOUSEKEEPING_MAX_ITEMS_PER_TICK
+            )
+        )
+        if not pipeline_definitions_that_are_deletable:
+            return
+        log.info(
+            f"Delete MetaKegg pipeline defintions with ticket ids {[d.ticket.id.hex for d in pipeline_definitions_that_are_deletable]} because of age..."
+        )
+        state_manager.delete_pipeline_statuses(
+            ticket_ids=[d.ticket.id for d in pipeline_definitions_that_are_deletable]
+        )
+
+    def _process_abandoned_pipeline_defs(
+        self, state_manager: MetaKeggPipelineStateManager
+    ):
+        pipeline_definitions_that_are_abandoned = (
+            state_manager.get_pipelines_that_are_abandoned(
+                limit=config.PIPELINE_HOUSEKEEPING_MAX_ITEMS_PER_TICK
+            )
+        )
+        if not pipeline_definitions_that_are_abandoned:
+            return
+        log.info(
+            f"Delete MetaKegg pipeline defintions with ticket ids {[d.ticket.id.hex for d in pipeline_definitions_that_are_abandoned]} because they are abandoned..."
+        )
+        state_manager.delete_pipeline_statuses(
+            ticket_ids=[d.ticket.id for d in pipeline_definitions_that_are_abandoned]
+        )
+
+    def _purge_old_statistics(self, state_manager: MetaKeggPipelineStateManager):
+        state_manager.remove_expired_pipeline_run_statistic_points()
+
+    def _remove_gone_workers(self, state_manager: MetaKeggPipelineStateManager):
+        gone_worker_ids = state_manager.remove_gone_worker_heartbeats()
+        if gone_worker_ids:
+            log.info(
+                f"Removed heartbeats of pipeline workers {gone_worker_ids}, which are gone."
+            )
+
+    def _refresh_queue_start_estimates(
+        self, state_manager: MetaKeggPipelineStateManager
+    ):
+        # running pipeline runs progress and workers come and go, without the queue changing
+        state_manager.refresh_queue_start_estimates()
+
+    def _clean_zombie_files(self, state_manager: MetaKeggPipelineStateManager):
+        cache_dir = Path(config.PIPELINE_RUNS_CACHE_DIR)
+        all_pipeline_definition_ids: List[uuid.UUID] = (
+            state_manager.get_all_pipeline_run_ticket_ids()
+        )
+        state_manager.blob_store.remove_orphaned_blobs()
+        if not cache_dir.exists():
+            return
+        for path_obj in cache_dir.iterdir():
+            if path_obj.is_dir():
+                try:
+                    directory_ticket_id = uuid.UUID(path_obj.name)
+                except ValueError:
+                    # this is not a uuid named directory. Maybe a directory we dont have to do anything with
+                    log.warning(
+                        f"There seems to be a non standard directory in the cache dir at {path_obj.resolve()}."
+                    )
+                    continue
+                if directory_ticket_id not in all_pipeline_definition_ids:
+                    # we got a zombie, sir!
+                    log.warning(f"Delete zombie directory at {path_obj.resolve()}")
+                    shutil.rmtree(path_obj)
+                    state_manager.blob_store.release(directory_ticket_id)
@@ -1,57 +1,180 @@
 import sys
 import time
 import logging
+import threading
 import redis
 from io import TextIOBase
-from typing import Callable
+from typing import Callable, List, Optional
 import uuid
+from pathlib import Path
 
 from mekeweserver.pipeline_status_clerk import MetaKeggPipelineStateManager
 from mekeweserver.model import MetaKeggPipelineDef
+from mekeweserver.log import get_logger, APP_LOGGER_DEFAULT_NAME
 from mekeweserver.config import Config, get_config
 
 config: Config = get_config()
 
 
+class _OutputCatcherStream:
+    """Replaces `sys.stdout`/`sys.stderr` while an OutputCatcher is entered. Writes go to the OutputCatcher, everything else (e.g. `flush()`) to the original stream."""
+
+    def __init__(self, output_catcher: "OutputCatcher", original_stream: TextIOBase):
+        self.output_catcher = output_catcher
+        self.original_stream = original_stream
+
+    def write(self, message: str) -> int:
+        return self.output_catcher.write(message)
+
+    def __getattr__(self, name: str):
+        return getattr(self.original_stream, name)
+
+
+class _OutputCatcherLogHandler(logging.Handler):
+    """Attached to the root logger while an OutputCatcher is entered. Hands log records of metaKEGG and its dependencies to the OutputCatcher,
+    if they have at least the level of the handler. Records of the server itself are left out.
+    The levels of the loggers are not changed. Loggers without an own level inherit the level of the root logger (by default WARNING).
+    """
+
+    def __init__(self, output_catcher: "OutputCatcher", level: int):
+        super().__init__(level)
+        self.setFormatter(logging.Formatter("%(levelname)s:%(name)s:%(message)s"))
+        self.output_catcher = output_catcher
+
+    def emit(self, record: logging.LogRecord):
+        if record.name == APP_LOGGER_DEFAULT_NAME or record.name.startswith(
+            f"{APP_LOGGER_DEFAULT_NAME}."
+        ):
+            return
+        try:
+            self.output_catcher.write(self.format(record) + "\n")
+        except Exception:
+            self.handleError(record)
+
+
 class OutputCatcher:
+    """Catches stdout, stderr and log records of the whole process while entered. Every analysis runs in its own child process
+    (`config.PIPELINE_WORKER_CONCURRENT_ANALYSES` > 1 requires `config.PIPELINE_RUN_IN_SUBPROCESS`), so the output of concurrent analyses does not mix.
+
+    Complete lines are buffered in memory. A background thread hands them to the `output_handler` in batches, every `flush_interval_sec`
+    or as soon as `flush_size_bytes` are buffered. Writing output never waits for the `output_handler` (e.g. the database).
+    Remaining output, incl. a last line without newline, is handed over on exit.
+    """
 
-    def __init__(self, output_handler: Callable[[str, TextIOBase], None]):
+    def __init__(
+        self,
+        output_handler: Callable[[List[str], TextIOBase], None],
+        flush_interval_sec: Optional[float] = None,
+        flush_size_bytes: Optional[int] = None,
+    ):
         self.output_handler = output_handler
-        self.original_stdout = sys.stdout  # Save original stdout
+        self.flush_interval_sec = (
+            flush_interval_sec
+            if flush_interval_sec is not None
+            else config.PIPELINE_RUN_OUTPUT_LOG_FLUSH_INTERVAL_SEC
+        )
+        self.flush_size_bytes = (
+            flush_size_bytes
+            if flush_size_bytes is not None
+            else config.PIPELINE_RUN_OUTPUT_LOG_FLUSH_SIZE_BYTES
+        )
+        self._log_handler = _OutputCatcherLogHandler(
+            self, level=logging.getLevelName(config.PIPELINE_RUN_OUTPUT_LOG_LEVEL)
+        )
+        self.original_stdout = sys.stdout
+        self.original_stderr = sys.stderr
         self.buffer = ""  # Buffer to store partial output
+        self._lines: List[str] = []  # complete lines that are not flushed yet
+        self._lines_size_bytes = 0
+        self._buffer_lock = threading.Lock()
+        # keeps the order of lines if the flusher thread and `__exit__` flush at the same time
+        self._flush_lock = threading.Lock()
+        self._flush_requested = threading.Event()
+        self._stopped = threading.Event()
+        self._flusher_thread: Optional[threading.Thread] = None
 
     def __enter__(self):
-        sys.stdout = self  # Redirect stdout to this instance
+        self._stopped.clear()
+        self._flusher_thread = threading.Thread(
+            target=self._run_flusher, name="OutputCatcherFlusher", daemon=True
+        )
+        self._flusher_thread.start()
+        # Redirect output to this instance
+        self.original_stdout = sys.stdout
+        self.original_stderr = sys.stderr
+        sys.stdout = _OutputCatcherStream(self, self.original_stdout)
+        sys.stderr = _OutputCatcherStream(self, self.original_stderr)
+        logging.getLogger().addHandler(self._log_handler)
         return self
 
-    def write(self, message):
-        # Buffer the output until we hit a newline
-        self.buffer += message
-        if "\n" in self.buffer:
-            # Split by newlines and handle each complete line
-            lines = self.buffer.splitlines(keepends=True)
+    def write(self, message: str) -> int:
+        with self._buffer_lock:
+            # Buffer the output until we hit a newline
+            self.buffer += message
+            if "\n" not in self.buffer:
+                return len(message)
+            lines = self.buffer.split("\n")
+            # the last element is the (maybe empty) start of the next line
+            self.buffer = lines.pop()
             for line in lines:
-                if line.endswith("\n"):
-                    self.output_handler(line.strip(), self.original_stdout)
-            self.buffer = ""
+                self._lines.append(line.strip())
+                self._lines_size_bytes += len(line.encode())
+            flush_now = self._lines_size_bytes >= self.flush_size_bytes
+        if flush_now:
+            self._flush_requested.set()
+        return len(message)
+
+    def flush(self, include_partial_line: bool = False):
+        with self._flush_lock:
+            with self._buffer_lock:
+                if include_partial_line and self.buffer:
+                    self._lines.append(self.buffer.strip())
+                    self.buffer = ""
+                lines = self._lines
+                self._lines = []
+                self._lines_size_bytes = 0
+            if not lines:
+                return
+            try:
+                self.output_handler(lines, self.original_stdout)
+            except Exception as e:
+                # losing some output lines must not fail the analysis
+                get_logger().warning(
+                    f"Could not write {len(lines)} lines of pipeline run output: {e}"
+                )
+
+    def _run_flusher(self):
+        while not self._stopped.is_set():
+            self._flush_requested.wait(self.flush_interval_sec)
+            self._flush_requested.clear()
+            self.flush()
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        sys.stdout = self.original_stdout  # Restore original stdout
+        logging.getLogger().removeHandler(self._log_handler)
+        sys.stdout = self.original_stdout
+        sys.stderr = self.original_stderr
+        self._stopped.set()
+        self._flush_requested.set()
+        self._flusher_thread.join()
+        self.flush(include_partial_line=True)
 
 
 def get_pipeline_output_handler(
     ticket_id: uuid.UUID,
     redis_client: redis.Redis,
-) -> Callable[[str, TextIOBase], None]:
-    def pipeline_output_handler(m: str, original_logger: TextIOBase):
-        state_clerk = MetaKeggPipelineStateManager(redis_client)
-        pipeline_status = state_clerk.get_pipeline_run_definition(ticket_id)
-        if pipeline_status.output_log is None:
-            pipeline_status.output_log = ""
-        pipeline_status.output_log += f"{m}\n"
+    log_file_path: Optional[Path] = None,
+) -> Callable[[List[str], TextIOBase], None]:
+    """The handler writes the output into the (truncated) output log in redis and, if `log_file_path` is given, the full output log into this file."""
+    state_clerk = MetaKeggPipelineStateManager(redis_client)
+
+    def pipeline_output_handler(lines: List[str], original_logger: TextIOBase):
+        text = "".join(line + "\n" for line in lines)
         if config.LOG_LEVEL == "DEBUG":
             # if we are in debug mode, print all the stuff from the metakegg pipeline. otherwise we save it only to the redis server, no redudance in non debug mode.
-            original_logger.write(m + "\n")
-        state_clerk.set_pipeline_run_definition(pipeline_status)
+            original_logger.write(text)
+        if log_file_path is not None:
+            with open(log_file_path, "a", encoding="utf-8") as log_file:
+                log_file.write(text)
+        state_clerk.append_pipeline_run_output_log(ticket_id, lines)
 
     return pipeline_output_handler
@@ -9,6 +9,15 @@ import asyncio
 import redis
 import zipfile
 import datetime
+import threading
+import multiprocessing
+import multiprocessing.synchronize
+from multiprocessing.connection import Connection
+import resource
+import signal
+import time
+import getversion
+import metaKEGG
 from metaKEGG.modules.pipeline_async import PipelineAsync
 
 from mekeweserver.model import (
@@ -21,58 +30,250 @@ from mekeweserver.model import (
     GlobalParamModel,
 )
 from mekeweserver.pipeline_status_clerk import MetaKeggPipelineStateManager
+from mekeweserver.pipeline_result_cache import MetaKeggPipelineResultCache
+from mekeweserver.output_zip_stream import (
+    ZIP_COMPRESSION_METHODS,
+    OutputZipTooLargeError,
+    build_output_manifest,
+    write_output_zip,
+)
+from mekeweserver.kegg_rest_cache import (
+    MetaKeggKeggRestCache,
+    install_kegg_rest_cache,
+)
+from mekeweserver.pipeline_worker.analysis_fork_server import (
+    get_analysis_process_context,
+)
+from mekeweserver.pipeline_worker.analysis_preload import (
+    is_preloaded,
+    preload_analysis_modules,
+)
 from mekeweserver.pipeline_worker.pipeline_output_catcher import (
     OutputCatcher,
     get_pipeline_output_handler,
 )
-from mekeweserver.utils import get_module_root_dir
+from mekeweserver.utils import link_or_copy_file
+from mekeweserver.db import get_redis_client
 from mekeweserver.log import get_logger
+from mekeweserver.config import Config, get_config
 
+config: Config = get_config()
 log = get_logger()
 
 
+class PipelineRunResourceLimitError(Exception):
+    pass
+
+
+class PipelineRunCanceledError(Exception):
+    pass
+
+
+class PipelineRunInterruptedError(Exception):
+    """The worker is shutting down and the pipeline run did not finish within the drain grace period."""
+
+    pass
+
+
+class PipelineRunSubprocessError(Exception):
+    """An exception that was raised in the child process of a pipeline run. Carries the formatted traceback of the child."""
+
+    def __init__(self, message: str, error_traceback: str):
+        super().__init__(message)
+        self.error_traceback = error_traceback
+
+
 class MetakeggPipelineProcessor:
+    # how often the worker checks if the user canceled the running pipeline run
+    CANCEL_CHECK_INTERVAL_SEC = 1
 
     def __init__(
         self,
         pipeline_definition: MetaKeggPipelineDef,
         pipeline_state_manager: MetaKeggPipelineStateManager,
+        lease_heartbeat_interval_sec: Optional[float] = None,
+        drain_event: Optional[multiprocessing.synchronize.Event] = None,
     ):
         self.pipeline_definition = pipeline_definition
         self.pipeline_state_manager = pipeline_state_manager
+        self.lease_heartbeat_interval_sec = lease_heartbeat_interval_sec
+        # if set, the worker is shutting down. The pipeline run gets `config.PIPELINE_WORKER_DRAIN_GRACE_PERIOD_SEC` to finish, before it is aborted.
+        self.drain_event = drain_event
+        self._drain_deadline: Optional[float] = None
+        self.canceled = False
+        # True if the pipeline run was aborted because of a worker shutdown. The run is neither failed nor successful and must be requeued.
+        self.interrupted = False
         self._global_params: GlobalParamModel = None
         self._method_params: BaseModel = None
 
     def run(self) -> MetaKeggPipelineDef:
+        if self.lease_heartbeat_interval_sec is None:
+            return self._run()
+        # keep the lease of the pipeline run alive while we are processing it. If this process dies, the lease will lapse and the pipeline run will be requeued.
+        heartbeat_stop_event = threading.Event()
+        heartbeat_thread = threading.Thread(
+            target=self._lease_heartbeat,
+            args=(heartbeat_stop_event,),
+            daemon=True,
+        )
+        heartbeat_thread.start()
+        try:
+            return self._run()
+        finally:
+            heartbeat_stop_event.set()
+            heartbeat_thread.join()
+
+    def _lease_heartbeat(self, stop_event: threading.Event):
+        while not stop_event.wait(self.lease_heartbeat_interval_sec):
+            try:
+                if not self.pipeline_state_manager.refresh_pipeline_run_lease(
+                    self.pipeline_definition.ticket.id
+                ):
+                    log.warning(
+                        f"Lease of pipeline-run with id '{self.pipeline_definition.ticket.id}' lapsed while processing it."
+                    )
+            except redis.RedisError as e:
+                log.error(e, exc_info=True)
+
+    def _run(self) -> MetaKeggPipelineDef:
         try:
+            # a pipeline run that was canceled while queued must not complete from the result cache either
+            self._raise_if_canceled()
+            result_cache_key = self._get_result_cache_key()
+            if result_cache_key is not None and self._complete_from_result_cache(
+                result_cache_key
+            ):
+                return self.pipeline_definition
             self._run_pipeline()
+        except PipelineRunInterruptedError as e:
+            log.warning(
+                f"Pipeline-run with id '{self.pipeline_definition.ticket.id}' was interrupted: {e}"
+            )
+            return self.pipeline_definition
         except Exception as e:
             log.debug(self.pipeline_definition.model_dump_json(indent=2))
             self.pipeline_definition = self.handle_exception(e)
             return self.pipeline_definition
 
-        self.pipeline_definition = (
-            self.pipeline_state_manager.get_pipeline_run_definition(
-                ticket_id=self.pipeline_definition.ticket.id
-            )
-        )
         self.pipeline_definition.pipeline_output_zip_file_name = (
             self.pipeline_definition.generate_output_zip_file_name()
         )
         try:
-            self.pack_output()
+            if config.PIPELINE_RUN_RESULT_ZIP_MODE == "streamed":
+                self.write_output_manifest()
+            else:
+                self.pack_output()
         except Exception as e:
             self.pipeline_definition = self.handle_exception(
                 e, self.pipeline_definition
             )
             return self.pipeline_definition
 
+        if result_cache_key is not None:
+            try:
+                self._store_in_result_cache(result_cache_key)
+            except Exception as e:
+                # the result cache is an optimization. A broken cache must not fail the pipeline run.
+                log.warning(
+                    f"Could not store result of pipeline-run with id '{self.pipeline_definition.ticket.id}' in the result cache: {e}"
+                )
+        try:
+            # only after the result zip was stored in the result cache. Cache hits of other pipeline runs must not ship this output log.
+            self.add_output_log_to_output_zip()
+        except Exception as e:
+            self.pipeline_definition = self.handle_exception(
+                e, self.pipeline_definition
+            )
+            return self.pipeline_definition
         self.pipeline_definition.state = "success"
-        self.pipeline_state_manager.set_pipeline_run_definition(
-            self.pipeline_definition
+        self.pipeline_state_manager.update_pipeline_run_definition_fields(
+            self.pipeline_definition.ticket.id,
+            state=self.pipeline_definition.state,
+            pipeline_output_zip_file_name=self.pipeline_definition.pipeline_output_zip_file_name,
         )
         return self.pipeline_definition
 
+    def _get_result_cache_key(self) -> Optional[str]:
+        """Hash the normalized inputs (input file contents, analysis method, resolved global and method params) of the pipeline run.
+        Returns None if the result cache is disabled or the key can not be computed.
+        """
+        if not config.PIPELINE_RESULT_CACHE_ENABLED:
+            return None
+        method: MetaKeggPipelineAnalysisMethod = (
+            self.pipeline_definition.pipeline_analyses_method
+        )
+        try:
+            input_file_paths = [
+                self.pipeline_definition.get_input_files_path(
+                    param_name, filename, not_exists_ok=False
+                ).absolute()
+                for param_name, filenames in self.pipeline_definition.pipeline_input_file_names.items()
+                for filename in filenames
+            ]
+            return MetaKeggPipelineResultCache.compute_key(
+                method_name=method.name,
+                global_params=self._gather_global_params().model_dump(),
+                method_params=self._gather_analyse_method_params(
+                    getattr(PipelineAsync, method.name)
+                ).model_dump(),
+                input_file_paths=input_file_paths,
+                metakegg_version=getversion.get_module_version(metaKEGG)[0],
+            )
+        except Exception as e:
+            # e.g. invalid params. Let the actual pipeline run report the error.
+            log.warning(
+                f"Could not compute result cache key of pipeline-run with id '{self.pipeline_definition.ticket.id}': {e}"
+            )
+            return None
+
+    def _store_in_result_cache(self, result_cache_key: str):
+        output_zip_file_path = self.pipeline_definition.get_output_zip_file_path()
+        if not output_zip_file_path.exists():
+            # Streamed result zip mode (see `config.PIPELINE_RUN_RESULT_ZIP_MODE`). Building the zip only for the cache would cost the time and disk space the mode saves.
+            return
+        MetaKeggPipelineResultCache(self.pipeline_state_manager.redis_client).put(
+            result_cache_key, output_zip_file_path
+        )
+
+    def _complete_from_result_cache(self, result_cache_key: str) -> bool:
+        """If an earlier pipeline run with identical inputs left its result in the result cache, take it over as the result of this pipeline run."""
+        try:
+            cached_zip_path = MetaKeggPipelineResultCache(
+                self.pipeline_state_manager.redis_client
+            ).get(result_cache_key)
+            if cached_zip_path is None:
+                return False
+            self.pipeline_definition.pipeline_output_zip_file_name = (
+                self.pipeline_definition.generate_output_zip_file_name()
+            )
+            target_zip_file_path = self.pipeline_definition.get_output_zip_file_path()
+            target_zip_file_path.parent.mkdir(parents=True, exist_ok=True)
+            link_or_copy_file(cached_zip_path, target_zip_file_path)
+        except Exception as e:
+            log.warning(
+                f"Could not use result cache for pipeline-run with id '{self.pipeline_definition.ticket.id}': {e}"
+            )
+            self.pipeline_definition.pipeline_output_zip_file_name = None
+            return False
+        log.info(
+            f"Pipeline-run with id '{self.pipeline_definition.ticket.id}' completed from result cache (key '{result_cache_key}')."
+        )
+        self.pipeline_state_manager.append_pipeline_run_output_log(
+            self.pipeline_definition.ticket.id,
+            [
+                "An earlier pipeline run with identical input files, analysis method and parameters exists. Its result was reused."
+            ],
+        )
+        self.pipeline_definition.result_from_cache = True
+        self.pipeline_definition.state = "success"
+        self.pipeline_state_manager.update_pipeline_run_definition_fields(
+            self.pipeline_definition.ticket.id,
+            state=self.pipeline_definition.state,
+            pipeline_output_zip_file_name=self.pipeline_definition.pipeline_output_zip_file_name,
+            result_from_cache=self.pipeline_definition.result_from_cache,
+        )
+        return True
+
     def _gather_global_params(self) -> GlobalParamModel:
         params = {}
         for param_doc in get_param_docs(PipelineAsync.__init__):
@@ -172,18 +373,164 @@ class MetakeggPipelineProcessor:
         )
         return MetaKeggMethodParamModel(**params)
 
+    def _raise_if_canceled(self):
+        if self.pipeline_state_manager.is_pipeline_run_cancel_requested(
+            self.pipeline_definition.ticket.id
+        ):
+            self.canceled = True
+            raise PipelineRunCanceledError("The pipeline run was canceled.")
+
+    def _raise_if_drain_grace_period_passed(self):
+        if self.drain_event is None or not self.drain_event.is_set():
+            return
+        if self._drain_deadline is None:
+            log.info(
+                f"Worker is shutting down. Pipeline-run with id '{self.pipeline_definition.ticket.id}' has {config.PIPELINE_WORKER_DRAIN_GRACE_PERIOD_SEC} seconds to finish."
+            )
+            self._drain_deadline = (
+                time.monotonic() + config.PIPELINE_WORKER_DRAIN_GRACE_PERIOD_SEC
+            )
+        if time.monotonic() > self._drain_deadline:
+            self.interrupted = True
+            raise PipelineRunInterruptedError(
+                f"The worker shut down and the analysis did not finish within the grace period of {config.PIPELINE_WORKER_DRAIN_GRACE_PERIOD_SEC} seconds."
+            )
+
+    def _get_timeout_at(self) -> Optional[float]:
+        if config.PIPELINE_RUN_TIMEOUT_SEC is None:
+            return None
+        return time.monotonic() + config.PIPELINE_RUN_TIMEOUT_SEC
+
+    def _raise_if_timed_out(self, timeout_at: Optional[float]):
+        if timeout_at is not None and time.monotonic() > timeout_at:
+            raise PipelineRunResourceLimitError(
+                f"The analysis exceeded the time limit of {config.PIPELINE_RUN_TIMEOUT_SEC} seconds and was aborted."
+            )
+
     def _run_pipeline(self):
+        self._raise_if_canceled()
+        if not config.PIPELINE_RUN_IN_SUBPROCESS:
+            # Debugging only. The analysis can not be aborted in this mode. A cancel request will only be respected before the start and a worker shutdown waits for the analysis to finish.
+            # metaKEGG changes the working dir and does not reset it on errors (https://github.com/DZD-eV-Diabetes-Research/meta-kegg-web-wrapper/issues/10).
+            # Only one analysis runs in the worker process in this mode (see `config.PIPELINE_WORKER_CONCURRENT_ANALYSES`), so restoring it afterwards is enough.
+            working_dir = os.getcwd()
+            try:
+                # a fresh event loop. `asyncio.get_event_loop()` fails if an earlier `asyncio.run()` in this thread closed the loop.
+                asyncio.run(self._run_pipeline_analysis_async())
+            finally:
+                os.chdir(working_dir)
+            return
+        # metaKEGG runs in a forked child process. This way we can enforce resource limits and the worker survives crashes/hangs of the analysis.
+        # The child is started by a fork server (see `get_analysis_process_context`). The processor (and the pipeline definition with its dynamic param models) is not pickleable, the child gets the pipeline definition as JSON.
+        receive_conn, send_conn = multiprocessing.Pipe(duplex=False)
+        child_process = get_analysis_process_context().Process(
+            target=_run_pipeline_in_child_process,
+            args=(
+                self.pipeline_definition.model_dump_json(),
+                send_conn,
+                time.monotonic(),
+            ),
+            name=f"MetaKeggPipelineRun-{self.pipeline_definition.ticket.id.hex}",
+        )
+        child_process.start()
+        send_conn.close()
+        timeout_at = self._get_timeout_at()
+        try:
+            while not receive_conn.poll(self.CANCEL_CHECK_INTERVAL_SEC):
+                self._raise_if_canceled()
+                self._raise_if_drain_grace_period_passed()
+                self._raise_if_timed_out(timeout_at)
+            result: Optional[Dict[str, str]] = receive_conn.recv()
+        except EOFError:
+            # the child died without reporting back
+            result = None
+        finally:
+            if child_process.is_alive():
+                child_process.kill()
+            child_process.join()
+            receive_conn.close()
+        if result is None:
+            raise PipelineRunResourceLimitError(
+                self._get_child_process_exit_reason(child_process.exitcode)
+            )
+        if result["startup_sec"] is not None:
+            self.pipeline_state_manager.set_pipeline_run_analysis_startup_time(
+                self.pipeline_definition.ticket.id,
+                startup_sec=result["startup_sec"],
+                warm=result["started_warm"],
+            )
+        if result["error"] is not None:
+            raise PipelineRunSubprocessError(
+                result["error"], error_traceback=result["error_traceback"]
+            )
 
+    def _get_child_process_exit_reason(self, exitcode: int) -> str:
+        if exitcode == -signal.SIGXCPU:
+            return f"The analysis exceeded the CPU time limit of {config.PIPELINE_RUN_MAX_CPU_SEC} seconds and was aborted."
+        if exitcode == -signal.SIGKILL:
+            return "The analysis process was killed. Most likely it ran out of memory."
+        return f"The analysis process exited unexpectedly with exit code {exitcode}."
+
+    def _run_pipeline_in_child_process(
+        self, send_conn: Connection, fork_requested_at: float
+    ):
+        # On shutdown the worker decides if the analysis may finish (see `_raise_if_drain_grace_period_passed`). Signals to the whole process group must not kill it.
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        if config.PIPELINE_RUN_MAX_MEMORY_BYTES is not None:
+            resource.setrlimit(
+                resource.RLIMIT_AS,
+                (
+                    config.PIPELINE_RUN_MAX_MEMORY_BYTES,
+                    config.PIPELINE_RUN_MAX_MEMORY_BYTES,
+                ),
+            )
+        if config.PIPELINE_RUN_MAX_CPU_SEC is not None:
+            # soft limit sends SIGXCPU, the hard limit a SIGKILL shortly after, if SIGXCPU was ignored.
+            resource.setrlimit(
+                resource.RLIMIT_CPU,
+                (config.PIPELINE_RUN_MAX_CPU_SEC, config.PIPELINE_RUN_MAX_CPU_SEC + 5),
+            )
+        result = {
+            "error": None,
+            "error_traceback": None,
+            "startup_sec": None,
+            "started_warm": is_preloaded(),
+        }
+        try:
+            # a no-op if this process was forked from a preloaded fork server (see `config.PIPELINE_WORKER_PRELOAD_ANALYSIS_MODULES`)
+            preload_analysis_modules()
+            result["startup_sec"] = time.monotonic() - fork_requested_at
+            # The child process exits after the analysis. Where metaKEGG leaves its working dir does not matter.
+            asyncio.run(self._run_pipeline_analysis_async())
+        except MemoryError as e:
+            result["error"] = (
+                f"The analysis exceeded the memory limit of {config.PIPELINE_RUN_MAX_MEMORY_BYTES} bytes and was aborted."
+                if config.PIPELINE_RUN_MAX_MEMORY_BYTES is not None
+                else "The analysis ran out of memory."
+            )
+            result["error_traceback"] = self._get_error_traceback()
+        except Exception as e:
+            result["error"] = str(e)
+            result["error_traceback"] = self._get_error_traceback()
+        send_conn.send(result)
+        send_conn.close()
+
+    async def _run_pipeline_analysis_async(self):
         method: MetaKeggPipelineAnalysisMethod = (
             self.pipeline_definition.pipeline_analyses_method
         )
-        event_loop = asyncio.get_event_loop()
+        if config.KEGG_REST_CACHE_ENABLED:
+            install_kegg_rest_cache(
+                MetaKeggKeggRestCache(self.pipeline_state_manager.redis_client)
+            )
 
         # The OutputCatcher (with our handler) writes any printed output of the metakegg pipeline run into our redis database. this way we can keep the user up2date what happening.
         with OutputCatcher(
             output_handler=get_pipeline_output_handler(
                 self.pipeline_definition.ticket.id,
                 self.pipeline_state_manager.redis_client,
+                log_file_path=self.pipeline_definition.get_output_log_file_path().resolve(),
             )
         ):
             # init metakegg.Pipeline
@@ -223,16 +570,7 @@ class MetakeggPipelineProcessor:
             self._method_params = self._gather_analyse_method_params(
                 analysis_method_func
             )
-            # workdir = os.getcwd()
-            # log.info(("workdir", workdir))
-            os.chdir(get_module_root_dir())
-            event_loop.run_until_complete(
-                analysis_method_func(**self._method_params.model_dump())
-            )
-            # HOTfix for https://github.com/DZD-eV-Diabetes-Research/meta-kegg-web-wrapper/issues/10
-            # MetaKegg has a bug in which it will set the working dir to a new/wrong place and wont reset.
-            # we need to make sure to always set it back again
-            os.chdir(get_module_root_dir())
+            await analysis_method_func(**self._method_params.model_dump())
 
     def pack_output(self):
         # todo: i dont like this function here...maybe find a better place
@@ -247,16 +585,90 @@ class MetakeggPipelineProcessor:
         log.info(
             f"Zip output file {[f.name for f in self.pipeline_definition.get_output_files_dir().iterdir()]} into {target_zip_file_path}"
         )
-        with zipfile.ZipFile(target_zip_file_path, "w") as output_zip:
-            for output_file in output_files:
-                output_zip.write(output_file, arcname=output_file.name)
+        members = [(output_file, output_file.name) for output_file in output_files]
+        compress_type = ZIP_COMPRESSION_METHODS[
+            config.PIPELINE_RUN_RESULT_ZIP_COMPRESSION
+        ]
+        stored_file_extensions = {
+            e.lower() for e in config.PIPELINE_RUN_RESULT_ZIP_STORED_FILE_EXTENSIONS
+        }
+        started_at = time.monotonic()
+        files_size_bytes, zip_size_bytes = write_output_zip(
+            target_zip_file_path,
+            members,
+            get_compress_type=lambda path: (
+                zipfile.ZIP_STORED
+                if path.suffix.lower() in stored_file_extensions
+                else compress_type
+            ),
+            compress_level=config.PIPELINE_RUN_RESULT_ZIP_COMPRESSION_LEVEL,
+            max_workers=config.PIPELINE_RUN_RESULT_ZIP_COMPRESSION_THREADS,
+        )
+        self.pipeline_state_manager.set_pipeline_run_result_archive_stats(
+            self.pipeline_definition.ticket.id,
+            build_sec=time.monotonic() - started_at,
+            compression_ratio=files_size_bytes / zip_size_bytes,
+        )
         for output_file in output_files:
             output_file.unlink(missing_ok=True)
 
+    def add_output_log_to_output_zip(self):
+        """The output log in the pipeline run status might be truncated. Ship the full log with the result zip.
+        Appending keeps the already compressed members of the zip as they are.
+        """
+        output_zip_file_path = self.pipeline_definition.get_output_zip_file_path()
+        output_log_file_path = self.pipeline_definition.get_output_log_file_path()
+        if not output_zip_file_path.exists() or not output_log_file_path.exists():
+            # e.g. streamed result zip mode. `write_output_manifest` already added the output log to the output files.
+            return
+        with zipfile.ZipFile(
+            output_zip_file_path,
+            "a",
+            compression=ZIP_COMPRESSION_METHODS[
+                config.PIPELINE_RUN_RESULT_ZIP_COMPRESSION
+            ],
+            compresslevel=config.PIPELINE_RUN_RESULT_ZIP_COMPRESSION_LEVEL,
+        ) as zip_file:
+            zip_file.write(
+                output_log_file_path, config.PIPELINE_RUN_OUTPUT_LOG_ARCHIVE_FILE_NAME
+            )
+        output_log_file_path.unlink(missing_ok=True)
+
+    def write_output_manifest(self):
+        """Keep the output files and record what is needed to stream them as result zip on download (see `mekeweserver.output_zip_stream`).
+        Much cheaper than `pack_output`: the files are only read once to calculate their checksums.
+        """
+        output_files_dir = self.pipeline_definition.get_output_files_dir()
+        output_log_file_path = self.pipeline_definition.get_output_log_file_path()
+        if output_log_file_path.exists():
+            os.replace(
+                output_log_file_path,
+                Path(
+                    output_files_dir, config.PIPELINE_RUN_OUTPUT_LOG_ARCHIVE_FILE_NAME
+                ),
+            )
+        try:
+            manifest = build_output_manifest(output_files_dir)
+        except OutputZipTooLargeError as e:
+            log.warning(f"{e} Build the result zip instead.")
+            archived_output_log_file_path = Path(
+                output_files_dir, config.PIPELINE_RUN_OUTPUT_LOG_ARCHIVE_FILE_NAME
+            )
+            if archived_output_log_file_path.exists():
+                # `pack_output` must not pack the output log with the output files, see `add_output_log_to_output_zip`
+                os.replace(archived_output_log_file_path, output_log_file_path)
+            self.pack_output()
+            return
+        manifest_file_path = self.pipeline_definition.get_output_manifest_file_path()
+        tmp_manifest_file_path = manifest_file_path.with_suffix(".tmp")
+        tmp_manifest_file_path.write_text(manifest.model_dump_json())
+        os.replace(tmp_manifest_file_path, manifest_file_path)
+
     def handle_exception(
         self, e: Exception, pipeline_status: Optional[MetaKeggPipelineDef] = None
     ) -> MetaKeggPipelineDef:
-        if pipeline_status is None:
+        pipeline_definition = pipeline_status
+        if pipeline_definition is None:
             pipeline_definition = (
                 self.pipeline_state_manager.get_pipeline_run_definition(
                     ticket_id=self.pipeline_definition.ticket.id
@@ -265,12 +677,38 @@ class MetakeggPipelineProcessor:
         pipeline_definition.state = "failed"
         pipeline_definition.error = str(e)
         pipeline_definition.error_traceback = (
+            e.error_traceback
+            if isinstance(e, PipelineRunSubprocessError)
+            else self._get_error_traceback()
+        )
+        self.pipeline_state_manager.update_pipeline_run_definition_fields(
+            pipeline_definition.ticket.id,
+            state=pipeline_definition.state,
+            error=pipeline_definition.error,
+            error_traceback=pipeline_definition.error_traceback,
+        )
+        return pipeline_definition
+
+    def _get_error_traceback(self) -> str:
+        return (
             str(traceback.format_exc())
             + f"\n PipelineDefinition: \n {self.pipeline_definition.model_dump_json(indent=2)}"
             + f"\n metakegg.PipelineAsync Params: {self._global_params.model_dump_json(indent=2) if self._global_params else 'NotInitialized'}"
-            + f"\n metakegg.PipelineAsync.{pipeline_definition.pipeline_analyses_method.name} Params: {self._method_params.model_dump_json(indent=2) if self._method_params else 'NotInitialized'}"
-        )
-        pipeline_definition = self.pipeline_state_manager.set_pipeline_run_definition(
-            pipeline_definition
+            + f"\n metakegg.PipelineAsync.{self.pipeline_definition.pipeline_analyses_method.name} Params: {self._method_params.model_dump_json(indent=2) if self._method_params else 'NotInitialized'}"
         )
-        return pipeline_definition
+
+
+def _run_pipeline_in_child_process(
+    pipeline_definition_json: str,
+    send_conn: Connection,
+    fork_requested_at: float,
+):
+    """Entrypoint of the analysis child process (see `MetakeggPipelineProcessor._run_pipeline`)."""
+    MetakeggPipelineProcessor(
+        pipeline_definition=MetaKeggPipelineDef.model_validate_json(
+            pipeline_definition_json
+        ),
+        pipeline_state_manager=MetaKeggPipelineStateManager(
+            get_redis_client(never_start_fakeredis=True)
+        ),
+    )._run_pipeline_in_child_process(send_conn, fork_requested_at)
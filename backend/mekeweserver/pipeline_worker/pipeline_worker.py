@@ -1,10 +1,14 @@
-from typing import List, Dict
+from typing import List, Dict, Optional, Set
 from multiprocessing import Process, Event
+from concurrent.futures import Future, ThreadPoolExecutor, FIRST_COMPLETED, wait
+import threading
 import shutil
 import traceback
 import os
 from pathlib import Path
 import uuid
+import socket
+import signal
 
 # from metaKEGG import Pipeline
 # from mekeweserver.model import PipelineInputParams
@@ -13,11 +17,16 @@ import time
 import redis
 
 from mekeweserver.pipeline_status_clerk import MetaKeggPipelineStateManager
+from mekeweserver.model import MetaKeggPipelineDef
 from mekeweserver.db import get_redis_client
 
 from mekeweserver.log import get_logger
 from mekeweserver.config import Config, get_config
 from mekeweserver.pipeline_worker.pipeline_processor import MetakeggPipelineProcessor
+from mekeweserver.pipeline_worker.analysis_preload import preload_analysis_modules
+from mekeweserver.pipeline_worker.analysis_fork_server import (
+    start_analysis_fork_server,
+)
 
 config: Config = get_config()
 log = get_logger()
@@ -27,37 +36,82 @@ class PipelineWorker(Process):
     WORKER_EXCEPTION_COUNTER_REDIS_KEY = "METAKEGG_WORKER_EXCEPTION_COUNT"
 
     # constructor
-    def __init__(self, tick_pause_sec: int = 1, env: Dict = None):
+    def __init__(
+        self, tick_pause_sec: int = 1, env: Dict = None, worker_id: str = None
+    ):
         # call the parent constructor
         Process.__init__(self)
         # create and store an event
         self.stop_event = Event()
         self.tick_pause_sec = tick_pause_sec
         self.env = env
+        # The worker id names the processing list of this worker in redis. It must be stable over restarts of the same worker,
+        # so a restarted worker can pick up pipeline runs that were dequeued but not finished by its predecessor.
+        self.worker_id = worker_id if worker_id is not None else socket.gethostname()
+        self.exception_counter_redis_key = (
+            f"{self.WORKER_EXCEPTION_COUNTER_REDIS_KEY}:{self.worker_id}"
+        )
+        # Only with `config.PIPELINE_WORKER_CONCURRENT_ANALYSES` > 1. Pipeline runs are processed in threads of the executor, each analysis in its own child process.
+        self.pipeline_run_executor: Optional[ThreadPoolExecutor] = None
+        self.pipeline_runs_in_progress: Set[Future] = set()
 
     def run(self):
         if self.env:
             os.environ = os.environ.copy() | self.env
         log.info("Started MetaKegg Pipeline Processing Worker")
+        signal.signal(signal.SIGTERM, self._handle_shutdown_signal)
+        signal.signal(signal.SIGINT, self._handle_shutdown_signal)
         redis_client = get_redis_client(never_start_fakeredis=True)
-        redis_client.set(self.WORKER_EXCEPTION_COUNTER_REDIS_KEY, 0)
+        redis_client.set(self.exception_counter_redis_key, 0)
+        pipeline_state_manager = MetaKeggPipelineStateManager(redis_client=redis_client)
+        # Report liveness from a thread. The main loop is blocked while a pipeline run is processed.
+        # It keeps reporting while the worker drains, until the main loop exited and all pipeline runs are done.
+        heartbeat_stop_event = threading.Event()
+        heartbeat_thread = threading.Thread(
+            target=self._heartbeat,
+            args=(pipeline_state_manager, heartbeat_stop_event),
+            daemon=True,
+        )
+        heartbeat_thread.start()
+        if config.PIPELINE_RUN_IN_SUBPROCESS:
+            # preloads the analysis modules (if enabled) in the fork server, not in this process.
+            start_analysis_fork_server()
+        elif config.PIPELINE_WORKER_PRELOAD_ANALYSIS_MODULES:
+            log.info(
+                f"Preloaded analysis modules in {preload_analysis_modules():.2f} seconds."
+            )
+        pipeline_state_manager.rebuild_pipeline_run_indexes()
+        pipeline_state_manager.requeue_unfinished_pipeline_runs_of_worker(
+            self.worker_id
+        )
+        if config.PIPELINE_WORKER_CONCURRENT_ANALYSES > 1:
+            # each analysis runs in its own child process (enforced by `Config`), so they do not share a working directory.
+            self.pipeline_run_executor = ThreadPoolExecutor(
+                max_workers=config.PIPELINE_WORKER_CONCURRENT_ANALYSES,
+                thread_name_prefix="PipelineRun",
+            )
 
         while not self.stop_event.is_set():
+            block_timeout_sec = None
             try:
                 pipeline_state_manager = MetaKeggPipelineStateManager(
                     redis_client=redis_client
                 )
-                self._clean_zombie_files(pipeline_state_manager)
-                self._process_next_pipeline_in_queue(pipeline_state_manager)
-                self._process_next_expiring_pipeline(pipeline_state_manager)
-                self._process_next_deletable_pipeline(pipeline_state_manager)
-                self._process_next_abandoned_pipeline_def(pipeline_state_manager)
-                self._purge_old_statistics(pipeline_state_manager)
+                if config.PIPELINE_WORKER_DEQUEUE_MODE == "blocking":
+                    block_timeout_sec = config.PIPELINE_WORKER_DEQUEUE_TIMEOUT_SEC
+                if self.pipeline_run_executor is None:
+                    self._process_next_pipeline_in_queue(
+                        pipeline_state_manager, block_timeout_sec=block_timeout_sec
+                    )
+                else:
+                    self._submit_next_pipeline_in_queue(
+                        pipeline_state_manager, block_timeout_sec=block_timeout_sec
+                    )
             except Exception as e:
                 exception_count: int = 99999
                 try:
                     exception_count = int(
-                        redis_client.get(self.WORKER_EXCEPTION_COUNTER_REDIS_KEY)
+                        redis_client.get(self.exception_counter_redis_key)
                     )
                 except redis.ConnectionError:
                     print("REDIS OFFLINE")
@@ -70,122 +124,139 @@ class PipelineWorker(Process):
                     try:
                         print("INCREASE", exception_count)
                         exception_count = redis_client.incr(
-                            self.WORKER_EXCEPTION_COUNTER_REDIS_KEY, 1
+                            self.exception_counter_redis_key, 1
                         )
                     except:
                         raise e
                 else:
                     raise e
                 # traceback.format_exception(e)
+                # prevent a busy loop, e.g. while redis is offline
+                time.sleep(self.tick_pause_sec)
             else:
-                redis_client.set(self.WORKER_EXCEPTION_COUNTER_REDIS_KEY, 0)
-            time.sleep(self.tick_pause_sec)
+                redis_client.set(self.exception_counter_redis_key, 0)
+                if block_timeout_sec is None:
+                    # polling mode. In blocking mode the dequeue itself waited for the queue.
+                    time.sleep(self.tick_pause_sec)
+        if self.pipeline_run_executor is not None:
+            # the running pipeline runs see the stop event and drain (see `MetakeggPipelineProcessor`)
+            self.pipeline_run_executor.shutdown(wait=True)
+        heartbeat_stop_event.set()
+        heartbeat_thread.join()
+        pipeline_state_manager.remove_worker_heartbeat(self.worker_id)
         log.info("Exiting MetaKegg Pipeline Processing Worker.")
 
-    def _process_next_pipeline_in_queue(
-        self, state_manager: MetaKeggPipelineStateManager
+    def _handle_shutdown_signal(self, signum, frame):
+        """Drain mode: Stop taking new pipeline runs from the queue. The current pipeline run gets `config.PIPELINE_WORKER_DRAIN_GRACE_PERIOD_SEC`
+        to finish before it is aborted and requeued (see `MetakeggPipelineProcessor`).
+        """
+        log.info(
+            f"Pipeline worker '{self.worker_id}' received signal {signum}. Drain and stop..."
+        )
+        # Setting a multiprocessing Event takes a lock that the interrupted main thread might hold. Set it from another thread.
+        threading.Thread(target=self.stop_event.set, daemon=True).start()
+
+    def _heartbeat(
+        self,
+        state_manager: MetaKeggPipelineStateManager,
+        stop_event: threading.Event,
     ):
+        while True:
+            try:
+                state_manager.set_worker_heartbeat(self.worker_id)
+            except redis.RedisError as e:
+                log.error(e, exc_info=True)
+            if stop_event.wait(config.PIPELINE_WORKER_HEARTBEAT_INTERVAL_SEC):
+                return
+
+    def _process_next_pipeline_in_queue(
+        self,
+        state_manager: MetaKeggPipelineStateManager,
+        block_timeout_sec: float = None,
+    ) -> bool:
         next_pipeline_definition_in_queue = (
-            state_manager.get_next_pipeline_run_from_queue()
+            state_manager.get_next_pipeline_run_from_queue(
+                worker_id=self.worker_id, block_timeout_sec=block_timeout_sec
+            )
         )
-        if next_pipeline_definition_in_queue is not None:
-            pipeline_processor = MetakeggPipelineProcessor(
-                pipeline_definition=next_pipeline_definition_in_queue,
-                pipeline_state_manager=state_manager,
+        if next_pipeline_definition_in_queue is None:
+            return False
+        self._process_pipeline_run(state_manager, next_pipeline_definition_in_queue)
+        return True
+
+    def _submit_next_pipeline_in_queue(
+        self,
+        state_manager: MetaKeggPipelineStateManager,
+        block_timeout_sec: float = None,
+    ) -> bool:
+        """Concurrent mode: Take the next pipeline run from the queue and process it in a thread of `self.pipeline_run_executor`,
+        if less than `config.PIPELINE_WORKER_CONCURRENT_ANALYSES` pipeline runs are in progress. Otherwise wait for one to finish.
+        """
+        finished_pipeline_runs = {f for f in self.pipeline_runs_in_progress if f.done()}
+        self.pipeline_runs_in_progress -= finished_pipeline_runs
+        for finished_pipeline_run in finished_pipeline_runs:
+            # raise exceptions of the processing threads in the main loop
+            finished_pipeline_run.result()
+        if (
+            len(self.pipeline_runs_in_progress)
+            >= config.PIPELINE_WORKER_CONCURRENT_ANALYSES
+        ):
+            wait(
+                self.pipeline_runs_in_progress,
+                timeout=block_timeout_sec or self.tick_pause_sec,
+                return_when=FIRST_COMPLETED,
             )
-            pipeline_processor.run()
-            state_manager.set_pipeline_state_as_finished(
-                next_pipeline_definition_in_queue.ticket.id
+            return True
+        next_pipeline_definition_in_queue = (
+            state_manager.get_next_pipeline_run_from_queue(
+                worker_id=self.worker_id, block_timeout_sec=block_timeout_sec
             )
-
-    def _process_next_expiring_pipeline(
-        self, state_manager: MetaKeggPipelineStateManager
-    ):
-        next_pipeline_definition_that_is_expired = (
-            state_manager.get_next_pipeline_that_is_expired()
-        )
-        if next_pipeline_definition_that_is_expired is None:
-            return
-        log.info(
-            f"Set MetaKegg pipeline defintion with ticket id {next_pipeline_definition_that_is_expired.ticket.id.hex} as expired..."
-        )
-        # we first need to set the pipelinestate to expired before deleting anything to prevent race cond.
-        next_pipeline_definition_that_is_expired.state = "expired"
-        # set a "deleted" marker behind the input filename list
-        next_pipeline_definition_that_is_expired.pipeline_input_file_names = {}
-        output_zip_name = (
-            next_pipeline_definition_that_is_expired.pipeline_output_zip_file_name
         )
-        if output_zip_name is not None:
-            next_pipeline_definition_that_is_expired.pipeline_output_zip_file_name = (
-                None
+        if next_pipeline_definition_in_queue is None:
+            return False
+        self.pipeline_runs_in_progress.add(
+            self.pipeline_run_executor.submit(
+                self._process_pipeline_run,
+                state_manager,
+                next_pipeline_definition_in_queue,
             )
-        state_manager.set_pipeline_run_definition(
-            next_pipeline_definition_that_is_expired
         )
+        return True
 
-        # delete all cached file for this pipeline
-        shutil.rmtree(next_pipeline_definition_that_is_expired.get_files_base_dir())
-
-    def _process_next_deletable_pipeline(
-        self, state_manager: MetaKeggPipelineStateManager
+    def _process_pipeline_run(
+        self,
+        state_manager: MetaKeggPipelineStateManager,
+        next_pipeline_definition_in_queue: MetaKeggPipelineDef,
     ):
-
-        next_pipeline_definition_that_is_deletable = (
-            state_manager.get_next_pipeline_that_is_deletable()
-        )
-        if next_pipeline_definition_that_is_deletable is None:
+        if self.stop_event.is_set():
+            # the shutdown started while we were waiting for the queue. Do not start the pipeline run at all.
+            state_manager.requeue_pipeline_run_of_stopping_worker(
+                self.worker_id, next_pipeline_definition_in_queue.ticket.id
+            )
             return
-        log.info(
-            f"Delete MetaKegg pipeline defintion with ticket id {next_pipeline_definition_that_is_deletable.ticket.id.hex} because of age..."
-        )
-        state_manager.delete_pipeline_status(
-            ticket_id=next_pipeline_definition_that_is_deletable.ticket.id
-        )
-
-    def _process_next_abandoned_pipeline_def(
-        self, state_manager: MetaKeggPipelineStateManager
-    ):
-        next_pipeline_definition_that_is_deletable = (
-            state_manager.get_next_pipeline_that_is_abandoned()
+        pipeline_processor = MetakeggPipelineProcessor(
+            pipeline_definition=next_pipeline_definition_in_queue,
+            pipeline_state_manager=state_manager,
+            lease_heartbeat_interval_sec=config.PIPELINE_RUN_LEASE_HEARTBEAT_INTERVAL_SEC,
+            drain_event=self.stop_event,
         )
-        if next_pipeline_definition_that_is_deletable is None:
+        pipeline_processor.run()
+        if pipeline_processor.interrupted:
+            state_manager.requeue_pipeline_run_of_stopping_worker(
+                self.worker_id, next_pipeline_definition_in_queue.ticket.id
+            )
             return
-        log.info(
-            f"Delete MetaKegg pipeline defintion with ticket id {next_pipeline_definition_that_is_deletable.ticket.id.hex} because it is abandoned..."
+        state_manager.set_pipeline_state_as_finished(
+            next_pipeline_definition_in_queue.ticket.id
         )
-        state_manager.delete_pipeline_status(
-            ticket_id=next_pipeline_definition_that_is_deletable.ticket.id
+        if pipeline_processor.canceled:
+            state_manager.free_pipeline_run_files(
+                next_pipeline_definition_in_queue.ticket.id
+            )
+        state_manager.clear_pipeline_run_cancel_request(
+            next_pipeline_definition_in_queue.ticket.id
+        )
+        # only now the pipeline run can be removed from the processing list of this worker.
+        state_manager.acknowledge_pipeline_run_processed(
+            self.worker_id, next_pipeline_definition_in_queue.ticket.id
         )
-
-    def _purge_old_statistics(self, state_manager: MetaKeggPipelineStateManager):
-        state_manager.remove_expired_pipeline_run_statistic_points()
-
-    def _clean_zombie_files(self, state_manager: MetaKeggPipelineStateManager):
-        cache_dir = Path(config.PIPELINE_RUNS_CACHE_DIR)
-        all_pipeline_definition = state_manager.get_all_pipeline_run_definitions()
-        all_pipeline_definition_ids: List[uuid.UUID] = [
-            d.ticket.id for d in all_pipeline_definition
-        ]
-        if not cache_dir.exists():
-            return
-        for path_obj in cache_dir.iterdir():
-            if path_obj.is_dir():
-                directory_ticket_id: uuid.UUID = None
-                try:
-                    directory_ticket_id = uuid.UUID(path_obj.name)
-                except ValueError as e:
-                    if (
-                        hasattr(e, "message")
-                        and e.message == "badly formed hexadecimal UUID string"
-                    ):
-                        # this is not a uuid named directory. Maybe a directory we dont have to do anything with
-                        log.warning(
-                            f"There seems to be a non standard directory in the cache dir at {path_obj.resolve()}."
-                        )
-                    else:
-                        raise e
-                if directory_ticket_id not in all_pipeline_definition_ids:
-                    # we got a zombie, sir!
-                    log.warning(f"Delete zombie directory at {path_obj.resolve()}")
-                    shutil.rmtree(path_obj)
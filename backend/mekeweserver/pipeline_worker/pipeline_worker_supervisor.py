@@ -0,0 +1,108 @@
+from typing import List, Dict, Optional
+import threading
+import socket
+import time
+
+from mekeweserver.pipeline_worker.pipeline_worker import PipelineWorker
+from mekeweserver.pipeline_worker.pipeline_housekeeper import PipelineHousekeeper
+from mekeweserver.log import get_logger
+from mekeweserver.config import Config, get_config
+
+config: Config = get_config()
+log = get_logger()
+
+
+class PipelineWorkerSupervisor:
+    """Starts `config.PIPELINE_WORKER_COUNT` PipelineWorker processes that share the redis queue and a PipelineHousekeeper process.
+    Restarts them if they crash."""
+
+    # extra time on top of the drain grace period, for requeueing and exiting.
+    DRAIN_TIMEOUT_MARGIN_SEC = 10
+
+    def __init__(
+        self,
+        worker_count: Optional[int] = None,
+        env: Dict = None,
+        check_interval_sec: float = 1,
+    ):
+        self.worker_count = (
+            worker_count if worker_count is not None else config.PIPELINE_WORKER_COUNT
+        )
+        self.env = env
+        self.check_interval_sec = check_interval_sec
+        # the worker ids stay the same when a worker is restarted. This way the new worker picks up the unfinished pipeline runs of the crashed one.
+        self.worker_ids: List[str] = [
+            f"{socket.gethostname()}-{index}" for index in range(self.worker_count)
+        ]
+        self.housekeeper_id = f"{socket.gethostname()}-housekeeper"
+        self.processes: Dict[str, PipelineWorker | PipelineHousekeeper] = {}
+        self.restart_counts: Dict[str, int] = {
+            process_id: 0 for process_id in self.worker_ids + [self.housekeeper_id]
+        }
+        self.stop_event = threading.Event()
+        self._supervisor_thread = threading.Thread(
+            target=self._supervise, name="PipelineWorkerSupervisor", daemon=True
+        )
+
+    def start(self):
+        log.info(
+            f"Start {self.worker_count} background MetaKegg Pipeline Processor worker(s)..."
+        )
+        for process_id in self.restart_counts.keys():
+            self._start_process(process_id)
+        self._supervisor_thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        for process in self.processes.values():
+            process.stop_event.set()
+
+    def join(self, timeout: Optional[float] = None):
+        for process in self.processes.values():
+            process.join(timeout)
+
+    def drain(self, timeout_sec: Optional[float] = None):
+        """Graceful shutdown: The workers finish or requeue their current pipeline run and exit.
+        Processes that are still alive after `timeout_sec` are killed. Their pipeline runs will be requeued by the lease recovery or on the next start of the worker.
+        """
+        if timeout_sec is None:
+            timeout_sec = (
+                config.PIPELINE_WORKER_DRAIN_GRACE_PERIOD_SEC
+                + self.DRAIN_TIMEOUT_MARGIN_SEC
+            )
+        log.info(
+            f"Drain pipeline workers. Wait up to {timeout_sec} seconds for running pipeline runs..."
+        )
+        self.stop()
+        deadline = time.monotonic() + timeout_sec
+        for process_id, process in self.processes.items():
+            process.join(max(deadline - time.monotonic(), 0))
+            if process.is_alive():
+                log.warning(
+                    f"Pipeline worker process '{process_id}' did not stop in time. Kill it."
+                )
+                process.kill()
+                process.join()
+
+    def _start_process(self, process_id: str):
+        if process_id == self.housekeeper_id:
+            process = PipelineHousekeeper(env=self.env, housekeeper_id=process_id)
+        else:
+            process = PipelineWorker(env=self.env, worker_id=process_id)
+        process.start()
+        self.processes[process_id] = process
+
+    def _supervise(self):
+        while not self.stop_event.wait(self.check_interval_sec):
+            for process_id, process in list(self.processes.items()):
+                if process.is_alive() or self.stop_event.is_set():
+                    continue
+                self.restart_counts[process_id] += 1
+                log.error(
+                    f"Pipeline worker process '{process_id}' died with exit code {process.exitcode}. Restart it (restart no. {self.restart_counts[process_id]})..."
+                )
+                process.close()
+                self._start_process(process_id)
+
+    def is_alive(self) -> bool:
+        return all(process.is_alive() for process in self.processes.values())
@@ -0,0 +1,154 @@
+from typing import BinaryIO, List, Optional
+import hashlib
+import os
+import time
+import uuid
+from pathlib import Path
+import redis
+
+from mekeweserver.utils import link_or_copy_file
+from mekeweserver.log import get_logger
+from mekeweserver.config import Config, get_config
+
+config: Config = get_config()
+log = get_logger()
+
+
+class MetaKeggUploadBlobStore:
+    """Content-addressed storage for uploaded input files.
+
+    An upload is hashed while it is streamed to disk and stored once as `<PIPELINE_UPLOAD_BLOB_DIR>/<digest[:2]>/<digest>`.
+    The input file of a pipeline run (`<PIPELINE_RUNS_CACHE_DIR>/<ticket>/input/<param>/<name>`) is a hard link to that blob,
+    so the same file uploaded by many users takes the space of one file. Without hard link support (e.g. blob dir on another file system)
+    the blob is copied and only the upload itself is deduplicated.
+
+    Blobs are reference counted. Every pipeline run records which blobs its input files refer to.
+    When the input files of a pipeline run are deleted, its references are released and blobs without references are removed.
+    Because pipeline runs hold their own hard links, removing a blob never breaks an input file of a pipeline run.
+    """
+
+    # hash digest -> number of pipeline run input files referring to the blob
+    REDIS_NAME_REFCOUNTS = "upload_blob_refcounts"
+    # hash per pipeline run "<param_name>/<file_name>" -> digest
+    REDIS_NAME_TICKET_REFS_PREFIX = "upload_blob_refs"
+    FILE_READ_CHUNK_SIZE_BYTES = 1024 * 1024
+    # blobs without reference count (e.g. leftovers of a crash between storing the blob and counting the reference) are removed after this time
+    ORPHANED_BLOB_MIN_AGE_SEC = 3600
+
+    def __init__(self, redis_client: redis.Redis):
+        self.redis_client = redis_client
+        self.blob_dir = Path(config.PIPELINE_UPLOAD_BLOB_DIR)
+
+    def _get_ticket_refs_name(self, ticket_id: uuid.UUID) -> str:
+        return f"{self.REDIS_NAME_TICKET_REFS_PREFIX}:{ticket_id.hex}"
+
+    def _get_blob_path(self, digest: str) -> Path:
+        return Path(self.blob_dir, digest[:2], digest)
+
+    def store(
+        self,
+        ticket_id: uuid.UUID,
+        param_name: str,
+        file_name: str,
+        source_file: BinaryIO,
+        target_path: Path,
+    ) -> str:
+        """Stream `source_file` into the blob store and link it to `target_path` as input file of the pipeline run.
+        An existing input file with the same name is replaced. Returns the sha256 digest of the file.
+        """
+        self.blob_dir.mkdir(parents=True, exist_ok=True)
+        tmp_path = Path(self.blob_dir, f".upload.{uuid.uuid4().hex}.tmp")
+        file_hash = hashlib.sha256()
+        try:
+            with open(tmp_path, "wb") as tmp_file:
+                while chunk := source_file.read(self.FILE_READ_CHUNK_SIZE_BYTES):
+                    file_hash.update(chunk)
+                    tmp_file.write(chunk)
+            digest = file_hash.hexdigest()
+            blob_path = self._get_blob_path(digest)
+            target_path.unlink(missing_ok=True)
+            try:
+                link_or_copy_file(blob_path, target_path)
+            except FileNotFoundError:
+                # first upload of this content (or the blob was just released). Our upload becomes the blob.
+                blob_path.parent.mkdir(parents=True, exist_ok=True)
+                os.replace(tmp_path, blob_path)
+                link_or_copy_file(blob_path, target_path)
+        finally:
+            tmp_path.unlink(missing_ok=True)
+
+        ref_name = f"{param_name}/{file_name}"
+        previous_digest = self.redis_client.hget(
+            self._get_ticket_refs_name(ticket_id), ref_name
+        )
+        redis_pipe = self.redis_client.pipeline(transaction=True)
+        redis_pipe.hset(self._get_ticket_refs_name(ticket_id), ref_name, digest)
+        redis_pipe.hincrby(self.REDIS_NAME_REFCOUNTS, digest, 1)
+        redis_pipe.execute()
+        if previous_digest is not None:
+            # re-upload of a file with the same name
+            self._release_blobs([previous_digest.decode("utf-8")])
+        return digest
+
+    def release(
+        self,
+        ticket_id: uuid.UUID,
+        param_name: Optional[str] = None,
+        file_name: Optional[str] = None,
+    ):
+        """Release the references of one input file, or of all input files if no `param_name`/`file_name` is given.
+        Releasing the same reference twice is a no-op.
+        """
+        refs_name = self._get_ticket_refs_name(ticket_id)
+        redis_pipe = self.redis_client.pipeline(transaction=True)
+        if param_name is None:
+            redis_pipe.hvals(refs_name)
+            redis_pipe.delete(refs_name)
+            raw_digests, _ = redis_pipe.execute()
+        else:
+            ref_name = f"{param_name}/{file_name}"
+            redis_pipe.hget(refs_name, ref_name)
+            redis_pipe.hdel(refs_name, ref_name)
+            raw_digest, _ = redis_pipe.execute()
+            raw_digests = [raw_digest] if raw_digest is not None else []
+        self._release_blobs([d.decode("utf-8") for d in raw_digests])
+
+    def _release_blobs(self, digests: List[str]):
+        for digest in digests:
+            if self.redis_client.hincrby(self.REDIS_NAME_REFCOUNTS, digest, -1) > 0:
+                continue
+            # Last reference is gone. A concurrent upload of the same content that already linked the blob keeps its own hard link,
+            # a concurrent upload that did not link yet writes the blob again.
+            with self.redis_client.pipeline(transaction=True) as redis_pipe:
+                try:
+                    redis_pipe.watch(self.REDIS_NAME_REFCOUNTS)
+                    if int(redis_pipe.hget(self.REDIS_NAME_REFCOUNTS, digest) or 0) > 0:
+                        # a new reference came in meanwhile
+                        continue
+                    redis_pipe.multi()
+                    redis_pipe.hdel(self.REDIS_NAME_REFCOUNTS, digest)
+                    redis_pipe.execute()
+                except redis.WatchError:
+                    # the reference counts changed meanwhile. Keep the blob, `remove_orphaned_blobs` will catch it if it is unused.
+                    continue
+            self._get_blob_path(digest).unlink(missing_ok=True)
+
+    def remove_orphaned_blobs(self):
+        """Delete blobs without references that are older than `ORPHANED_BLOB_MIN_AGE_SEC`."""
+        if not self.blob_dir.exists():
+            return
+        referenced_digests = {
+            digest.decode("utf-8")
+            for digest, refcount in self.redis_client.hgetall(
+                self.REDIS_NAME_REFCOUNTS
+            ).items()
+            if int(refcount) > 0
+        }
+        min_ctime = time.time() - self.ORPHANED_BLOB_MIN_AGE_SEC
+        for path_obj in self.blob_dir.glob("**/*"):
+            if not path_obj.is_file() or path_obj.name in referenced_digests:
+                continue
+            # the ctime changes with every new hard link. Recently used blobs are kept.
+            if path_obj.stat().st_ctime < min_ctime:
+                log.warning(f"Delete orphaned upload blob at {path_obj.resolve()}")
+                path_obj.unlink(missing_ok=True)
@@ -1,4 +1,5 @@
 import os
+import shutil
 from typing import List
 from pathlib import Path
 
@@ -23,6 +24,23 @@ def get_directory_size_bytes(dir: Path) -> int:
     return sum
 
 
+def get_disk_usage_bytes(dirs: List[Path]) -> int:
+    """Size of all files in the directory trees. Files with multiple hard links are counted once."""
+    seen_inodes = set()
+    sum = 0
+    for dir in dirs:
+        if not dir.exists():
+            continue
+        for root, _, file_names in os.walk(dir):
+            for file_name in file_names:
+                stat = os.lstat(os.path.join(root, file_name))
+                if (stat.st_dev, stat.st_ino) in seen_inodes:
+                    continue
+                seen_inodes.add((stat.st_dev, stat.st_ino))
+                sum += stat.st_size
+    return sum
+
+
 def count_files_in_dir_tree(dir: Path) -> int:
     if dir.is_file():
         return 1
@@ -37,3 +55,11 @@ def count_files_in_dir_tree(dir: Path) -> int:
 
 def get_module_root_dir() -> Path:
     return Path(__file__).parent
+
+
+def link_or_copy_file(source: Path, target: Path):
+    # a hard link costs no extra space. Falls back to a copy if both are on different file systems.
+    try:
+        os.link(source, target)
+    except OSError:
+        shutil.copyfile(source, target)
@@ -0,0 +1,64 @@
+from typing import Dict
+from pathlib import Path
+import sys, os
+import signal
+import threading
+
+# Add meta kegg server to global Python modules.
+# This way we address mekeweserver as a module for imports without the need of installing it first.
+# this is convenient for local development
+if __name__ == "__main__":
+    MODULE_DIR = Path(__file__).parent
+    MODULE_PARENT_DIR = MODULE_DIR.parent.absolute()
+    sys.path.insert(0, os.path.normpath(MODULE_PARENT_DIR))
+
+
+from mekeweserver.log import get_logger
+
+
+def run_worker(env: Dict = None):
+    """Run only the pipeline workers, without the API server.
+    Start with `python -m mekeweserver.worker` on any node that can reach the same redis server and `PIPELINE_RUNS_CACHE_DIR` (shared storage) as the API server.
+    """
+    if env:
+        os.environ = os.environ.copy() | env
+    from mekeweserver.config import Config, get_config
+
+    config: Config = get_config()
+    log = get_logger()
+    if config.REDIS_CONNECTION_PARAMS is None:
+        raise ValueError(
+            "A standalone worker needs a redis server shared with the API server. Please set config `REDIS_CONNECTION_PARAMS`."
+        )
+    if config.PIPELINE_WORKER_COUNT == 0:
+        raise ValueError(
+            "PIPELINE_WORKER_COUNT is 0. There are no workers to start on this node."
+        )
+
+    from mekeweserver.db import get_redis_client
+
+    log.info("Check Cache/DB Health...")
+    get_redis_client(never_start_fakeredis=True).ping()
+    log.info("...connection to Cache/DB Health successful.")
+    Path(config.PIPELINE_RUNS_CACHE_DIR).mkdir(parents=True, exist_ok=True)
+
+    from mekeweserver.pipeline_worker.pipeline_worker_supervisor import (
+        PipelineWorkerSupervisor,
+    )
+
+    worker_supervisor = PipelineWorkerSupervisor(env=env)
+    shutdown_event = threading.Event()
+
+    def shutdown_handler(signum, frame):
+        log.info(f"Received signal {signum}. Stop pipeline workers...")
+        shutdown_event.set()
+
+    signal.signal(signal.SIGTERM, shutdown_handler)
+    signal.signal(signal.SIGINT, shutdown_handler)
+    worker_supervisor.start()
+    shutdown_event.wait()
+    worker_supervisor.drain()
+
+
+if __name__ == "__main__":
+    run_worker()
@@ -96,9 +96,28 @@ start_mekeweserver_and_backgroundworker()
 
 # RUN TESTS
 from tests.tests_pipeline_run import run_all_tests_pipeline_run
+from tests.tests_kegg_rest_cache import run_all_tests_kegg_rest_cache
+from tests.tests_output_zip_stream import run_all_tests_output_zip_stream
+from tests.tests_pipeline_status_clerk import run_all_tests_pipeline_status_clerk
+from tests.tests_pipeline_queue import run_all_tests_pipeline_queue
+from tests.tests_pipeline_estimates import run_all_tests_pipeline_estimates
+from tests.tests_pipeline_worker import run_all_tests_pipeline_worker
+from tests.tests_upload_blob_store import run_all_tests_upload_blob_store
+from tests.tests_pipeline_result_cache import run_all_tests_pipeline_result_cache
+from tests.tests_pipeline_output_catcher import run_all_tests_pipeline_output_catcher
 
 if mekeweserver_process.is_alive():
     try:
+        # the unit tests do not need the server. Run them first, so a failing API test does not hide their results.
+        run_all_tests_kegg_rest_cache()
+        run_all_tests_output_zip_stream()
+        run_all_tests_pipeline_status_clerk()
+        run_all_tests_pipeline_queue()
+        run_all_tests_pipeline_estimates()
+        run_all_tests_pipeline_worker()
+        run_all_tests_upload_blob_store()
+        run_all_tests_pipeline_result_cache()
+        run_all_tests_pipeline_output_catcher()
         run_all_tests_pipeline_run()
     except Exception as e:
         print("Error in user tests")
@@ -0,0 +1,230 @@
+from typing import List
+import io
+import os
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import fakeredis
+from PIL import Image
+
+from utils import call_route, patched_config
+import mekeweserver.fastapi_routes as fastapi_routes
+import mekeweserver.kegg_rest_cache as kegg_rest_cache
+from mekeweserver.kegg_rest_cache import (
+    MetaKeggKeggRestCache,
+    install_kegg_rest_cache,
+    uninstall_kegg_rest_cache,
+)
+
+STAND_IN_KGML = """<?xml version="1.0"?>
+<pathway name="path:hsa00010" org="hsa" number="00010" title="Glycolysis / Gluconeogenesis" image="https://www.kegg.jp/kegg/pathway/hsa/hsa00010.png" link="https://www.kegg.jp/kegg-bin/show_pathway?hsa00010">
+</pathway>
+"""
+
+
+def _get_stand_in_png() -> bytes:
+    png = io.BytesIO()
+    Image.new("RGB", (4, 4), "white").save(png, format="PNG")
+    return png.getvalue()
+
+
+class _StandInKeggHandler(BaseHTTPRequestHandler):
+    # paths (incl. the KEGG host) of all requests that reached the stand-in server
+    requested_paths: List[str] = []
+
+    def do_GET(self):
+        _StandInKeggHandler.requested_paths.append(self.path)
+        if self.path == "/rest.kegg.jp/get/hsa00010/kgml":
+            body = STAND_IN_KGML.encode("utf-8")
+        elif self.path == "/rest.kegg.jp/get/hsa00010":
+            body = b"ENTRY       hsa00010\n"
+        elif self.path in (
+            "/rest.kegg.jp/get/hsa00010/image",
+            "/www.kegg.jp/kegg/pathway/hsa/hsa00010.png",
+        ):
+            body = _get_stand_in_png()
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def _start_stand_in_kegg_server() -> ThreadingHTTPServer:
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _StandInKeggHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def test_kegg_rest_cache_hits_and_misses():
+    server = _start_stand_in_kegg_server()
+    _StandInKeggHandler.requested_paths = []
+    redis_client = fakeredis.FakeRedis()
+    cache = MetaKeggKeggRestCache(
+        redis_client=redis_client,
+        cache_dir=tempfile.mkdtemp(),
+        ttl_sec=3600,
+        upstream_base_url=f"http://127.0.0.1:{server.server_port}",
+    )
+    install_kegg_rest_cache(cache)
+    try:
+        from Bio.KEGG import REST
+        from Bio.KEGG.KGML import KGML_parser
+        from Bio.Graphics.KGML_vis import get_temp_imagefilename
+        import metaKEGG.helpers.helpfunctions as helpfunctions
+
+        for _ in range(3):
+            pathway = KGML_parser.read(REST.kegg_get("hsa00010", "kgml"))
+            assert pathway.title == "Glycolysis / Gluconeogenesis"
+            assert REST.kegg_get("hsa00010").read().startswith("ENTRY")
+            get_temp_imagefilename(pathway.image)
+            # metaKEGG fetches images via http
+            response = helpfunctions.requests.get(
+                "http://rest.kegg.jp/get/hsa00010/image"
+            )
+            assert response.status_code == 200
+            assert response.content == _get_stand_in_png()
+        # every resource was fetched only once
+        assert sorted(_StandInKeggHandler.requested_paths) == sorted(
+            [
+                "/rest.kegg.jp/get/hsa00010/kgml",
+                "/rest.kegg.jp/get/hsa00010",
+                "/www.kegg.jp/kegg/pathway/hsa/hsa00010.png",
+                "/rest.kegg.jp/get/hsa00010/image",
+            ]
+        ), _StandInKeggHandler.requested_paths
+        # cache hits are not throttled like requests to KEGG
+        started_at = time.monotonic()
+        for _ in range(10):
+            REST.kegg_get("hsa00010", "kgml").read()
+        assert time.monotonic() - started_at < 1
+        stats = cache.get_stats()
+        assert stats.entries == 4, stats
+        assert stats.misses == 4, stats
+        assert stats.hits == 18, stats
+        # the https and the http image URL are the same entry
+        assert (
+            helpfunctions.requests.get(
+                "https://rest.kegg.jp/get/hsa00010/image"
+            ).content
+            == _get_stand_in_png()
+        )
+        assert cache.get_stats().misses == 4
+        response = helpfunctions.requests.get("http://rest.kegg.jp/get/hsa99999/image")
+        assert response.status_code == 404
+    finally:
+        uninstall_kegg_rest_cache()
+        server.shutdown()
+
+
+def test_kegg_rest_cache_expiry():
+    server = _start_stand_in_kegg_server()
+    _StandInKeggHandler.requested_paths = []
+    cache = MetaKeggKeggRestCache(
+        redis_client=fakeredis.FakeRedis(),
+        cache_dir=tempfile.mkdtemp(),
+        ttl_sec=0,
+        upstream_base_url=f"http://127.0.0.1:{server.server_port}",
+    )
+    url = "https://rest.kegg.jp/get/hsa00010"
+    cache.get(url)
+    cache.get(url)
+    # expired entries are fetched again...
+    assert len(_StandInKeggHandler.requested_paths) == 2
+    server.shutdown()
+    server.server_close()
+    # ...but served if KEGG is not reachable
+    assert cache.get(url).startswith(b"ENTRY")
+    stats = cache.get_stats()
+    assert stats.stale_hits == 1, stats
+    assert stats.errors == 1, stats
+
+
+def test_kegg_rest_cache_ttl():
+    server = _start_stand_in_kegg_server()
+    _StandInKeggHandler.requested_paths = []
+    cache = MetaKeggKeggRestCache(
+        redis_client=fakeredis.FakeRedis(),
+        cache_dir=tempfile.mkdtemp(),
+        ttl_sec=3600,
+        upstream_base_url=f"http://127.0.0.1:{server.server_port}",
+    )
+    url = "https://rest.kegg.jp/get/hsa00010"
+    try:
+        cache.get(url)
+        entry_path = cache._get_entry_path(url)
+        # younger than the TTL: served from the cache
+        fetched_at = time.time() - 3500
+        os.utime(entry_path, (fetched_at, fetched_at))
+        assert cache.get(url).startswith(b"ENTRY")
+        assert len(_StandInKeggHandler.requested_paths) == 1
+        # older than the TTL: fetched again, which renews the entry
+        fetched_at = time.time() - 3700
+        os.utime(entry_path, (fetched_at, fetched_at))
+        assert cache.get(url).startswith(b"ENTRY")
+        assert len(_StandInKeggHandler.requested_paths) == 2
+        assert time.time() - entry_path.stat().st_mtime < 60
+        cache.get(url)
+        assert len(_StandInKeggHandler.requested_paths) == 2
+        # a refresh (see `mekeweserver.kegg_rest_cache_warmup`) ignores the TTL
+        cache.get(url, refresh=True)
+        assert len(_StandInKeggHandler.requested_paths) == 3
+        stats = cache.get_stats()
+        assert (stats.hits, stats.misses, stats.entries) == (2, 3, 1), stats
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_kegg_rest_cache_stats_endpoint():
+    redis_client = fakeredis.FakeRedis(server=fakeredis.FakeServer())
+    cache_dir = tempfile.mkdtemp()
+    with patched_config(
+        kegg_rest_cache.config,
+        KEGG_REST_CACHE_DIR=cache_dir,
+        KEGG_REST_CACHE_TTL_SEC=60,
+    ):
+        # empty cache
+        stats = call_route(
+            redis_client, fastapi_routes.get_info_config_router, "/stats/kegg-cache"
+        )
+        assert (stats.entries, stats.hits, stats.misses) == (0, 0, 0), stats
+        assert stats.hit_rate is None
+        server = _start_stand_in_kegg_server()
+        try:
+            cache = MetaKeggKeggRestCache(
+                redis_client=redis_client,
+                upstream_base_url=f"http://127.0.0.1:{server.server_port}",
+            )
+            for _ in range(4):
+                cache.get("https://rest.kegg.jp/get/hsa00010")
+        finally:
+            server.shutdown()
+            server.server_close()
+        # the endpoint reports the cache the workers filled
+        stats = call_route(
+            redis_client, fastapi_routes.get_info_config_router, "/stats/kegg-cache"
+        )
+    assert stats.entries == 1, stats
+    assert stats.size_bytes == len(b"ENTRY       hsa00010\n")
+    assert stats.ttl_sec == 60
+    assert (stats.hits, stats.misses) == (3, 1), stats
+    assert stats.hit_rate == 0.75
+
+
+def run_all_tests_kegg_rest_cache():
+    test_kegg_rest_cache_hits_and_misses()
+    test_kegg_rest_cache_expiry()
+    test_kegg_rest_cache_ttl()
+    test_kegg_rest_cache_stats_endpoint()
+
+
+if __name__ == "__main__":
+    run_all_tests_kegg_rest_cache()
+    print("TESTS SUCCEDED")
@@ -0,0 +1,135 @@
+import io
+import os
+import tempfile
+import zipfile
+from pathlib import Path
+
+import mekeweserver.output_zip_stream as output_zip_stream
+from mekeweserver.output_zip_stream import (
+    build_output_manifest,
+    iter_output_zip,
+    write_output_zip,
+)
+
+
+def test_output_zip_stream():
+    files_dir = Path(tempfile.mkdtemp())
+    files = {
+        "result.txt": b"gene\tvalue\n" * 1000,
+        "pathway map ä.png": os.urandom(3 * 1024 * 1024),
+        "empty.txt": b"",
+    }
+    for name, content in files.items():
+        Path(files_dir, name).write_bytes(content)
+    # sub directories are not part of the result zip
+    Path(files_dir, "tmp").mkdir()
+
+    manifest = build_output_manifest(files_dir)
+    chunks = list(iter_output_zip(files_dir, manifest))
+    zip_content = b"".join(chunks)
+    assert len(zip_content) == manifest.zip_size_bytes
+    # streamed in chunks, the zip never has to be in memory as a whole
+    assert max(len(chunk) for chunk in chunks) <= 1024 * 1024
+    with zipfile.ZipFile(io.BytesIO(zip_content)) as output_zip:
+        assert output_zip.testzip() is None
+        assert sorted(output_zip.namelist()) == sorted(files.keys())
+        # made on Unix, matching the Unix file modes in the external attributes
+        assert all(info.create_system == 3 for info in output_zip.infolist())
+        for name, content in files.items():
+            assert output_zip.read(name) == content
+
+
+def test_write_output_zip():
+    files_dir = Path(tempfile.mkdtemp())
+    files = {
+        # several chunks, which are deflated in parallel
+        "genes.csv": b"".join(
+            f"gene{i};{i * 0.37:.4f};{i % 97 / 1000:.5f}\n".encode()
+            for i in range(200000)
+        ),
+        "pathway.eps": b"%!PS-Adobe-3.0 EPSF-3.0\n" * 50000,
+        "pathway.png": os.urandom(512 * 1024),
+        "random.txt": os.urandom(512 * 1024),
+    }
+    for name, content in files.items():
+        Path(files_dir, name).write_bytes(content)
+    for compress_type in (zipfile.ZIP_DEFLATED, zipfile.ZIP_BZIP2, zipfile.ZIP_LZMA):
+        target_zip_file_path = Path(files_dir.parent, f"{files_dir.name}.zip")
+        files_size_bytes, zip_size_bytes = write_output_zip(
+            target_zip_file_path,
+            [(Path(files_dir, name), f"result/{name}") for name in files.keys()],
+            get_compress_type=lambda path: (
+                zipfile.ZIP_STORED if path.suffix == ".png" else compress_type
+            ),
+            compress_level=6,
+            max_workers=4,
+        )
+        assert files_size_bytes == sum(len(content) for content in files.values())
+        assert zip_size_bytes == target_zip_file_path.stat().st_size
+        with zipfile.ZipFile(target_zip_file_path) as output_zip:
+            assert output_zip.testzip() is None
+            # members keep their order
+            assert output_zip.namelist() == [f"result/{name}" for name in files.keys()]
+            compress_types = {
+                info.filename: info.compress_type for info in output_zip.infolist()
+            }
+            assert compress_types["result/genes.csv"] == compress_type
+            assert compress_types["result/pathway.eps"] == compress_type
+            assert compress_types["result/pathway.png"] == zipfile.ZIP_STORED
+            # incompressible files are stored
+            assert compress_types["result/random.txt"] == zipfile.ZIP_STORED
+            for name, content in files.items():
+                assert output_zip.read(f"result/{name}") == content
+        # no temporary files are left behind
+        assert sorted(p.name for p in files_dir.iterdir()) == sorted(files.keys())
+        target_zip_file_path.unlink()
+
+
+def test_write_output_zip_parallel_deflate():
+    files_dir = Path(tempfile.mkdtemp())
+    # compresses to about half, so the deflated member alone is several MiB
+    content = b"".join(
+        os.urandom(16).hex().encode() + b";pathway;gene;0.5\n" for _ in range(150000)
+    )
+    Path(files_dir, "genes.csv").write_bytes(content)
+    deflated_chunks = []
+    deflate_chunk = output_zip_stream._deflate_chunk
+
+    def count_deflated_chunks(chunk, *args):
+        deflated_chunks.append(len(chunk))
+        return deflate_chunk(chunk, *args)
+
+    output_zip_stream._deflate_chunk = count_deflated_chunks
+    target_zip_file_path = Path(files_dir.parent, f"{files_dir.name}.zip")
+    try:
+        _, zip_size_bytes = write_output_zip(
+            target_zip_file_path,
+            [(Path(files_dir, "genes.csv"), "result/genes.csv")],
+            get_compress_type=lambda path: zipfile.ZIP_DEFLATED,
+            compress_level=6,
+            max_workers=4,
+        )
+    finally:
+        output_zip_stream._deflate_chunk = deflate_chunk
+    assert zip_size_bytes > 1024 * 1024
+    assert zip_size_bytes < len(content)
+    # deflated chunk by chunk by the thread pool
+    assert len(deflated_chunks) == len(content) // (1024 * 1024) + 1
+    with zipfile.ZipFile(target_zip_file_path) as output_zip:
+        assert output_zip.testzip() is None
+        info = output_zip.getinfo("result/genes.csv")
+        assert info.compress_type == zipfile.ZIP_DEFLATED
+        assert info.file_size == len(content)
+        assert info.compress_size < zip_size_bytes
+        assert output_zip.read("result/genes.csv") == content
+
+
+def run_all_tests_output_zip_stream():
+    test_output_zip_stream()
+    test_write_output_zip()
+    test_write_output_zip_parallel_deflate()
+
+
+if __name__ == "__main__":
+    run_all_tests_output_zip_stream()
+    print("TESTS SUCCEDED")
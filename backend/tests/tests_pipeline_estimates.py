@@ -0,0 +1,208 @@
+import datetime
+import tempfile
+
+from utils import get_fakeredis_state_manager, patched_config, queue_pipeline_runs
+import mekeweserver.pipeline_status_clerk as pipeline_status_clerk
+import mekeweserver.model as model
+from mekeweserver.model import MetaKeggPipelineStatisticPoint
+from mekeweserver.pipeline_run_estimates import (
+    MetaKeggPipelineRunDurationEstimator,
+    estimate_start_offsets_sec,
+)
+
+
+def _statistic_point(
+    method_name: str, input_files_size_bytes: int, duration_sec: int, **values
+) -> MetaKeggPipelineStatisticPoint:
+    return MetaKeggPipelineStatisticPoint(
+        pipeline_waiting_time_sec=0,
+        pipeline_running_duration_sec=duration_sec,
+        pipeline_methodname=method_name,
+        pipeline_finished_at=datetime.datetime.now(tz=datetime.timezone.utc),
+        input_files_amount=1,
+        input_files_size_bytes=input_files_size_bytes,
+        result_file_size_bytes=None,
+        **values,
+    )
+
+
+def _assert_about(value: float, expected: float, tolerance: float = 2.0):
+    assert abs(value - expected) <= tolerance, f"Expected about {expected} got {value}"
+
+
+def _get_offset_sec(point_in_time: datetime.datetime) -> float:
+    return (
+        point_in_time - datetime.datetime.now(tz=datetime.timezone.utc)
+    ).total_seconds()
+
+
+def test_duration_estimator():
+    estimator = MetaKeggPipelineRunDurationEstimator(
+        [
+            # running time grows linear with the input size
+            _statistic_point("linear", 100, 10),
+            _statistic_point("linear", 200, 20),
+            _statistic_point("linear", 300, 30),
+            # not taken into account
+            _statistic_point("linear", 300, 1000, pipeline_failed=True),
+            _statistic_point("linear", 300, 0, result_from_cache=True),
+            # too few data points for a fit
+            _statistic_point("few", 100, 50),
+            _statistic_point("few", 200, 70),
+            # running time does not grow with the input size
+            _statistic_point("shrinking", 100, 30),
+            _statistic_point("shrinking", 200, 20),
+            _statistic_point("shrinking", 300, 10),
+        ],
+        default_duration_sec=300,
+    )
+    _assert_about(estimator.estimate_duration_sec("linear", 400), 40, 0.001)
+    _assert_about(estimator.estimate_duration_sec("linear"), 20, 0.001)
+    # at least a second
+    assert estimator.estimate_duration_sec("linear", 0) == 1.0
+    _assert_about(estimator.estimate_duration_sec("few", 1000), 60, 0.001)
+    _assert_about(estimator.estimate_duration_sec("shrinking", 1000), 20, 0.001)
+    # unknown method: average of all methods
+    _assert_about(estimator.estimate_duration_sec("unknown", 100), 30, 0.001)
+    _assert_about(estimator.estimate_duration_sec(), 30, 0.001)
+
+    # only failed pipeline runs are better than nothing
+    estimator = MetaKeggPipelineRunDurationEstimator(
+        [_statistic_point("linear", 100, 42, pipeline_failed=True)],
+        default_duration_sec=300,
+    )
+    assert estimator.estimate_duration_sec("unknown") == 42
+    estimator = MetaKeggPipelineRunDurationEstimator([], default_duration_sec=300)
+    assert estimator.estimate_duration_sec("linear", 100) == 300
+
+
+def test_start_offsets():
+    assert estimate_start_offsets_sec(1, [], [10, 20, 0]) == [0, 10, 30]
+    # one worker is busy for 5 more seconds
+    assert estimate_start_offsets_sec(2, [5.0], [10, 10, 10, 0]) == [0, 5, 10, 15]
+    # more pipeline runs are running than workers report a heartbeat
+    assert estimate_start_offsets_sec(1, [20.0, 5.0], [10, 0]) == [5, 15]
+    assert estimate_start_offsets_sec(3, [], [0]) == [0]
+
+
+def test_admission_retry_after():
+    config = pipeline_status_clerk.config
+    state_manager = get_fakeredis_state_manager()
+    state_manager.set_worker_heartbeat("worker-1")
+    with patched_config(
+        config,
+        PIPELINE_RUN_DEFAULT_DURATION_ESTIMATE_SEC=300,
+        PIPELINE_QUEUE_MAX_LENGTH=None,
+        PIPELINE_QUEUE_MAX_ESTIMATED_WAIT_SEC=None,
+    ):
+        # no limits, no admission control
+        queue_pipeline_runs(state_manager, 5)
+        assert state_manager.get_pipeline_run_admission_retry_after_sec() is None
+
+        # 5 queued pipeline runs of 300 sec and one worker. A new pipeline run would start in 1500 sec.
+        config.PIPELINE_QUEUE_MAX_LENGTH = 3
+        # the queue has room again when the third pipeline run is started
+        assert state_manager.get_pipeline_run_admission_retry_after_sec() in (599, 600)
+        config.PIPELINE_QUEUE_MAX_LENGTH = 6
+        assert state_manager.get_pipeline_run_admission_retry_after_sec() is None
+
+        config.PIPELINE_QUEUE_MAX_ESTIMATED_WAIT_SEC = 1000
+        assert state_manager.get_pipeline_run_admission_retry_after_sec() in (499, 500)
+        config.PIPELINE_QUEUE_MAX_ESTIMATED_WAIT_SEC = 2000
+        assert state_manager.get_pipeline_run_admission_retry_after_sec() is None
+
+        # both limits exceeded: retry when both are met again
+        config.PIPELINE_QUEUE_MAX_LENGTH = 4
+        config.PIPELINE_QUEUE_MAX_ESTIMATED_WAIT_SEC = 600
+        assert state_manager.get_pipeline_run_admission_retry_after_sec() in (899, 900)
+
+        # a second worker drains the queue twice as fast. A new pipeline run would start in 600 sec.
+        state_manager.set_worker_heartbeat("worker-2")
+        state_manager.refresh_queue_start_estimates()
+        config.PIPELINE_QUEUE_MAX_LENGTH = None
+        assert state_manager.get_pipeline_run_admission_retry_after_sec() is None
+        config.PIPELINE_QUEUE_MAX_ESTIMATED_WAIT_SEC = 300
+        assert state_manager.get_pipeline_run_admission_retry_after_sec() in (299, 300)
+
+
+def test_queue_start_estimates():
+    config = pipeline_status_clerk.config
+    state_manager = get_fakeredis_state_manager()
+    state_manager.set_worker_heartbeat("worker-1")
+    state_manager.set_worker_heartbeat("worker-2")
+    with patched_config(config, PIPELINE_RUN_DEFAULT_DURATION_ESTIMATE_SEC=300):
+        ticket_ids = queue_pipeline_runs(state_manager, 3)
+        # two workers take the first two pipeline runs right away
+        for ticket_id, expected_start_offset_sec in zip(ticket_ids, [0, 0, 300]):
+            pipeline_status = state_manager.get_pipeline_run_definition(ticket_id)
+            _assert_about(
+                _get_offset_sec(pipeline_status.estimated_start_at_utc),
+                expected_start_offset_sec,
+            )
+            _assert_about(
+                _get_offset_sec(pipeline_status.estimated_finish_at_utc),
+                expected_start_offset_sec + 300,
+            )
+        _assert_about(state_manager.get_estimated_queue_wait_sec(), 300)
+
+        # polling the status reads the stored estimates, it does not recompute them
+        last_ticket_start = state_manager.get_pipeline_run_definition(
+            ticket_ids[2]
+        ).estimated_start_at_utc
+        state_manager.remove_worker_heartbeat("worker-2")
+        assert (
+            state_manager.get_pipeline_run_definition(
+                ticket_ids[2]
+            ).estimated_start_at_utc
+            == last_ticket_start
+        )
+        state_manager.refresh_queue_start_estimates()
+        _assert_about(
+            _get_offset_sec(
+                state_manager.get_pipeline_run_definition(
+                    ticket_ids[2]
+                ).estimated_start_at_utc
+            ),
+            600,
+        )
+        _assert_about(state_manager.get_estimated_queue_wait_sec(), 900)
+
+        # a running pipeline run started when it started. The queue waits for it to finish.
+        running_status = state_manager.get_next_pipeline_run_from_queue(
+            worker_id="worker-1"
+        )
+        assert running_status.ticket.id == ticket_ids[0]
+        running_status = state_manager.get_pipeline_run_definition(ticket_ids[0])
+        assert running_status.estimated_start_at_utc == running_status.started_at_utc
+        _assert_about(_get_offset_sec(running_status.estimated_finish_at_utc), 300)
+        assert (
+            state_manager.redis_client.zscore(
+                state_manager.REDIS_NAME_PIPELINE_QUEUE_START_ESTIMATES,
+                ticket_ids[0].hex,
+            )
+            is None
+        )
+        for ticket_id, expected_start_offset_sec in zip(ticket_ids[1:], [300, 600]):
+            _assert_about(
+                _get_offset_sec(
+                    state_manager.get_pipeline_run_definition(
+                        ticket_id
+                    ).estimated_start_at_utc
+                ),
+                expected_start_offset_sec,
+            )
+        _assert_about(state_manager.get_estimated_queue_wait_sec(), 900)
+
+
+def run_all_tests_pipeline_estimates():
+    # the pipeline runs of these tests get empty input directories
+    with patched_config(model.config, PIPELINE_RUNS_CACHE_DIR=tempfile.mkdtemp()):
+        test_duration_estimator()
+        test_start_offsets()
+        test_admission_retry_after()
+        test_queue_start_estimates()
+
+
+if __name__ == "__main__":
+    run_all_tests_pipeline_estimates()
+    print("TESTS SUCCEDED")
@@ -0,0 +1,111 @@
+import asyncio
+import logging
+import sys
+import threading
+import time
+from typing import List
+
+from utils import patched_config
+import mekeweserver.pipeline_worker.pipeline_output_catcher as pipeline_output_catcher
+from mekeweserver.log import get_logger
+from mekeweserver.pipeline_worker.pipeline_output_catcher import OutputCatcher
+
+
+class _RecordingOutputHandler:
+    def __init__(self):
+        self.batches: List[List[str]] = []
+        self.called = threading.Event()
+
+    def __call__(self, lines: List[str], original_stdout):
+        self.batches.append(lines)
+        self.called.set()
+
+    def get_lines(self) -> List[str]:
+        return [line for batch in self.batches for line in batch]
+
+
+def test_batched_output():
+    output_handler = _RecordingOutputHandler()
+    with OutputCatcher(
+        output_handler, flush_interval_sec=60, flush_size_bytes=1024 * 1024
+    ):
+        for number in range(100):
+            print(f"line {number}")
+        print("no newline", end="")
+        # lines are buffered, the analysis does not wait for the output handler
+        assert output_handler.batches == []
+    # incl. the last line without newline
+    assert output_handler.get_lines() == [f"line {number}" for number in range(100)] + [
+        "no newline"
+    ]
+
+    output_handler = _RecordingOutputHandler()
+    with OutputCatcher(output_handler, flush_interval_sec=60, flush_size_bytes=10):
+        print("more than ten bytes")
+        # the flusher thread hands the lines over as soon as enough bytes are buffered
+        assert output_handler.called.wait(5)
+        assert output_handler.batches == [["more than ten bytes"]]
+        print("after the flush")
+    assert output_handler.get_lines() == ["more than ten bytes", "after the flush"]
+
+
+async def _analysis():
+    print("stdout")
+    sys.stderr.write("stderr\n")
+    # e.g. metaKEGG does blocking work in an executor thread
+    await asyncio.get_running_loop().run_in_executor(
+        None, lambda: print("executor thread")
+    )
+    logging.getLogger("some.dependency").warning("dependency warning")
+    logging.getLogger("some.dependency").debug("dependency debug")
+    get_logger().warning("server warning")
+
+
+def test_captures_stderr_log_records_and_threads():
+    root_logger = logging.getLogger()
+    root_level = root_logger.level
+    root_handlers = list(root_logger.handlers)
+    original_stdout = sys.stdout
+    original_stderr = sys.stderr
+    output_handler = _RecordingOutputHandler()
+    with patched_config(
+        pipeline_output_catcher.config, PIPELINE_RUN_OUTPUT_LOG_LEVEL="INFO"
+    ):
+        with OutputCatcher(output_handler, flush_interval_sec=60):
+            asyncio.run(_analysis())
+            # the level of the root logger is not changed for the whole process
+            assert root_logger.level == root_level
+    assert output_handler.get_lines() == [
+        "stdout",
+        "stderr",
+        "executor thread",
+        "WARNING:some.dependency:dependency warning",
+    ]
+    # everything is restored on exit
+    assert sys.stdout is original_stdout
+    assert sys.stderr is original_stderr
+    assert root_logger.handlers == root_handlers
+    print("not captured")
+    assert len(output_handler.get_lines()) == 4
+
+
+def test_failing_output_handler():
+    def output_handler(lines: List[str], original_stdout):
+        raise ConnectionError("database is gone")
+
+    # losing output lines must not fail the analysis
+    with OutputCatcher(output_handler, flush_interval_sec=0.01):
+        print("lost")
+        time.sleep(0.05)
+        print("lost too")
+
+
+def run_all_tests_pipeline_output_catcher():
+    test_batched_output()
+    test_captures_stderr_log_records_and_threads()
+    test_failing_output_handler()
+
+
+if __name__ == "__main__":
+    run_all_tests_pipeline_output_catcher()
+    print("TESTS SUCCEDED")
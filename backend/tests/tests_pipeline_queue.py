@@ -0,0 +1,436 @@
+from typing import List
+import tempfile
+import threading
+import time
+import uuid
+import fakeredis
+from starlette.requests import Request
+
+from utils import get_fakeredis_state_manager, patched_config, queue_pipeline_runs
+from mekeweserver.pipeline_status_clerk import MetaKeggPipelineStateManager
+import mekeweserver.pipeline_status_clerk as pipeline_status_clerk
+from mekeweserver.pipeline_queue import MetaKeggPipelineQueue
+import mekeweserver.pipeline_queue as pipeline_queue
+import mekeweserver.model as model
+import mekeweserver.client_address as client_address
+
+
+def test_reliable_dequeue():
+    state_manager = get_fakeredis_state_manager()
+    ticket_ids = queue_pipeline_runs(state_manager, 3)
+    assert [
+        state_manager.get_pipeline_run_definition(t).place_in_queue for t in ticket_ids
+    ] == [1, 2, 3]
+    processing_list_name = state_manager._get_processing_list_name("worker-1")
+
+    pipeline_status = state_manager.get_next_pipeline_run_from_queue(
+        worker_id="worker-1"
+    )
+    assert pipeline_status.ticket.id == ticket_ids[0]
+    assert pipeline_status.state == "running"
+    assert pipeline_status.run_attempts == 1
+    assert state_manager.get_pipeline_run_definition(ticket_ids[1]).place_in_queue == 1
+    # the ticket stays in the processing list of the worker until it is acknowledged
+    assert state_manager.redis_client.lrange(processing_list_name, 0, -1) == [
+        ticket_ids[0].hex.encode()
+    ]
+    state_manager.set_pipeline_state_as_finished(ticket_ids[0])
+    state_manager.acknowledge_pipeline_run_processed("worker-1", ticket_ids[0])
+    assert state_manager.redis_client.llen(processing_list_name) == 0
+
+    # the worker dies while processing two pipeline runs. On restart they are put back into the queue, the oldest first.
+    state_manager.get_next_pipeline_run_from_queue(worker_id="worker-1")
+    state_manager.get_next_pipeline_run_from_queue(worker_id="worker-1")
+    assert state_manager.queue.get_length() == 0
+    assert state_manager.requeue_unfinished_pipeline_runs_of_worker("worker-1") == [
+        ticket_ids[2],
+        ticket_ids[1],
+    ]
+    assert state_manager.redis_client.llen(processing_list_name) == 0
+    assert [
+        state_manager.get_pipeline_run_definition(t).place_in_queue
+        for t in ticket_ids[1:]
+    ] == [1, 2]
+    assert state_manager.get_next_pipeline_run_from_queue().ticket.id == ticket_ids[1]
+
+    # waits for a ticket, but not longer than the timeout
+    state_manager.get_next_pipeline_run_from_queue()
+    started_at = time.monotonic()
+    assert state_manager.get_next_pipeline_run_from_queue(block_timeout_sec=1) is None
+    assert time.monotonic() - started_at < 5
+
+
+def _let_lease_lapse(state_manager: MetaKeggPipelineStateManager, ticket_id: uuid.UUID):
+    state_manager.redis_client.pexpire(state_manager._get_lease_name(ticket_id), 1)
+    time.sleep(0.05)
+
+
+def test_lease_expiry():
+    state_manager = get_fakeredis_state_manager()
+    ticket_id, next_ticket_id = queue_pipeline_runs(state_manager, 2)
+    with patched_config(pipeline_status_clerk.config, PIPELINE_RUN_MAX_ATTEMPTS=2):
+        state_manager.get_next_pipeline_run_from_queue(worker_id="worker-1")
+        # the worker is alive and refreshes the lease
+        assert state_manager.refresh_pipeline_run_lease(ticket_id)
+        assert state_manager.recover_pipeline_runs_with_lapsed_lease() == []
+
+        # the worker crashed. The pipeline run goes back to the head of the queue.
+        _let_lease_lapse(state_manager, ticket_id)
+        assert not state_manager.refresh_pipeline_run_lease(ticket_id)
+        assert state_manager.recover_pipeline_runs_with_lapsed_lease() == [ticket_id]
+        pipeline_status = state_manager.get_pipeline_run_definition(ticket_id)
+        assert pipeline_status.state == "queued"
+        assert pipeline_status.place_in_queue == 1
+        assert pipeline_status.started_at_utc is None
+        assert (
+            state_manager.redis_client.llen(
+                state_manager._get_processing_list_name("worker-1")
+            )
+            == 0
+        )
+
+        # after `PIPELINE_RUN_MAX_ATTEMPTS` attempts the pipeline run is given up
+        pipeline_status = state_manager.get_next_pipeline_run_from_queue(
+            worker_id="worker-2"
+        )
+        assert pipeline_status.ticket.id == ticket_id
+        assert pipeline_status.run_attempts == 2
+        _let_lease_lapse(state_manager, ticket_id)
+        assert state_manager.recover_pipeline_runs_with_lapsed_lease() == []
+        pipeline_status = state_manager.get_pipeline_run_definition(ticket_id)
+        assert pipeline_status.state == "failed"
+        assert "interrupted 2 times" in pipeline_status.error, pipeline_status.error
+        assert (
+            state_manager.get_pipeline_run_definition(next_ticket_id).place_in_queue
+            == 1
+        )
+
+        # a restarted worker already requeued its pipeline run. The recovery sweep must not requeue it twice.
+        state_manager.get_next_pipeline_run_from_queue(worker_id="worker-3")
+        _let_lease_lapse(state_manager, next_ticket_id)
+        assert state_manager.requeue_unfinished_pipeline_runs_of_worker("worker-3") == [
+            next_ticket_id
+        ]
+        assert state_manager.recover_pipeline_runs_with_lapsed_lease() == []
+        assert state_manager.queue.get_length() == 1
+
+
+def test_cancel():
+    state_manager = get_fakeredis_state_manager()
+    running_ticket_id, queued_ticket_id, next_ticket_id = queue_pipeline_runs(
+        state_manager, 3
+    )
+    state_manager.get_next_pipeline_run_from_queue(worker_id="worker-1")
+
+    # a queued pipeline run is canceled right away
+    pipeline_status = state_manager.cancel_pipeline_run(queued_ticket_id)
+    assert pipeline_status.state == "failed"
+    assert pipeline_status.error == "The pipeline run was canceled."
+    assert pipeline_status.place_in_queue is None
+    assert not pipeline_status.get_input_files_base_dir().exists()
+    assert not state_manager.is_pipeline_run_cancel_requested(queued_ticket_id)
+    assert state_manager.get_pipeline_run_definition(next_ticket_id).place_in_queue == 1
+
+    # a running pipeline run gets a cancel request for its worker
+    pipeline_status = state_manager.cancel_pipeline_run(running_ticket_id)
+    assert pipeline_status.state == "running"
+    assert state_manager.is_pipeline_run_cancel_requested(running_ticket_id)
+    # if its worker dies, it is not requeued
+    _let_lease_lapse(state_manager, running_ticket_id)
+    assert state_manager.recover_pipeline_runs_with_lapsed_lease() == []
+    pipeline_status = state_manager.get_pipeline_run_definition(running_ticket_id)
+    assert pipeline_status.state == "failed"
+    assert pipeline_status.error == "The pipeline run was canceled."
+    assert not state_manager.is_pipeline_run_cancel_requested(running_ticket_id)
+    assert state_manager.queue.get_length() == 1
+
+    # finished pipeline runs can not be canceled anymore
+    state_manager.get_next_pipeline_run_from_queue(worker_id="worker-1")
+    state_manager.set_pipeline_state_as_finished(next_ticket_id)
+    assert state_manager.cancel_pipeline_run(next_ticket_id).state == "success"
+    assert not state_manager.is_pipeline_run_cancel_requested(next_ticket_id)
+
+
+def _dequeue_all(state_manager: MetaKeggPipelineStateManager) -> List[uuid.UUID]:
+    ticket_ids = []
+    while (
+        pipeline_status := state_manager.get_next_pipeline_run_from_queue()
+    ) is not None:
+        ticket_ids.append(pipeline_status.ticket.id)
+    return ticket_ids
+
+
+def test_fair_queue_ordering():
+    state_manager = get_fakeredis_state_manager()
+    # client A submits a batch. Client B comes later, but does not wait for the whole batch.
+    a_ticket_ids = queue_pipeline_runs(state_manager, 4, client_key="A")
+    b_ticket_ids = queue_pipeline_runs(state_manager, 2, client_key="B")
+    clients = ["A" if t in a_ticket_ids else "B" for t in _dequeue_all(state_manager)]
+    # tickets with the same tag are picked in any order
+    assert sorted(clients[0:2]) == sorted(clients[2:4]) == ["A", "B"], clients
+    assert clients[4:] == ["A", "A"], clients
+
+    with patched_config(
+        pipeline_queue.config,
+        PIPELINE_QUEUE_CLIENT_PRIORITIES={"VIP": 1},
+        PIPELINE_QUEUE_CLIENT_WEIGHTS={"heavy": 2},
+    ):
+        a_ticket_ids = queue_pipeline_runs(state_manager, 2, client_key="A")
+        heavy_ticket_ids = queue_pipeline_runs(state_manager, 2, client_key="heavy")
+        vip_ticket_ids = queue_pipeline_runs(state_manager, 1, client_key="VIP")
+        # a higher priority class goes first, no matter how many tickets wait
+        assert (
+            state_manager.get_pipeline_run_definition(vip_ticket_ids[0]).place_in_queue
+            == 1
+        )
+        ticket_ids = _dequeue_all(state_manager)
+        assert ticket_ids[0] == vip_ticket_ids[0]
+        # a client with twice the weight gets twice the share
+        assert ticket_ids[1] == heavy_ticket_ids[0]
+        assert ticket_ids[-1] == a_ticket_ids[1]
+
+    with patched_config(pipeline_queue.config, PIPELINE_QUEUE_SCHEDULING="fifo"):
+        ticket_ids = queue_pipeline_runs(state_manager, 3, client_key="A")
+        ticket_ids += queue_pipeline_runs(state_manager, 2, client_key="B")
+        assert _dequeue_all(state_manager) == ticket_ids
+
+
+def test_concurrent_enqueue():
+    queue = MetaKeggPipelineQueue(fakeredis.FakeRedis(server=fakeredis.FakeServer()))
+
+    def enqueue_batch():
+        for _ in range(20):
+            queue.enqueue(uuid.uuid4(), client_key="A")
+
+    threads = [threading.Thread(target=enqueue_batch) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    tags = [
+        tag
+        for _, tag in queue.redis_client.zrange(
+            queue._get_queue_name(0), 0, -1, withscores=True
+        )
+    ]
+    # every ticket of a client gets its own tag, even if the client enqueues concurrently
+    assert sorted(tags) == [float(i) for i in range(1, 81)], tags
+
+
+def test_place_in_queue():
+    queue = MetaKeggPipelineQueue(fakeredis.FakeRedis(server=fakeredis.FakeServer()))
+    # the former plain FIFO list, consumed from the right side
+    legacy_ticket_ids = [uuid.uuid4() for _ in range(3)]
+    queue.redis_client.lpush(
+        queue.LEGACY_REDIS_NAME_QUEUE, *[t.hex for t in legacy_ticket_ids]
+    )
+    queue.migrate_legacy_queue()
+    assert [queue.get_place_in_queue(t) for t in legacy_ticket_ids] == [1, 2, 3]
+
+    with patched_config(
+        pipeline_queue.config, PIPELINE_QUEUE_CLIENT_PRIORITIES={"VIP": 1}
+    ):
+        vip_ticket_id = uuid.uuid4()
+        queue.enqueue(vip_ticket_id, client_key="VIP")
+    # the higher priority class is ahead of all other tickets
+    assert queue.get_place_in_queue(vip_ticket_id) == 1
+    assert [queue.get_place_in_queue(t) for t in legacy_ticket_ids] == [2, 3, 4]
+
+    assert queue.dequeue() == vip_ticket_id
+    assert queue.get_place_in_queue(vip_ticket_id) is None
+    assert queue.remove(legacy_ticket_ids[1])
+    assert [queue.get_place_in_queue(t) for t in legacy_ticket_ids] == [1, None, 2]
+    queue.enqueue_at_head(legacy_ticket_ids[1])
+    assert [queue.get_place_in_queue(t) for t in legacy_ticket_ids] == [2, 1, 3]
+    # the positions match the order in which the tickets are picked
+    assert queue.get_ticket_ids() == [
+        legacy_ticket_ids[1],
+        legacy_ticket_ids[0],
+        legacy_ticket_ids[2],
+    ]
+    assert [queue.dequeue() for _ in range(4)] == [
+        legacy_ticket_ids[1],
+        legacy_ticket_ids[0],
+        legacy_ticket_ids[2],
+        None,
+    ]
+
+
+def test_wakeup_signal():
+    state_manager = get_fakeredis_state_manager()
+    redis_client = state_manager.redis_client
+    signal_name = MetaKeggPipelineQueue.REDIS_NAME_SIGNAL
+    # the signal list holds at most one token, no matter how many tickets were enqueued
+    queue_pipeline_runs(state_manager, 5)
+    assert redis_client.llen(signal_name) == 1
+    _dequeue_all(state_manager)
+
+    # idle workers are woken one after the other as long as tickets are left
+    picked_ticket_ids = []
+
+    def idle_worker():
+        pipeline_status = state_manager.get_next_pipeline_run_from_queue(
+            block_timeout_sec=10
+        )
+        picked_ticket_ids.append(pipeline_status.ticket.id if pipeline_status else None)
+
+    redis_client.delete(signal_name)
+    workers = [threading.Thread(target=idle_worker) for _ in range(3)]
+    for worker in workers:
+        worker.start()
+    time.sleep(0.2)
+    started_at = time.monotonic()
+    # one token for three tickets
+    ticket_ids = queue_pipeline_runs(state_manager, 3)
+    for worker in workers:
+        worker.join()
+    assert time.monotonic() - started_at < 5
+    assert sorted(picked_ticket_ids) == sorted(ticket_ids)
+    assert redis_client.llen(signal_name) == 0
+
+    # a leftover token wakes a worker only once
+    queue_pipeline_runs(state_manager, 1)
+    _dequeue_all(state_manager)
+    assert redis_client.llen(signal_name) == 1
+    started_at = time.monotonic()
+    assert state_manager.get_next_pipeline_run_from_queue(block_timeout_sec=5) is None
+    assert time.monotonic() - started_at < 1
+    assert redis_client.llen(signal_name) == 0
+
+
+def test_ticket_priorities():
+    state_manager = get_fakeredis_state_manager()
+    queue = state_manager.queue
+    redis_client = state_manager.redis_client
+
+    def get_priorities():
+        return {
+            name: {
+                uuid.UUID(raw_ticket_id.decode("utf-8")): int(raw_priority)
+                for raw_ticket_id, raw_priority in redis_client.hgetall(name).items()
+            }
+            for name in [
+                queue.REDIS_NAME_TICKET_PRIORITIES,
+                queue.REDIS_NAME_DEQUEUED_TICKET_PRIORITIES,
+            ]
+        }
+
+    with patched_config(
+        pipeline_queue.config, PIPELINE_QUEUE_CLIENT_PRIORITIES={"VIP": 1}
+    ):
+        vip_ticket_id, removed_ticket_id = queue_pipeline_runs(
+            state_manager, 2, client_key="VIP"
+        )
+    ticket_id = queue_pipeline_runs(state_manager, 1)[0]
+    assert get_priorities() == {
+        queue.REDIS_NAME_TICKET_PRIORITIES: {
+            vip_ticket_id: 1,
+            removed_ticket_id: 1,
+            ticket_id: 0,
+        },
+        queue.REDIS_NAME_DEQUEUED_TICKET_PRIORITIES: {},
+    }
+    assert queue.remove(removed_ticket_id)
+    assert not queue.remove(removed_ticket_id)
+    # a dequeued ticket keeps its priority class until it is finished
+    assert (
+        state_manager.get_next_pipeline_run_from_queue(worker_id="worker-1").ticket.id
+        == vip_ticket_id
+    )
+    assert get_priorities() == {
+        queue.REDIS_NAME_TICKET_PRIORITIES: {ticket_id: 0},
+        queue.REDIS_NAME_DEQUEUED_TICKET_PRIORITIES: {vip_ticket_id: 1},
+    }
+    # interrupted, it goes back to the head of its priority class
+    state_manager.requeue_pipeline_run_of_stopping_worker("worker-1", vip_ticket_id)
+    assert queue.get_ticket_ids() == [vip_ticket_id, ticket_id]
+    assert get_priorities() == {
+        queue.REDIS_NAME_TICKET_PRIORITIES: {vip_ticket_id: 1, ticket_id: 0},
+        queue.REDIS_NAME_DEQUEUED_TICKET_PRIORITIES: {},
+    }
+    for expected_ticket_id in [vip_ticket_id, ticket_id]:
+        pipeline_status = state_manager.get_next_pipeline_run_from_queue(
+            worker_id="worker-1"
+        )
+        assert pipeline_status.ticket.id == expected_ticket_id
+        state_manager.set_pipeline_state_as_finished(expected_ticket_id)
+        state_manager.acknowledge_pipeline_run_processed("worker-1", expected_ticket_id)
+    # nothing is left behind
+    assert get_priorities() == {
+        queue.REDIS_NAME_TICKET_PRIORITIES: {},
+        queue.REDIS_NAME_DEQUEUED_TICKET_PRIORITIES: {},
+    }
+
+
+def test_concurrent_enqueue_at_head():
+    queue = MetaKeggPipelineQueue(fakeredis.FakeRedis(server=fakeredis.FakeServer()))
+    ticket_ids = [uuid.uuid4() for _ in range(40)]
+
+    def enqueue_at_head_batch(ticket_ids: List[uuid.UUID]):
+        for ticket_id in ticket_ids:
+            queue.enqueue_at_head(ticket_id)
+
+    threads = [
+        threading.Thread(target=enqueue_at_head_batch, args=(ticket_ids[i::4],))
+        for i in range(4)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    tags = [
+        tag
+        for _, tag in queue.redis_client.zrange(
+            queue._get_queue_name(0), 0, -1, withscores=True
+        )
+    ]
+    # every ticket got its own place in front of the others
+    assert sorted(tags) == [float(-i) for i in range(40, 0, -1)], tags
+
+
+def test_client_key_from_forwarded_headers():
+    def get_request(headers: dict) -> Request:
+        return Request(
+            {
+                "type": "http",
+                "client": ("10.0.0.1", 1234),
+                "headers": [
+                    (name.lower().encode(), value.encode())
+                    for name, value in headers.items()
+                ],
+            }
+        )
+
+    forwarded_headers = {"X-Forwarded-For": "1.2.3.4, 10.0.0.2", "X-Real-IP": "5.6.7.8"}
+    with patched_config(client_address.config, SERVER_TRUST_FORWARDED_HEADERS=False):
+        assert client_address.get_client_address(get_request(forwarded_headers)) == (
+            "10.0.0.1"
+        )
+    with patched_config(client_address.config, SERVER_TRUST_FORWARDED_HEADERS=True):
+        assert client_address.get_client_address(get_request(forwarded_headers)) == (
+            "1.2.3.4"
+        )
+        assert (
+            client_address.get_client_address(get_request({"X-Real-IP": "5.6.7.8"}))
+            == "5.6.7.8"
+        )
+        assert client_address.get_client_address(get_request({})) == "10.0.0.1"
+
+
+def run_all_tests_pipeline_queue():
+    with patched_config(model.config, PIPELINE_RUNS_CACHE_DIR=tempfile.mkdtemp()):
+        test_reliable_dequeue()
+        test_lease_expiry()
+        test_cancel()
+        test_fair_queue_ordering()
+        test_concurrent_enqueue()
+        test_place_in_queue()
+        test_wakeup_signal()
+        test_ticket_priorities()
+        test_concurrent_enqueue_at_head()
+        test_client_key_from_forwarded_headers()
+
+
+if __name__ == "__main__":
+    run_all_tests_pipeline_queue()
+    print("TESTS SUCCEDED")
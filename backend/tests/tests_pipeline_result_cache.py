@@ -0,0 +1,173 @@
+import os
+import tempfile
+import zipfile
+from pathlib import Path
+
+import fakeredis
+from metaKEGG.modules.pipeline_async import PipelineAsync
+
+from utils import get_fakeredis_state_manager, patched_config, queue_pipeline_runs
+import mekeweserver.pipeline_result_cache as pipeline_result_cache
+import mekeweserver.pipeline_worker.pipeline_processor as pipeline_processor
+from mekeweserver.pipeline_result_cache import MetaKeggPipelineResultCache
+from mekeweserver.pipeline_worker.pipeline_processor import MetakeggPipelineProcessor
+
+
+def _get_result_cache():
+    with patched_config(
+        pipeline_result_cache.config, PIPELINE_RESULT_CACHE_DIR=tempfile.mkdtemp()
+    ):
+        return MetaKeggPipelineResultCache(
+            fakeredis.FakeRedis(server=fakeredis.FakeServer())
+        )
+
+
+def _write_zip(content: bytes) -> Path:
+    zip_path = Path(tempfile.mkdtemp(), "result.zip")
+    with zipfile.ZipFile(zip_path, "w") as zip_file:
+        zip_file.writestr("result.txt", content)
+    return zip_path
+
+
+def test_compute_key():
+    input_dir = Path(tempfile.mkdtemp())
+    for name, content in [("a.txt", "genes"), ("b.txt", "genes"), ("c.txt", "other")]:
+        Path(input_dir, name).write_text(content)
+
+    def compute_key(input_file_name: str, method_params: dict = None):
+        input_file_path = Path(input_dir, input_file_name)
+        return MetaKeggPipelineResultCache.compute_key(
+            method_name="gene_expression",
+            global_params={"input_file_path": str(input_file_path)},
+            method_params=method_params or {"count_threshold": 2},
+            input_file_paths=[input_file_path],
+            metakegg_version="1.0.0",
+        )
+
+    # input files are identified by their content, not their name
+    assert compute_key("a.txt") == compute_key("b.txt")
+    assert compute_key("a.txt") != compute_key("c.txt")
+    assert compute_key("a.txt") != compute_key("a.txt", {"count_threshold": 3})
+
+
+def test_get_and_put():
+    result_cache = _get_result_cache()
+    assert result_cache.get("key-1") is None
+    output_zip_path = _write_zip(b"result 1")
+    result_cache.put("key-1", output_zip_path)
+    cached_zip_path = result_cache.get("key-1")
+    assert cached_zip_path.read_bytes() == output_zip_path.read_bytes()
+    # the pipeline run appends its output log to its own zip after storing it. The cached zip must not change with it.
+    assert cached_zip_path.stat().st_ino != output_zip_path.stat().st_ino
+    # storing a result under a known key again does not count its size twice
+    result_cache.put("key-1", output_zip_path)
+    stats = result_cache.get_stats()
+    assert stats.entries == 1
+    assert stats.size_bytes == output_zip_path.stat().st_size
+    assert (stats.hits, stats.misses, stats.stores, stats.evictions) == (1, 1, 1, 0)
+    # no temporary files are left behind
+    assert [p.name for p in result_cache.cache_dir.iterdir()] == ["key-1.zip"]
+
+
+def test_eviction():
+    zip_size_bytes = _write_zip(b"result").stat().st_size
+    with patched_config(
+        pipeline_result_cache.config,
+        PIPELINE_RESULT_CACHE_MAX_SIZE_BYTES=zip_size_bytes * 2,
+    ):
+        result_cache = _get_result_cache()
+        result_cache.put("key-1", _write_zip(b"result"))
+        result_cache.put("key-2", _write_zip(b"result"))
+        # key-1 is the most recently used entry now
+        assert result_cache.get("key-1") is not None
+        result_cache.put("key-3", _write_zip(b"result"))
+        assert result_cache.get("key-2") is None
+        assert result_cache.get("key-1") is not None
+        assert result_cache.get("key-3") is not None
+        assert sorted(p.name for p in result_cache.cache_dir.iterdir()) == [
+            "key-1.zip",
+            "key-3.zip",
+        ]
+        stats = result_cache.get_stats()
+        assert stats.size_bytes == zip_size_bytes * 2
+        assert stats.evictions == 1
+        # results bigger than the whole cache are not stored at all
+        result_cache.put("key-4", _write_zip(os.urandom(zip_size_bytes * 2)))
+        assert result_cache.get("key-4") is None
+        assert result_cache.get_stats().evictions == 1
+
+
+async def _fake_gene_expression(self):
+    print(f"analysing {self.input_file_path}")
+    output_dir = Path(os.path.dirname(self.input_file_path), self.output_folder_name)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    Path(output_dir, "result.txt").write_text(Path(self.input_file_path).read_text())
+
+
+def test_cache_hit_does_not_ship_output_log_of_other_pipeline_run():
+    state_manager = get_fakeredis_state_manager()
+    result_cache_dir = tempfile.mkdtemp()
+    original_gene_expression = PipelineAsync.gene_expression
+    PipelineAsync.gene_expression = _fake_gene_expression
+    try:
+        with patched_config(
+            pipeline_processor.config,
+            PIPELINE_RUN_IN_SUBPROCESS=False,
+            PIPELINE_RESULT_CACHE_ENABLED=True,
+            KEGG_REST_CACHE_ENABLED=False,
+            PIPELINE_RUN_RESULT_ZIP_MODE="prebuilt",
+        ), patched_config(
+            pipeline_result_cache.config, PIPELINE_RESULT_CACHE_DIR=result_cache_dir
+        ):
+            ticket_ids = queue_pipeline_runs(state_manager, 2)
+            output_zip_members = []
+            for ticket_id in ticket_ids:
+                pipeline_status = state_manager.get_pipeline_run_definition(ticket_id)
+                input_file_dir = pipeline_status.get_input_file_dir("input_file_path")
+                input_file_dir.mkdir(parents=True)
+                Path(input_file_dir, "input.txt").write_text("genes")
+                state_manager.update_pipeline_run_definition_fields(
+                    ticket_id,
+                    pipeline_input_file_names={"input_file_path": ["input.txt"]},
+                )
+                pipeline_status = MetakeggPipelineProcessor(
+                    state_manager.get_pipeline_run_definition(ticket_id),
+                    state_manager,
+                ).run()
+                assert (
+                    pipeline_status.state == "success"
+                ), pipeline_status.error_traceback
+                with zipfile.ZipFile(
+                    pipeline_status.get_output_zip_file_path()
+                ) as zip_file:
+                    output_zip_members.append(
+                        {name: zip_file.read(name) for name in zip_file.namelist()}
+                    )
+    finally:
+        PipelineAsync.gene_expression = original_gene_expression
+
+    output_log_name = (
+        pipeline_processor.config.PIPELINE_RUN_OUTPUT_LOG_ARCHIVE_FILE_NAME
+    )
+    first_run_members, second_run_members = output_zip_members
+    # the first pipeline run ships its own output log
+    assert first_run_members["result.txt"] == b"genes"
+    assert ticket_ids[0].hex.encode() in first_run_members[output_log_name]
+    # the second pipeline run completed from the result cache, without the output log of the first one
+    assert state_manager.get_pipeline_run_definition(ticket_ids[1]).result_from_cache
+    assert second_run_members == {"result.txt": b"genes"}
+    for cached_zip_path in Path(result_cache_dir).iterdir():
+        with zipfile.ZipFile(cached_zip_path) as zip_file:
+            assert zip_file.namelist() == ["result.txt"]
+
+
+def run_all_tests_pipeline_result_cache():
+    test_compute_key()
+    test_get_and_put()
+    test_eviction()
+    test_cache_hit_does_not_ship_output_log_of_other_pipeline_run()
+
+
+if __name__ == "__main__":
+    run_all_tests_pipeline_result_cache()
+    print("TESTS SUCCEDED")
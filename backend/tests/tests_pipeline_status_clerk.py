@@ -0,0 +1,522 @@
+from typing import List, get_args
+import datetime
+import tempfile
+import threading
+import time
+import uuid
+from pathlib import Path
+
+from utils import get_fakeredis_state_manager, patched_config
+from mekeweserver.pipeline_status_clerk import MetaKeggPipelineStateManager
+import mekeweserver.pipeline_status_clerk as pipeline_status_clerk
+from mekeweserver.pipeline_worker.pipeline_housekeeper import PipelineHousekeeper
+import mekeweserver.pipeline_worker.pipeline_housekeeper as pipeline_housekeeper
+from mekeweserver.model import (
+    MetaKeggPipelineDefStates,
+    MetaKeggPipelineInputParamsValuesAllOptional,
+)
+
+
+def _create_pipeline_run(state_manager: MetaKeggPipelineStateManager) -> uuid.UUID:
+    return state_manager.init_new_pipeline_run(
+        MetaKeggPipelineInputParamsValuesAllOptional(global_params={})
+    ).id
+
+
+def _get_index_entries(
+    state_manager: MetaKeggPipelineStateManager, ticket_id: uuid.UUID
+):
+    redis_client = state_manager.redis_client
+    return {
+        "states": [
+            state
+            for state in get_args(MetaKeggPipelineDefStates)
+            if redis_client.sismember(
+                state_manager._get_state_index_name(state), ticket_id.hex
+            )
+        ],
+        "expire": redis_client.zscore(
+            state_manager.REDIS_NAME_PIPELINE_EXPIRE_DEADLINES, ticket_id.hex
+        ),
+        "delete": redis_client.zscore(
+            state_manager.REDIS_NAME_PIPELINE_DELETE_DEADLINES, ticket_id.hex
+        ),
+        "abandon": redis_client.zscore(
+            state_manager.REDIS_NAME_PIPELINE_ABANDON_DEADLINES, ticket_id.hex
+        ),
+    }
+
+
+def test_pipeline_run_indexes():
+    config = pipeline_status_clerk.config
+    state_manager = get_fakeredis_state_manager()
+    ticket_id = _create_pipeline_run(state_manager)
+    created_at_utc = state_manager.get_pipeline_run_definition(ticket_id).created_at_utc
+    index_entries = _get_index_entries(state_manager, ticket_id)
+    assert index_entries == {
+        "states": ["initialized"],
+        "expire": None,
+        "delete": None,
+        "abandon": (
+            created_at_utc
+            + datetime.timedelta(
+                minutes=config.PIPELINE_ABANDONED_DEFINITION_DELETED_AFTER
+            )
+        ).timestamp(),
+    }, index_entries
+
+    # partial updates of indexed fields move the ticket between the indexes
+    finished_at_utc = datetime.datetime.now(
+        tz=datetime.timezone.utc
+    ) - datetime.timedelta(minutes=config.PIPELINE_RESULT_EXPIRED_AFTER_MIN + 1)
+    state_manager.update_pipeline_run_definition_fields(
+        ticket_id, state="success", finished_at_utc=finished_at_utc
+    )
+    expire_at_utc = finished_at_utc + datetime.timedelta(
+        minutes=config.PIPELINE_RESULT_EXPIRED_AFTER_MIN
+    )
+    expected_index_entries = {
+        "states": ["success"],
+        "expire": expire_at_utc.timestamp(),
+        "delete": (
+            expire_at_utc
+            + datetime.timedelta(minutes=config.PIPELINE_RESULT_DELETED_AFTER_MIN)
+        ).timestamp(),
+        "abandon": None,
+    }
+    index_entries = _get_index_entries(state_manager, ticket_id)
+    assert index_entries == expected_index_entries, index_entries
+
+    # updates of not indexed fields leave the indexes alone
+    state_manager.update_pipeline_run_definition_fields(ticket_id, error="oops")
+    assert _get_index_entries(state_manager, ticket_id) == expected_index_entries
+
+    # the indexes can be rebuilt from the definitions
+    state_manager.redis_client.delete(
+        state_manager._get_state_index_name("success"),
+        state_manager.REDIS_NAME_PIPELINE_EXPIRE_DEADLINES,
+        state_manager.REDIS_NAME_PIPELINE_DELETE_DEADLINES,
+    )
+    state_manager.rebuild_pipeline_run_indexes()
+    assert _get_index_entries(state_manager, ticket_id) == expected_index_entries
+
+    assert [d.ticket.id for d in state_manager.get_pipelines_that_are_expired()] == [
+        ticket_id
+    ]
+    assert state_manager.get_pipelines_that_are_deletable() == []
+    assert state_manager.get_pipelines_that_are_abandoned() == []
+
+    # index entries of definitions that vanished are removed when they are found
+    state_manager.redis_client.delete(state_manager._get_definition_name(ticket_id))
+    assert state_manager.get_pipelines_that_are_expired() == []
+    index_entries = _get_index_entries(state_manager, ticket_id)
+    assert index_entries["expire"] is None, index_entries
+
+    other_ticket_id = _create_pipeline_run(state_manager)
+    state_manager.delete_pipeline_status(other_ticket_id)
+    assert _get_index_entries(state_manager, other_ticket_id) == {
+        "states": [],
+        "expire": None,
+        "delete": None,
+        "abandon": None,
+    }
+
+
+def test_batched_housekeeping():
+    config = pipeline_status_clerk.config
+    state_manager = get_fakeredis_state_manager()
+    housekeeper = PipelineHousekeeper(housekeeper_id="test")
+    now = datetime.datetime.now(tz=datetime.timezone.utc)
+    expire_after = datetime.timedelta(minutes=config.PIPELINE_RESULT_EXPIRED_AFTER_MIN)
+    delete_after = datetime.timedelta(minutes=config.PIPELINE_RESULT_DELETED_AFTER_MIN)
+    abandon_after = datetime.timedelta(
+        minutes=config.PIPELINE_ABANDONED_DEFINITION_DELETED_AFTER
+    )
+    expiring_ticket_ids = [_create_pipeline_run(state_manager) for _ in range(5)]
+    for ticket_id in expiring_ticket_ids:
+        state_manager.update_pipeline_run_definition_fields(
+            ticket_id,
+            state="success",
+            finished_at_utc=now - expire_after - datetime.timedelta(minutes=1),
+        )
+    deletable_ticket_ids = [_create_pipeline_run(state_manager) for _ in range(3)]
+    for ticket_id in deletable_ticket_ids:
+        state_manager.update_pipeline_run_definition_fields(
+            ticket_id,
+            state="expired",
+            finished_at_utc=now
+            - expire_after
+            - delete_after
+            - datetime.timedelta(minutes=1),
+        )
+    abandoned_ticket_ids = [_create_pipeline_run(state_manager) for _ in range(3)]
+    for ticket_id in abandoned_ticket_ids:
+        state_manager.update_pipeline_run_definition_fields(
+            ticket_id,
+            created_at_utc=now - abandon_after - datetime.timedelta(minutes=1),
+        )
+    # not due yet
+    fresh_ticket_id = _create_pipeline_run(state_manager)
+
+    def get_states(ticket_ids):
+        return [
+            (state_manager.get_pipeline_run_definition_fields(t, ["state"]) or {}).get(
+                "state"
+            )
+            for t in ticket_ids
+        ]
+
+    with patched_config(
+        pipeline_housekeeper.config, PIPELINE_HOUSEKEEPING_MAX_ITEMS_PER_TICK=2
+    ):
+        # every tick handles at most `PIPELINE_HOUSEKEEPING_MAX_ITEMS_PER_TICK` pipeline runs per task. The rest is left for the next tick.
+        for expected_expired_count in [2, 4, 5, 5]:
+            housekeeper._process_expiring_pipelines(state_manager)
+            assert (
+                get_states(expiring_ticket_ids).count("expired")
+                == expected_expired_count
+            ), get_states(expiring_ticket_ids)
+        for expected_deleted_count in [2, 3]:
+            housekeeper._process_deletable_pipelines(state_manager)
+            assert (
+                get_states(deletable_ticket_ids).count(None) == expected_deleted_count
+            )
+        for expected_deleted_count in [2, 3]:
+            housekeeper._process_abandoned_pipeline_defs(state_manager)
+            assert (
+                get_states(abandoned_ticket_ids).count(None) == expected_deleted_count
+            )
+    assert get_states([fresh_ticket_id]) == ["initialized"]
+    assert set(state_manager.get_all_pipeline_run_ticket_ids()) == set(
+        expiring_ticket_ids + [fresh_ticket_id]
+    )
+
+
+def test_housekeeping_moves_index_entries():
+    config = pipeline_status_clerk.config
+    state_manager = get_fakeredis_state_manager()
+    housekeeper = PipelineHousekeeper(housekeeper_id="test")
+    ticket_id = _create_pipeline_run(state_manager)
+    finished_at_utc = datetime.datetime.now(
+        tz=datetime.timezone.utc
+    ) - datetime.timedelta(minutes=config.PIPELINE_RESULT_EXPIRED_AFTER_MIN + 1)
+    state_manager.update_pipeline_run_definition_fields(
+        ticket_id, state="success", finished_at_utc=finished_at_utc
+    )
+    delete_deadline = _get_index_entries(state_manager, ticket_id)["delete"]
+    # the expired pipeline run leaves the expire deadline index, but keeps its delete deadline
+    housekeeper._process_expiring_pipelines(state_manager)
+    assert _get_index_entries(state_manager, ticket_id) == {
+        "states": ["expired"],
+        "expire": None,
+        "delete": delete_deadline,
+        "abandon": None,
+    }
+    assert state_manager.get_pipelines_that_are_expired() == []
+    # not deletable yet
+    housekeeper._process_deletable_pipelines(state_manager)
+    assert _get_index_entries(state_manager, ticket_id)["states"] == ["expired"]
+    # once the delete deadline passed, the pipeline run is deleted together with its index entries
+    state_manager.update_pipeline_run_definition_fields(
+        ticket_id,
+        finished_at_utc=finished_at_utc
+        - datetime.timedelta(minutes=config.PIPELINE_RESULT_DELETED_AFTER_MIN),
+    )
+    housekeeper._process_deletable_pipelines(state_manager)
+    assert _get_index_entries(state_manager, ticket_id) == {
+        "states": [],
+        "expire": None,
+        "delete": None,
+        "abandon": None,
+    }
+
+
+class _RecordingHousekeeper(PipelineHousekeeper):
+    def __init__(self, housekeeper_id: str, task_calls: List[str]):
+        super().__init__(housekeeper_id=housekeeper_id)
+        self.task_calls = task_calls
+
+    def get_tasks(self):
+        def record(task_name: str):
+            return lambda state_manager: self.task_calls.append(task_name)
+
+        def fail(state_manager):
+            raise ValueError("task failed")
+
+        return {
+            "frequent": (record("frequent"), 1),
+            "rare": (record("rare"), 3600),
+            "failing": (fail, 1),
+        }
+
+
+def _run_housekeeper(housekeeper: PipelineHousekeeper, redis_client, run_sec: float):
+    original_get_redis_client = pipeline_housekeeper.get_redis_client
+    pipeline_housekeeper.get_redis_client = lambda **kwargs: redis_client
+    # `PipelineHousekeeper.run` is what the housekeeper process runs. A thread is enough here.
+    housekeeper_thread = threading.Thread(target=housekeeper.run)
+    try:
+        housekeeper_thread.start()
+        time.sleep(run_sec)
+        housekeeper.stop_event.set()
+        housekeeper_thread.join(10)
+    finally:
+        pipeline_housekeeper.get_redis_client = original_get_redis_client
+    assert not housekeeper_thread.is_alive()
+
+
+def test_housekeeping_schedule():
+    redis_client = get_fakeredis_state_manager().redis_client
+    task_calls = []
+    started_at = time.monotonic()
+    _run_housekeeper(
+        _RecordingHousekeeper("housekeeper-1", task_calls), redis_client, run_sec=2.5
+    )
+    # every task runs on its own interval. A failing task does not stop the others.
+    assert task_calls.count("rare") == 1, task_calls
+    assert 2 <= task_calls.count("frequent") <= 4, task_calls
+    task_runs = PipelineHousekeeper.get_task_runs(redis_client)
+    assert sorted(task_runs) == ["failing", "frequent", "rare"]
+    assert task_runs["failing"].error == "task failed"
+    assert task_runs["rare"].error is None
+    assert task_runs["rare"].housekeeper_id == "housekeeper-1"
+    # the housekeeper stops without waiting for the next due task
+    assert time.monotonic() - started_at < 5
+
+    # another housekeeper (e.g. on another worker node) does not run a task again within its interval
+    other_task_calls = []
+    _run_housekeeper(
+        _RecordingHousekeeper("housekeeper-2", other_task_calls),
+        redis_client,
+        run_sec=1.5,
+    )
+    assert "rare" not in other_task_calls, other_task_calls
+    assert "frequent" in other_task_calls, other_task_calls
+
+
+def test_expiry_does_not_overwrite_concurrent_changes():
+    config = pipeline_status_clerk.config
+    state_manager = get_fakeredis_state_manager()
+    finished_at_utc = datetime.datetime.now(
+        tz=datetime.timezone.utc
+    ) - datetime.timedelta(minutes=config.PIPELINE_RESULT_EXPIRED_AFTER_MIN + 1)
+    ticket_ids = [_create_pipeline_run(state_manager) for _ in range(2)]
+    for ticket_id in ticket_ids:
+        state_manager.update_pipeline_run_definition_fields(
+            ticket_id,
+            state="success",
+            finished_at_utc=finished_at_utc,
+            pipeline_output_zip_file_name="result.zip",
+        )
+    requeued_ticket_id, expiring_ticket_id = ticket_ids
+    read_pipeline_run_definitions = state_manager._get_indexed_pipeline_run_definitions
+    reads = []
+
+    def read_and_requeue(ticket_ids):
+        pipeline_states = read_pipeline_run_definitions(ticket_ids)
+        if not reads:
+            # the pipeline run is requeued between the read and the write of the housekeeper
+            state_manager.update_pipeline_run_definition_fields(
+                requeued_ticket_id,
+                state="queued",
+                finished_at_utc=None,
+                error="requeued",
+            )
+        reads.append(ticket_ids)
+        return pipeline_states
+
+    state_manager._get_indexed_pipeline_run_definitions = read_and_requeue
+    expired = state_manager.set_pipeline_runs_expired(ticket_ids)
+    assert len(reads) == 2
+    assert [d.ticket.id for d in expired] == [expiring_ticket_id]
+    assert expired[0].state == "expired"
+    assert state_manager.get_pipeline_run_definition_fields(
+        requeued_ticket_id, ["state", "error", "pipeline_output_zip_file_name"]
+    ) == {
+        "state": "queued",
+        "error": "requeued",
+        "pipeline_output_zip_file_name": "result.zip",
+    }
+    assert state_manager.get_pipeline_run_definition_fields(
+        expiring_ticket_id,
+        ["state", "finished_at_utc", "pipeline_output_zip_file_name"],
+    ) == {
+        "state": "expired",
+        "finished_at_utc": finished_at_utc,
+        "pipeline_output_zip_file_name": None,
+    }
+    assert _get_index_entries(state_manager, requeued_ticket_id)["states"] == ["queued"]
+    assert _get_index_entries(state_manager, expiring_ticket_id)["expire"] is None
+
+
+def test_clean_zombie_files():
+    state_manager = get_fakeredis_state_manager()
+    housekeeper = PipelineHousekeeper(housekeeper_id="test")
+    ticket_id = _create_pipeline_run(state_manager)
+    cache_dir = Path(tempfile.mkdtemp())
+    pipeline_run_dir = Path(cache_dir, ticket_id.hex)
+    zombie_dir = Path(cache_dir, uuid.uuid4().hex)
+    other_dir = Path(cache_dir, "not-a-pipeline-run")
+    for path in [pipeline_run_dir, zombie_dir, other_dir]:
+        path.mkdir()
+    with patched_config(
+        pipeline_housekeeper.config, PIPELINE_RUNS_CACHE_DIR=str(cache_dir)
+    ):
+        housekeeper._clean_zombie_files(state_manager)
+    assert pipeline_run_dir.exists()
+    assert not zombie_dir.exists()
+    # directories that are not named after a ticket id are left alone
+    assert other_dir.exists()
+
+
+def test_output_log():
+    state_manager = get_fakeredis_state_manager()
+    ticket_id = _create_pipeline_run(state_manager)
+    with patched_config(
+        pipeline_status_clerk.config, PIPELINE_RUN_OUTPUT_LOG_HEAD_LINES=None
+    ):
+        state_manager.append_pipeline_run_output_log(ticket_id, ["line 1", "line 2"])
+        state_manager.append_pipeline_run_output_log(ticket_id, ["line 3"])
+        state_manager.append_pipeline_run_output_log(ticket_id, [])
+        pipeline_status = state_manager.get_pipeline_run_definition(ticket_id)
+        assert pipeline_status.output_log == "line 1\nline 2\nline 3\n"
+        assert pipeline_status.output_log_lines_total == 3
+        assert pipeline_status.output_log_lines_truncated == 0
+        # clients that already have the first lines only fetch the new ones
+        pipeline_status = state_manager.get_pipeline_run_definition(
+            ticket_id, output_log_offset=2
+        )
+        assert pipeline_status.output_log == "line 3\n"
+        assert pipeline_status.output_log_lines_total == 3
+        assert (
+            state_manager.get_pipeline_run_definition(
+                ticket_id, output_log_offset=3
+            ).output_log
+            == ""
+        )
+    # the output log is not part of the stored definition
+    assert not state_manager.redis_client.hexists(
+        state_manager._get_definition_name(ticket_id), "output_log"
+    )
+    state_manager.clear_pipeline_run_output_log(ticket_id)
+    pipeline_status = state_manager.get_pipeline_run_definition(ticket_id)
+    assert pipeline_status.output_log is None
+    assert pipeline_status.output_log_lines_total is None
+
+
+def test_output_log_truncation():
+    state_manager = get_fakeredis_state_manager()
+    ticket_id = _create_pipeline_run(state_manager)
+    with patched_config(
+        pipeline_status_clerk.config,
+        PIPELINE_RUN_OUTPUT_LOG_HEAD_LINES=3,
+        PIPELINE_RUN_OUTPUT_LOG_TAIL_LINES=2,
+    ):
+        lines = [f"line {i}" for i in range(1, 11)]
+        # the head fills up in the middle of a batch
+        state_manager.append_pipeline_run_output_log(ticket_id, lines[:2])
+        state_manager.append_pipeline_run_output_log(ticket_id, lines[2:6])
+        state_manager.append_pipeline_run_output_log(ticket_id, lines[6:])
+        pipeline_status = state_manager.get_pipeline_run_definition(ticket_id)
+        output_log_lines = pipeline_status.output_log.splitlines()
+        assert output_log_lines[:3] == lines[:3]
+        assert output_log_lines[3].startswith("[... 5 lines truncated.")
+        assert output_log_lines[4:] == lines[8:]
+        assert pipeline_status.output_log_lines_total == 10
+        assert pipeline_status.output_log_lines_truncated == 5
+
+        # offsets count the lines of the full output log
+        expected_output_logs_by_offset = {
+            2: (["line 3", "[... 5 lines truncated."] + lines[8:], 5),
+            5: (["[... 3 lines truncated."] + lines[8:], 3),
+            8: (lines[8:], 0),
+            9: (lines[9:], 0),
+            10: ([], 0),
+        }
+        for offset, (
+            expected_lines,
+            expected_truncated,
+        ) in expected_output_logs_by_offset.items():
+            pipeline_status = state_manager.get_pipeline_run_definition(
+                ticket_id, output_log_offset=offset
+            )
+            output_log_lines = pipeline_status.output_log.splitlines()
+            assert len(output_log_lines) == len(expected_lines), (
+                offset,
+                output_log_lines,
+            )
+            for line, expected_line in zip(output_log_lines, expected_lines):
+                assert line.startswith(expected_line), (offset, output_log_lines)
+            assert pipeline_status.output_log_lines_total == 10
+            assert pipeline_status.output_log_lines_truncated == expected_truncated
+
+
+def test_field_level_storage():
+    state_manager = get_fakeredis_state_manager()
+    redis_client = state_manager.redis_client
+    # a definition in the legacy storage layout, with its output log inside
+    legacy_pipeline_status = state_manager.get_pipeline_run_definition(
+        _create_pipeline_run(state_manager)
+    )
+    ticket_id = legacy_pipeline_status.ticket.id
+    state_manager.delete_pipeline_status(ticket_id)
+    legacy_pipeline_status.state = "queued"
+    legacy_pipeline_status.output_log = "line 1\nline 2\n"
+    redis_client.hset(
+        state_manager.REDIS_NAME_PIPELINE_STATES,
+        ticket_id.hex,
+        legacy_pipeline_status.model_dump_json(),
+    )
+    state_manager.rebuild_pipeline_run_indexes()
+    assert not redis_client.exists(state_manager.REDIS_NAME_PIPELINE_STATES)
+    pipeline_status = state_manager.get_pipeline_run_definition(ticket_id)
+    assert pipeline_status.state == "queued"
+    assert pipeline_status.output_log == "line 1\nline 2\n"
+    assert redis_client.sismember(
+        state_manager._get_state_index_name("queued"), ticket_id.hex
+    )
+
+    # partial updates only touch the given fields
+    raw_params = redis_client.hget(
+        state_manager._get_definition_name(ticket_id), "pipeline_params"
+    )
+    state_manager.update_pipeline_run_definition_fields(
+        ticket_id, state="running", run_attempts=2
+    )
+    assert state_manager.get_pipeline_run_definition_fields(
+        ticket_id, ["state", "run_attempts"]
+    ) == {"state": "running", "run_attempts": 2}
+    assert (
+        redis_client.hget(
+            state_manager._get_definition_name(ticket_id), "pipeline_params"
+        )
+        == raw_params
+    )
+    assert (
+        state_manager.get_pipeline_run_definition_fields(uuid.uuid4(), ["state"])
+        is None
+    )
+    try:
+        state_manager.update_pipeline_run_definition_fields(
+            uuid.uuid4(), state="running"
+        )
+        raise AssertionError("Updating a pipeline run that does not exist must fail.")
+    except ValueError:
+        pass
+
+
+def run_all_tests_pipeline_status_clerk():
+    test_pipeline_run_indexes()
+    test_batched_housekeeping()
+    test_housekeeping_moves_index_entries()
+    test_housekeeping_schedule()
+    test_expiry_does_not_overwrite_concurrent_changes()
+    test_clean_zombie_files()
+    test_output_log()
+    test_output_log_truncation()
+    test_field_level_storage()
+
+
+if __name__ == "__main__":
+    run_all_tests_pipeline_status_clerk()
+    print("TESTS SUCCEDED")
@@ -0,0 +1,458 @@
+from concurrent.futures import ThreadPoolExecutor, wait
+import asyncio
+import datetime
+import multiprocessing
+import os
+import signal
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+from metaKEGG.modules.pipeline_async import PipelineAsync
+
+from utils import (
+    call_route,
+    get_fakeredis_state_manager,
+    patched_config,
+    queue_pipeline_runs,
+)
+import mekeweserver.pipeline_worker.pipeline_processor as pipeline_processor
+import mekeweserver.pipeline_worker.pipeline_worker as pipeline_worker
+import mekeweserver.pipeline_worker.analysis_preload as analysis_preload
+import mekeweserver.model as model
+import mekeweserver.fastapi_routes as fastapi_routes
+import mekeweserver.pipeline_status_clerk as pipeline_status_clerk
+from mekeweserver.pipeline_worker.pipeline_housekeeper import PipelineHousekeeper
+from mekeweserver.pipeline_worker.pipeline_processor import MetakeggPipelineProcessor
+from mekeweserver.pipeline_worker.pipeline_worker import PipelineWorker
+from mekeweserver.pipeline_status_clerk import MetaKeggPipelineStateManager
+
+
+async def _fake_gene_expression(self):
+    """Behaves like the analyses of metaKEGG: changes the working directory and writes the output files relative to it, also across awaits."""
+    entry_dir = os.getcwd()
+    os.chdir(os.path.dirname(self.input_file_path))
+    input_text = Path(self.input_file_path).read_text()
+    os.makedirs(self.output_folder_name, exist_ok=True)
+    os.chdir(self.output_folder_name)
+    Path("started_at.txt").write_text(
+        f"{input_text} {datetime.datetime.now().timestamp()}"
+    )
+    # the other analysis runs in the meantime
+    await asyncio.sleep(1)
+    Path("finished_at.txt").write_text(
+        f"{input_text} {datetime.datetime.now().timestamp()}"
+    )
+    os.chdir(entry_dir)
+
+
+def _set_input_file(state_manager, ticket_id, text: str):
+    pipeline_status = state_manager.get_pipeline_run_definition(ticket_id)
+    input_file_dir = pipeline_status.get_input_file_dir("input_file_path")
+    input_file_dir.mkdir(parents=True)
+    Path(input_file_dir, "input.txt").write_text(text)
+    state_manager.update_pipeline_run_definition_fields(
+        ticket_id, pipeline_input_file_names={"input_file_path": ["input.txt"]}
+    )
+
+
+def test_concurrent_analyses():
+    state_manager = get_fakeredis_state_manager()
+    state_manager.set_worker_heartbeat("worker-1")
+    with patched_config(
+        pipeline_processor.config,
+        PIPELINE_RUN_IN_SUBPROCESS=True,
+        PIPELINE_RESULT_CACHE_ENABLED=False,
+        KEGG_REST_CACHE_ENABLED=False,
+        PIPELINE_RUN_RESULT_ZIP_MODE="streamed",
+    ), patched_config(pipeline_worker.config, PIPELINE_WORKER_CONCURRENT_ANALYSES=2):
+        ticket_ids = queue_pipeline_runs(state_manager, 2)
+        for number, ticket_id in enumerate(ticket_ids):
+            _set_input_file(state_manager, ticket_id, f"run-{number}")
+        worker = PipelineWorker(worker_id="worker-1")
+        worker.pipeline_run_executor = ThreadPoolExecutor(max_workers=2)
+        original_gene_expression = PipelineAsync.gene_expression
+        original_get_analysis_process_context = (
+            pipeline_processor.get_analysis_process_context
+        )
+        original_get_redis_client = pipeline_processor.get_redis_client
+        # Forked (instead of started by the fork server) the analysis children inherit the fake analysis and the fake redis server.
+        PipelineAsync.gene_expression = _fake_gene_expression
+        pipeline_processor.get_analysis_process_context = lambda: (
+            multiprocessing.get_context("fork")
+        )
+        pipeline_processor.get_redis_client = lambda **kwargs: (
+            state_manager.redis_client
+        )
+        working_dir = os.getcwd()
+        try:
+            assert worker._submit_next_pipeline_in_queue(state_manager)
+            assert worker._submit_next_pipeline_in_queue(state_manager)
+            assert len(worker.pipeline_runs_in_progress) == 2
+            wait(worker.pipeline_runs_in_progress)
+            for pipeline_run in worker.pipeline_runs_in_progress:
+                pipeline_run.result()
+        finally:
+            worker.pipeline_run_executor.shutdown()
+            PipelineAsync.gene_expression = original_gene_expression
+            pipeline_processor.get_analysis_process_context = (
+                original_get_analysis_process_context
+            )
+            pipeline_processor.get_redis_client = original_get_redis_client
+    assert os.getcwd() == working_dir
+
+    started_at = []
+    finished_at = []
+    for number, ticket_id in enumerate(ticket_ids):
+        pipeline_status = state_manager.get_pipeline_run_definition(ticket_id)
+        assert pipeline_status.state == "success", pipeline_status.error_traceback
+        output_files_dir = pipeline_status.get_output_files_dir()
+        # each analysis wrote only into its own output directory
+        output_files = {
+            path.name: path.read_text().split(" ")
+            for path in output_files_dir.iterdir()
+            if path.suffix == ".txt"
+        }
+        assert sorted(output_files) == ["finished_at.txt", "started_at.txt"]
+        assert {text for text, _ in output_files.values()} == {f"run-{number}"}
+        started_at.append(float(output_files["started_at.txt"][1]))
+        finished_at.append(float(output_files["finished_at.txt"][1]))
+    # the analyses ran at the same time
+    assert max(started_at) < min(finished_at)
+
+
+async def _sleeping_gene_expression(self):
+    """Takes as many seconds (plus one) as the input file says."""
+    await asyncio.sleep(float(Path(self.input_file_path).read_text()))
+    await _fake_gene_expression(self)
+
+
+def _run_worker_until_sigterm(state_manager, analysis_sec: float, drain_sec: float):
+    """Run a worker in this process on two queued pipeline runs and send it SIGTERM once the first one is running.
+    Returns the ticket ids, the time of the signal and the times of the worker heartbeats.
+    """
+    ticket_ids = queue_pipeline_runs(state_manager, 2)
+    for ticket_id in ticket_ids:
+        _set_input_file(state_manager, ticket_id, str(analysis_sec))
+    heartbeat_times = []
+    signal_times = []
+
+    def send_sigterm_when_running():
+        while (
+            state_manager.get_pipeline_run_definition_fields(ticket_ids[0], ["state"])[
+                "state"
+            ]
+            != "running"
+        ):
+            time.sleep(0.05)
+        signal_times.append(time.monotonic())
+        os.kill(os.getpid(), signal.SIGTERM)
+
+    def record_heartbeat(self, worker_id):
+        heartbeat_times.append(time.monotonic())
+        original_set_worker_heartbeat(self, worker_id)
+
+    original_set_worker_heartbeat = MetaKeggPipelineStateManager.set_worker_heartbeat
+    original_gene_expression = PipelineAsync.gene_expression
+    original_get_analysis_process_context = (
+        pipeline_processor.get_analysis_process_context
+    )
+    original_get_redis_client = pipeline_worker.get_redis_client
+    original_signal_handlers = {
+        signum: signal.getsignal(signum) for signum in (signal.SIGTERM, signal.SIGINT)
+    }
+    MetaKeggPipelineStateManager.set_worker_heartbeat = record_heartbeat
+    PipelineAsync.gene_expression = _sleeping_gene_expression
+    pipeline_processor.get_analysis_process_context = lambda: (
+        multiprocessing.get_context("fork")
+    )
+    pipeline_worker.get_redis_client = lambda **kwargs: state_manager.redis_client
+    signal_thread = threading.Thread(target=send_sigterm_when_running)
+    try:
+        with patched_config(
+            pipeline_processor.config,
+            PIPELINE_RUN_IN_SUBPROCESS=True,
+            PIPELINE_RESULT_CACHE_ENABLED=False,
+            KEGG_REST_CACHE_ENABLED=False,
+            PIPELINE_RUN_RESULT_ZIP_MODE="streamed",
+            PIPELINE_WORKER_DRAIN_GRACE_PERIOD_SEC=drain_sec,
+        ), patched_config(
+            pipeline_worker.config,
+            # the analysis child processes are forked from this process (see above), not from a fork server
+            PIPELINE_RUN_IN_SUBPROCESS=False,
+            PIPELINE_WORKER_PRELOAD_ANALYSIS_MODULES=False,
+            PIPELINE_WORKER_HEARTBEAT_INTERVAL_SEC=1,
+            PIPELINE_WORKER_DEQUEUE_MODE="blocking",
+            PIPELINE_WORKER_DEQUEUE_TIMEOUT_SEC=1,
+        ):
+            signal_thread.start()
+            # the worker process runs its loop in its main thread. So does this test, to receive the signal.
+            PipelineWorker(worker_id="worker-1").run()
+    finally:
+        signal_thread.join()
+        MetaKeggPipelineStateManager.set_worker_heartbeat = (
+            original_set_worker_heartbeat
+        )
+        PipelineAsync.gene_expression = original_gene_expression
+        pipeline_processor.get_analysis_process_context = (
+            original_get_analysis_process_context
+        )
+        pipeline_worker.get_redis_client = original_get_redis_client
+        for signum, handler in original_signal_handlers.items():
+            signal.signal(signum, handler)
+    return ticket_ids, signal_times[0], heartbeat_times
+
+
+def test_shutdown_drains_running_pipeline_run():
+    state_manager = get_fakeredis_state_manager()
+    ticket_ids, signaled_at, heartbeat_times = _run_worker_until_sigterm(
+        state_manager, analysis_sec=3, drain_sec=30
+    )
+    # the running pipeline run was finished, the next one was not started anymore
+    assert [
+        state_manager.get_pipeline_run_definition_fields(t, ["state"])["state"]
+        for t in ticket_ids
+    ] == ["success", "queued"]
+    assert state_manager.queue.get_ticket_ids() == [ticket_ids[1]]
+    assert (
+        state_manager.redis_client.llen(
+            state_manager._get_processing_list_name("worker-1")
+        )
+        == 0
+    )
+    # the worker reported to be alive while it drained and deregistered afterwards
+    assert len([t for t in heartbeat_times if t > signaled_at]) >= 2, heartbeat_times
+    assert state_manager.get_worker_heartbeats() == {}
+
+
+def test_shutdown_requeues_interrupted_pipeline_run():
+    state_manager = get_fakeredis_state_manager()
+    started_at = time.monotonic()
+    ticket_ids, signaled_at, heartbeat_times = _run_worker_until_sigterm(
+        state_manager, analysis_sec=60, drain_sec=2
+    )
+    # aborted after the grace period, not after the analysis
+    assert time.monotonic() - started_at < 30
+    pipeline_status = state_manager.get_pipeline_run_definition(ticket_ids[0])
+    assert pipeline_status.state == "queued"
+    assert pipeline_status.error is None
+    # a shutdown does not count as a failed attempt
+    assert pipeline_status.run_attempts == 0
+    # back at the head of the queue
+    assert state_manager.queue.get_ticket_ids() == ticket_ids
+    assert (
+        state_manager.redis_client.llen(
+            state_manager._get_processing_list_name("worker-1")
+        )
+        == 0
+    )
+    assert len([t for t in heartbeat_times if t > signaled_at]) >= 1, heartbeat_times
+    assert state_manager.get_worker_heartbeats() == {}
+
+
+async def _failing_gene_expression(self):
+    raise ValueError("broken input file")
+
+
+async def _crashing_gene_expression(self):
+    os._exit(3)
+
+
+def _run_analysis_in_child_process(
+    state_manager, gene_expression, input_text: str = "run", **config_values
+) -> model.MetaKeggPipelineDef:
+    ticket_id = queue_pipeline_runs(state_manager, 1)[0]
+    _set_input_file(state_manager, ticket_id, input_text)
+    state_manager.set_pipeline_state_as_running(ticket_id)
+    original_gene_expression = PipelineAsync.gene_expression
+    original_get_analysis_process_context = (
+        pipeline_processor.get_analysis_process_context
+    )
+    original_get_redis_client = pipeline_processor.get_redis_client
+    PipelineAsync.gene_expression = gene_expression
+    pipeline_processor.get_analysis_process_context = lambda: (
+        multiprocessing.get_context("fork")
+    )
+    pipeline_processor.get_redis_client = lambda **kwargs: state_manager.redis_client
+    try:
+        with patched_config(
+            pipeline_processor.config,
+            PIPELINE_RUN_IN_SUBPROCESS=True,
+            PIPELINE_RESULT_CACHE_ENABLED=False,
+            KEGG_REST_CACHE_ENABLED=False,
+            PIPELINE_RUN_RESULT_ZIP_MODE="streamed",
+            **config_values,
+        ):
+            MetakeggPipelineProcessor(
+                state_manager.get_pipeline_run_definition(ticket_id), state_manager
+            ).run()
+    finally:
+        PipelineAsync.gene_expression = original_gene_expression
+        pipeline_processor.get_analysis_process_context = (
+            original_get_analysis_process_context
+        )
+        pipeline_processor.get_redis_client = original_get_redis_client
+    return state_manager.get_pipeline_run_definition(ticket_id)
+
+
+def test_analysis_child_process():
+    state_manager = get_fakeredis_state_manager()
+    working_dir = os.getcwd()
+    pipeline_status = _run_analysis_in_child_process(
+        state_manager, _fake_gene_expression
+    )
+    assert pipeline_status.state == "success", pipeline_status.error_traceback
+    assert sorted(p.name for p in pipeline_status.get_output_files_dir().iterdir()) == [
+        "finished_at.txt",
+        "started_at.txt",
+    ]
+    # the analysis changed the working directory of the child process only
+    assert os.getcwd() == working_dir
+
+    # errors of the analysis are reported with the traceback of the child process
+    pipeline_status = _run_analysis_in_child_process(
+        state_manager, _failing_gene_expression
+    )
+    assert pipeline_status.state == "failed"
+    assert pipeline_status.error == "broken input file"
+    assert "ValueError: broken input file" in pipeline_status.error_traceback
+
+    # a crashing analysis does not take the worker down
+    pipeline_status = _run_analysis_in_child_process(
+        state_manager, _crashing_gene_expression
+    )
+    assert pipeline_status.state == "failed"
+    assert pipeline_status.error == (
+        "The analysis process exited unexpectedly with exit code 3."
+    )
+
+
+def test_analysis_time_limit():
+    state_manager = get_fakeredis_state_manager()
+    started_at = time.monotonic()
+    pipeline_status = _run_analysis_in_child_process(
+        state_manager,
+        _sleeping_gene_expression,
+        input_text="60",
+        PIPELINE_RUN_TIMEOUT_SEC=1,
+    )
+    # the analysis was killed after the time limit, not after it finished
+    assert time.monotonic() - started_at < 30
+    assert pipeline_status.state == "failed"
+    assert pipeline_status.error == (
+        "The analysis exceeded the time limit of 1 seconds and was aborted."
+    )
+    assert not list(pipeline_status.get_output_files_dir().glob("*.txt"))
+
+
+def _set_last_heartbeat(state_manager, worker_id: str, seconds_ago: float):
+    state_manager.redis_client.hset(
+        state_manager.REDIS_NAME_PIPELINE_WORKER_HEARTBEATS,
+        worker_id,
+        datetime.datetime.now(tz=datetime.timezone.utc).timestamp() - seconds_ago,
+    )
+
+
+def _get_health(state_manager) -> dict:
+    health_state = call_route(
+        state_manager.redis_client, fastapi_routes.get_health_router, "/health"
+    )
+    return {
+        "healthy": health_state.healthy,
+        "dependencies": {d.name: d.healthy for d in health_state.dependencies},
+    }
+
+
+def _get_startup_statistics(state_manager) -> tuple:
+    statistics = call_route(
+        state_manager.redis_client,
+        fastapi_routes.get_info_config_router,
+        "/stats",
+        days_limit=None,
+        days_offset=None,
+    )
+    return (
+        statistics.average_analysis_startup_warm_sec,
+        statistics.average_analysis_startup_cold_sec,
+    )
+
+
+def test_analysis_startup_statistics():
+    state_manager = get_fakeredis_state_manager()
+    # no finished pipeline runs yet
+    assert _get_startup_statistics(state_manager) == (None, None)
+
+    original_preloaded = analysis_preload._preloaded
+    try:
+        # forked from a process that did (or did not) preload the analysis modules
+        for preloaded in [False, True]:
+            analysis_preload._preloaded = preloaded
+            pipeline_status = _run_analysis_in_child_process(
+                state_manager, _fake_gene_expression
+            )
+            assert pipeline_status.state == "success", pipeline_status.error_traceback
+            state_manager.set_pipeline_state_as_finished(pipeline_status.ticket.id)
+    finally:
+        analysis_preload._preloaded = original_preloaded
+    warm_sec, cold_sec = _get_startup_statistics(state_manager)
+    assert warm_sec is not None and cold_sec is not None
+    # the startup times moved into the statistic points
+    assert not state_manager.redis_client.exists(
+        state_manager.REDIS_NAME_PIPELINE_ANALYSIS_STARTUP_TIMES
+    )
+
+
+def test_worker_health():
+    state_manager = get_fakeredis_state_manager()
+    config = pipeline_status_clerk.config
+    # no worker at all
+    assert _get_health(state_manager) == {
+        "healthy": False,
+        "dependencies": {"worker": False, "cache": True},
+    }
+    state_manager.set_worker_heartbeat("worker-1")
+    assert _get_health(state_manager) == {
+        "healthy": True,
+        "dependencies": {"worker:worker-1": True, "cache": True},
+    }
+    # a worker without a recent heartbeat is reported as unhealthy, even if other workers are alive
+    _set_last_heartbeat(
+        state_manager, "worker-2", config.PIPELINE_WORKER_HEARTBEAT_TIMEOUT_SEC + 1
+    )
+    assert state_manager.get_alive_worker_count() == 1
+    assert _get_health(state_manager) == {
+        "healthy": False,
+        "dependencies": {
+            "worker:worker-1": True,
+            "worker:worker-2": False,
+            "cache": True,
+        },
+    }
+    # reading the health does not change anything
+    assert sorted(state_manager.get_worker_heartbeats()) == ["worker-1", "worker-2"]
+
+    # the housekeeper removes workers that are gone for good
+    _set_last_heartbeat(
+        state_manager, "worker-3", config.PIPELINE_WORKER_FORGET_AFTER_SEC + 1
+    )
+    PipelineHousekeeper(housekeeper_id="test")._remove_gone_workers(state_manager)
+    assert sorted(state_manager.get_worker_heartbeats()) == ["worker-1", "worker-2"]
+    state_manager.remove_worker_heartbeat("worker-2")
+    assert _get_health(state_manager)["healthy"]
+
+
+def run_all_tests_pipeline_worker():
+    with patched_config(model.config, PIPELINE_RUNS_CACHE_DIR=tempfile.mkdtemp()):
+        test_concurrent_analyses()
+        test_analysis_child_process()
+        test_analysis_time_limit()
+        test_analysis_startup_statistics()
+        test_worker_health()
+        test_shutdown_drains_running_pipeline_run()
+        test_shutdown_requeues_interrupted_pipeline_run()
+
+
+if __name__ == "__main__":
+    run_all_tests_pipeline_worker()
+    print("TESTS SUCCEDED")
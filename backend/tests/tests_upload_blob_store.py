@@ -0,0 +1,145 @@
+import io
+import tempfile
+import uuid
+from pathlib import Path
+
+import fakeredis
+
+from utils import patched_config
+import mekeweserver.upload_blob_store as upload_blob_store
+from mekeweserver.upload_blob_store import MetaKeggUploadBlobStore
+
+
+def _get_blob_store() -> MetaKeggUploadBlobStore:
+    with patched_config(
+        upload_blob_store.config, PIPELINE_UPLOAD_BLOB_DIR=tempfile.mkdtemp()
+    ):
+        return MetaKeggUploadBlobStore(
+            fakeredis.FakeRedis(server=fakeredis.FakeServer())
+        )
+
+
+def _get_blob_paths(blob_store: MetaKeggUploadBlobStore):
+    return sorted(path for path in blob_store.blob_dir.glob("**/*") if path.is_file())
+
+
+def _get_refcounts(blob_store: MetaKeggUploadBlobStore):
+    return {
+        digest.decode("utf-8"): int(refcount)
+        for digest, refcount in blob_store.redis_client.hgetall(
+            blob_store.REDIS_NAME_REFCOUNTS
+        ).items()
+    }
+
+
+def test_store_deduplicates_uploads():
+    blob_store = _get_blob_store()
+    input_dir = Path(tempfile.mkdtemp())
+    ticket_ids = [uuid.uuid4(), uuid.uuid4()]
+    target_paths = [Path(input_dir, t.hex, "genes.xlsx") for t in ticket_ids]
+    digests = []
+    for ticket_id, target_path in zip(ticket_ids, target_paths):
+        target_path.parent.mkdir()
+        digests.append(
+            blob_store.store(
+                ticket_id,
+                "input_file_path",
+                "genes.xlsx",
+                io.BytesIO(b"gene\tvalue\n" * 1000),
+                target_path,
+            )
+        )
+    # the same content is stored once and linked into both pipeline runs
+    assert digests[0] == digests[1]
+    assert _get_blob_paths(blob_store) == [blob_store._get_blob_path(digests[0])]
+    assert target_paths[0].stat().st_ino == target_paths[1].stat().st_ino
+    assert target_paths[1].read_bytes() == b"gene\tvalue\n" * 1000
+    assert _get_refcounts(blob_store) == {digests[0]: 2}
+    # no temporary upload files are left behind
+    assert [p.name for p in blob_store.blob_dir.iterdir()] == [digests[0][:2]]
+
+    # a re-upload under the same name replaces the file and releases the former blob, if nobody else uses it
+    new_digest = blob_store.store(
+        ticket_ids[0],
+        "input_file_path",
+        "genes.xlsx",
+        io.BytesIO(b"other content"),
+        target_paths[0],
+    )
+    assert target_paths[0].read_bytes() == b"other content"
+    assert _get_refcounts(blob_store) == {digests[0]: 1, new_digest: 1}
+    blob_store.store(
+        ticket_ids[1],
+        "input_file_path",
+        "genes.xlsx",
+        io.BytesIO(b"other content"),
+        target_paths[1],
+    )
+    assert _get_refcounts(blob_store) == {new_digest: 2}
+    assert _get_blob_paths(blob_store) == [blob_store._get_blob_path(new_digest)]
+
+
+def test_release():
+    blob_store = _get_blob_store()
+    input_dir = Path(tempfile.mkdtemp())
+    ticket_ids = [uuid.uuid4(), uuid.uuid4()]
+    digest = None
+    for ticket_id in ticket_ids:
+        for file_name in ["a.txt", "b.txt"]:
+            digest = blob_store.store(
+                ticket_id,
+                "input_file_path",
+                file_name,
+                io.BytesIO(b"same content"),
+                Path(input_dir, f"{ticket_id.hex}-{file_name}"),
+            )
+    assert _get_refcounts(blob_store) == {digest: 4}
+    # one file of a pipeline run, twice
+    blob_store.release(ticket_ids[0], "input_file_path", "a.txt")
+    blob_store.release(ticket_ids[0], "input_file_path", "a.txt")
+    assert _get_refcounts(blob_store) == {digest: 3}
+    # all files of a pipeline run, twice
+    blob_store.release(ticket_ids[1])
+    blob_store.release(ticket_ids[1])
+    assert _get_refcounts(blob_store) == {digest: 1}
+    assert _get_blob_paths(blob_store) == [blob_store._get_blob_path(digest)]
+    # the last reference removes the blob. The input files of the pipeline runs are hard links and stay.
+    blob_store.release(ticket_ids[0])
+    assert _get_refcounts(blob_store) == {}
+    assert _get_blob_paths(blob_store) == []
+    assert Path(input_dir, f"{ticket_ids[0].hex}-b.txt").read_bytes() == (
+        b"same content"
+    )
+
+
+def test_remove_orphaned_blobs():
+    blob_store = _get_blob_store()
+    ticket_id = uuid.uuid4()
+    digest = blob_store.store(
+        ticket_id,
+        "input_file_path",
+        "genes.txt",
+        io.BytesIO(b"referenced"),
+        Path(tempfile.mkdtemp(), "genes.txt"),
+    )
+    # e.g. left behind by a crash between storing the blob and counting the reference
+    orphaned_blob_path = blob_store._get_blob_path("ab" + "0" * 62)
+    orphaned_blob_path.parent.mkdir()
+    orphaned_blob_path.write_bytes(b"orphaned")
+    # recent blobs are kept, a reference might be just about to be counted
+    blob_store.remove_orphaned_blobs()
+    assert orphaned_blob_path.exists()
+    blob_store.ORPHANED_BLOB_MIN_AGE_SEC = -1
+    blob_store.remove_orphaned_blobs()
+    assert _get_blob_paths(blob_store) == [blob_store._get_blob_path(digest)]
+
+
+def run_all_tests_upload_blob_store():
+    test_store_deduplicates_uploads()
+    test_release()
+    test_remove_orphaned_blobs()
+
+
+if __name__ == "__main__":
+    run_all_tests_upload_blob_store()
+    print("TESTS SUCCEDED")
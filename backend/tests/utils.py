@@ -1,4 +1,5 @@
-from typing import Dict, List, Literal, Tuple
+from typing import Any, Dict, List, Literal, Tuple
+from contextlib import contextmanager
 from io import BufferedReader
 from pathlib import Path
 import os
@@ -244,3 +245,69 @@ def kill_orphean_test_run_processes(kill_myself_too: bool = False):
         print("All matching Python processes have been terminated, except this one.")
     except Exception as e:
         print(f"An error occurred: {e}")
+
+
+@contextmanager
+def patched_config(config: Config, **values: Any):
+    """Set config values while in context. Every mekeweserver module has its own config instance, patch the one of the module under test."""
+    original_values = {name: getattr(config, name) for name in values}
+    for name, value in values.items():
+        setattr(config, name, value)
+    try:
+        yield config
+    finally:
+        for name, value in original_values.items():
+            setattr(config, name, value)
+
+
+def get_fakeredis_state_manager():
+    """A `MetaKeggPipelineStateManager` on an own fake redis server, so tests do not see each others pipeline runs."""
+    import fakeredis
+    from mekeweserver.pipeline_status_clerk import MetaKeggPipelineStateManager
+
+    return MetaKeggPipelineStateManager(
+        fakeredis.FakeRedis(server=fakeredis.FakeServer())
+    )
+
+
+def queue_pipeline_runs(state_manager, amount: int, client_key: str = "") -> List:
+    """Create `amount` queued pipeline runs with empty input directories. Returns their ticket ids."""
+    from mekeweserver.model import MetaKeggPipelineInputParamsValuesAllOptional
+
+    ticket_ids = []
+    for _ in range(amount):
+        ticket_id = state_manager.init_new_pipeline_run(
+            MetaKeggPipelineInputParamsValuesAllOptional(global_params={})
+        ).id
+        state_manager.set_pipeline_method(ticket_id, "gene_expression")
+        # stands in for the uploaded input files
+        state_manager.get_pipeline_run_definition(
+            ticket_id
+        ).get_input_files_base_dir().mkdir(parents=True)
+        state_manager.set_pipeline_run_as_queud(ticket_id, client_key=client_key)
+        ticket_ids.append(ticket_id)
+    return ticket_ids
+
+
+def call_route(redis_client, get_router, path: str, **params):
+    """Call the endpoint of a route of `mekeweserver.fastapi_routes` directly, without a http client or a running server, on `redis_client`.
+    Query `params` of the endpoint must be passed explicitly.
+    """
+    import asyncio
+    from fastapi import FastAPI
+    from slowapi import Limiter
+    from starlette.requests import Request
+    import mekeweserver.fastapi_routes as fastapi_routes
+
+    app = FastAPI()
+    app.state.limiter = Limiter(key_func=lambda request: "", enabled=False)
+    original_get_redis_client = fastapi_routes.get_redis_client
+    fastapi_routes.get_redis_client = lambda: redis_client
+    try:
+        router = get_router(app)
+    finally:
+        fastapi_routes.get_redis_client = original_get_redis_client
+    route = next(route for route in router.routes if route.path == path)
+    return asyncio.run(
+        route.endpoint(request=Request({"type": "http", "headers": []}), **params)
+    )